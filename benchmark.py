@@ -0,0 +1,328 @@
+#! /usr/bin/python
+
+"""
+benchmark.py: Benchmarks for the sidestream hot paths.
+
+Usage: benchmark.py [options] [name ...]
+
+Runs the named benchmarks, or all of them, each in its own process.  Every
+benchmark reports its rate (calls or records per second), per call latency
+percentiles in microseconds, and the peak RSS of its process.  Inputs are
+synthetic and seeded, so runs are comparable.
+
+With --output, the results are saved as JSON.  With --baseline, they are
+compared against a saved run, and the exit status is 1 if any rate dropped,
+or any latency rose, by more than --tolerance.
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import timeit
+
+import exitstats
+import paris_rollins
+import sockdiag
+import web100sim
+
+
+def syntheticSnapshot(i):
+    """Returns a Web100 snapshot with every standard variable set."""
+    snap = dict((k, i * 31 + n) for n, k in enumerate(
+        exitstats.Web100StatsWriter.stdvars))
+    snap.update({"LocalAddress": "1.2.3.%d" % (10 + i % 50),
+                 "RemAddress": "5.%d.%d.%d" % (i % 7, i % 251, i % 13),
+                 "LocalAddressType": 1})
+    return snap
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def measure(fn, count, prefix=''):
+    """Calls fn(i) for i in range(count), and returns its rate and latencies.
+
+    Returns:
+      dict with the calls per second ('rate') and the 50th, 90th and 99th
+      percentile latencies ('p50_us' etc.), with keys prefixed by prefix.
+    """
+    timer = timeit.default_timer
+    latencies = []
+    start = timer()
+    for i in xrange(count):
+        t = timer()
+        fn(i)
+        latencies.append(timer() - t)
+    elapsed = timer() - start
+    latencies.sort()
+    result = {prefix + 'rate': count / elapsed}
+    for p in (50, 90, 99):
+        result['%sp%d_us' % (prefix, p)] = percentile(latencies, p) * 1e6
+    return result
+
+
+class TemporaryDirectory(object):
+    """Runs the enclosed code in a new temporary working directory."""
+
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix='sidestream-benchmark')
+        os.chdir(self.path)
+        return self.path
+
+    def __exit__(self, *args):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+def benchFormatter(count=20000):
+    """Formats records with TextFormat, and with the legacy loop."""
+    snaps = [syntheticSnapshot(i) for i in range(100)]
+    active_vars = exitstats.Web100StatsWriter.stdvars
+    fmt = exitstats.TextFormat()
+    fmt.setkey(active_vars, snaps[0])
+    now = time.time()
+    result = measure(lambda i: fmt.record(i, now + i / 1000.0, snaps[i % 100]),
+                     count)
+    # The reference formatter the byte for byte test compares against.
+    from exitstats_test import legacyRecord as legacy
+    result.update(measure(lambda i: legacy(i, now + i / 1000.0,
+                                           active_vars, snaps[i % 100]),
+                          count, prefix='legacy_'))
+    return result
+
+
+def benchLogConnection(count=20000):
+    """Logs closed connections to per-IP files, batched."""
+    agent = web100sim.SimulatedAgent(connections=count, seed=1)
+    conns = agent.all_connections()
+    os.environ['SIDESTREAM_USE_LOCAL_IP'] = 'True'
+    with TemporaryDirectory():
+        writer = exitstats.Web100StatsWriter('bench/', flush_bytes=64*1024,
+                                             flush_seconds=5)
+        result = measure(lambda i: writer.logConnection(conns[i]), count)
+        writer.closeLogs()
+    return result
+
+
+def benchGetLogFile(count=100000):
+    """Looks up the log file for one of 13 local addresses."""
+    os.environ['SIDESTREAM_USE_LOCAL_IP'] = 'True'
+    addresses = ['1.2.3.%d' % (9 + i) for i in range(13)]
+    now = time.time()
+    with TemporaryDirectory():
+        writer = exitstats.Web100StatsWriter('bench/')
+        writer.setkey(syntheticSnapshot(0))
+        result = measure(lambda i: writer.getLogFile(now, addresses[i % 13]),
+                         count)
+        writer.closeLogs()
+    return result
+
+
+def benchRecentIPAddressCache(count=100000):
+    """Checks and adds addresses, 90% of them repeats."""
+    cache = paris_rollins.RecentIPAddressCache(
+        paris_rollins.MEAN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MIN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MAX_IP_CACHE_TIME_SECONDS)
+    addresses = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+                 for i in range(count // 10)]
+
+    def lookup(i):
+        address = addresses[(i * 7919) % len(addresses)]
+        if not cache.cached(address):
+            cache.add(address)
+    return measure(lookup, count)
+
+
+def benchTraceroutePool(count=200):
+    """Runs stub traceroutes (/bin/true) through a ParisTraceroutePool."""
+    paris_rollins.TIMEOUT_BIN = '/bin/true'
+    with TemporaryDirectory() as tmpdir:
+        pool = paris_rollins.ParisTraceroutePool(tmpdir)
+
+        def run(i):
+            while not pool.run_async(i, 'bench', 33457, '10.0.0.%d' % (i % 250),
+                                     80, '1.2.3.4', 1234):
+                time.sleep(0.001)
+        result = measure(run, count)
+        while not pool.idle():
+            time.sleep(0.01)
+    return result
+
+
+def benchTracerouteExecutor(count=200):
+    """Runs stub traceroutes (/bin/true) through a TracerouteExecutor."""
+    with TemporaryDirectory() as tmpdir:
+        executor = paris_rollins.TracerouteExecutor(tmpdir,
+                                                    traceroute_bin='/bin/true')
+
+        def run(i):
+            while not executor.run_async(i, 'bench', 33457,
+                                         '10.0.0.%d' % (i % 250), 80,
+                                         '1.2.3.4', 1234):
+                time.sleep(0.001)
+        result = measure(run, count)
+        while not executor.idle():
+            time.sleep(0.01)
+    return result
+
+
+def benchExitstatsPoll(count=5, connections=50000, close_rate=2000):
+    """Polls a simulated agent with 50k connections and 2k closes/sec."""
+    clock = [0.0]
+    agent = web100sim.SimulatedAgent(connections=connections,
+                                     close_rate=close_rate,
+                                     clock=lambda: clock[0])
+    with TemporaryDirectory():
+        writer = exitstats.Web100StatsWriter('bench/', flush_bytes=64*1024,
+                                             flush_seconds=5)
+        queue = exitstats.pipeline.SnapshotQueue(100000)
+        _, writers = exitstats.startWriters(writer, queue, 1)
+        tracker = exitstats.conntrack.ConnectionTracker()
+        prefilter = exitstats.Prefilter(exitstats.ClassificationCache(
+            writer.ipToIndex, writer.connectionType))
+
+        def poll(i):
+            clock[0] += 5
+            exitstats.pollConnections(agent, tracker, queue,
+                                      prefilter=prefilter)
+        result = measure(poll, count)
+        exitstats.stopWriters(writer, queue, writers)
+    result['missed'] = agent.missed
+    return result
+
+
+def benchParisRollinsScan(count=5, connections=50000, close_rate=2000):
+    """Scans a simulated agent with 50k connections and 2k closes/sec."""
+    read_errors = paris_rollins.READ_ERRORS + (web100sim.error,)
+    clock = [0.0]
+    agent = web100sim.SimulatedAgent(connections=connections,
+                                     close_rate=close_rate,
+                                     clock=lambda: clock[0])
+    cache = paris_rollins.RecentIPAddressCache(
+        paris_rollins.MEAN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MIN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MAX_IP_CACHE_TIME_SECONDS)
+    state = paris_rollins.ScanState()
+
+    def scan(i):
+        clock[0] += 5
+        paris_rollins.uncached_closed_connections(agent, cache, state,
+                                                  read_errors)
+    return measure(scan, count)
+
+
+def benchSockDiagPoll(count=20, connections=500):
+    """Dumps 500 loopback TCP connections, and reads one variable from each."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(connections)
+    sockets = []
+    for _ in range(connections):
+        sockets.append(socket.create_connection(listener.getsockname()))
+        sockets.append(listener.accept()[0])
+    agent = sockdiag.SockDiagAgent(families=(socket.AF_INET,))
+
+    def poll(i):
+        for c in agent.all_connections():
+            c.read('State')
+    result = measure(poll, count)
+    agent.close()
+    for s in sockets + [listener]:
+        s.close()
+    return result
+
+
+BENCHMARKS = {
+    'formatter': benchFormatter,
+    'log_connection': benchLogConnection,
+    'get_log_file': benchGetLogFile,
+    'recent_ip_cache': benchRecentIPAddressCache,
+    'traceroute_pool': benchTraceroutePool,
+    'traceroute_executor': benchTracerouteExecutor,
+    'exitstats_poll': benchExitstatsPoll,
+    'paris_rollins_scan': benchParisRollinsScan,
+    'sockdiag_poll': benchSockDiagPoll,
+}
+
+
+def _runChild(name, results):
+    result = BENCHMARKS[name]()
+    # ru_maxrss is in kilobytes on Linux.
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(result)
+
+
+def run(name):
+    """Runs a benchmark in a child process, so its peak RSS is its own."""
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_runChild, args=(name, results))
+    child.start()
+    result = results.get()
+    child.join()
+    return result
+
+
+def regressions(results, baseline, tolerance):
+    """Lists the results that are worse than baseline by more than tolerance.
+
+    Rates should not drop, and latencies (_us) and peak RSS should not rise.
+    """
+    found = []
+    for name, result in sorted(results.items()):
+        for key, value in sorted(result.items()):
+            base = baseline.get(name, {}).get(key)
+            if not base:
+                continue
+            change = (value - base) / float(base)
+            if key.endswith('rate'):
+                change = -change
+            elif not (key.endswith('_us') or key == 'peak_rss_kb'):
+                continue
+            if change > tolerance:
+                found.append('%s %s: %.4g -> %.4g' % (name, key, base, value))
+    return found
+
+
+optparser = optparse.OptionParser(
+    usage='%prog [options] [' + '|'.join(sorted(BENCHMARKS)) + ' ...]')
+optparser.add_option('-o', '--output', help='save the results as JSON')
+optparser.add_option('-b', '--baseline', help='JSON results to compare with')
+optparser.add_option('-t', '--tolerance', type='float', default=0.2,
+                     help='allowed fractional regression')
+
+
+def main(argv):
+    (options, names) = optparser.parse_args(argv[1:])
+    names = names or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            optparser.error('unknown benchmark %s' % name)
+    results = {}
+    for name in names:
+        results[name] = run(name)
+        print '%s: %s' % (name, ', '.join(
+            '%s=%.4g' % kv for kv in sorted(results[name].items())))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            found = regressions(results, json.load(f), options.tolerance)
+        for line in found:
+            print 'REGRESSION', line
+        if found:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
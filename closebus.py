@@ -0,0 +1,207 @@
+"""
+closebus.py: Streams of events, published over Unix domain sockets.
+
+exitstats already scans the connection table on every poll.  It publishes
+each newly closed connection as a CloseEvent, so that paris_rollins can
+subscribe instead of scanning the same table again.  It may also stream every
+logged record, for near real time consumers.
+
+Events are sent as lines, by default of tab separated fields in CloseEvent
+order.  The publisher never blocks the poller: each subscriber has a bounded
+buffer of unsent events, and events that do not fit are dropped and counted.
+"""
+
+import errno
+import os
+import select
+import socket
+
+from collections import namedtuple
+
+import prometheus_client as prom
+
+DEFAULT_PATH = '/var/run/sidestream-closes.sock'
+
+# Bytes of unsent events kept for a slow subscriber.
+MAX_PENDING = 1 << 20
+
+subscriber_count = prom.Gauge('sidestream_stream_subscribers',
+                              'Current number of subscribers per stream',
+                              ['stream'])
+published_count = prom.Counter('sidestream_stream_published_count',
+                               'Count of events published per stream',
+                               ['stream'])
+dropped_count = prom.Counter(
+    'sidestream_stream_dropped_count',
+    'Count of events dropped because a subscriber fell behind',
+    ['stream'])
+
+CloseEvent = namedtuple('CloseEvent', ['time', 'cid', 'LocalAddress',
+                                       'LocalPort', 'RemAddress', 'RemPort',
+                                       'LocalAddressType'])
+# Field conversions, applied to received events.
+_FIELD_TYPES = (float, int, str, int, str, int, int)
+
+
+def eventFromSnapshot(cid, poll_time, snap):
+    """Returns the CloseEvent of a closed connection's snapshot."""
+    return CloseEvent(poll_time, cid, snap['LocalAddress'], snap['LocalPort'],
+                      snap['RemAddress'], snap['RemPort'],
+                      snap['LocalAddressType'])
+
+
+def encode(event):
+    return '%r\t%d\t%s\t%d\t%s\t%d\t%d\n' % event
+
+
+def decode(line):
+    return CloseEvent._make(t(v) for t, v in zip(_FIELD_TYPES,
+                                                  line.split('\t')))
+
+
+class Subscription(object):
+    """A subscriber, as seen by the Publisher."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Encoded events not sent yet.
+        self.pending = ''
+        # Count of events that did not fit in pending.
+        self.dropped = 0
+
+
+class Publisher(object):
+    """Sends events to the subscribers connected to a Unix socket.
+
+    New subscribers are accepted when events are published, so the publisher
+    needs no thread of its own.
+    """
+
+    def __init__(self, path, max_pending=MAX_PENDING, encode=encode,
+                 stream='close_events'):
+        """
+        Args:
+          path: str, the Unix socket path.  A stale socket is replaced.
+          max_pending: int, bytes of unsent events kept per subscriber.
+          encode: callable, returns an event as a line.
+          stream: str, the name of the stream in metrics.
+        """
+        self.path = path
+        self.max_pending = max_pending
+        self.encode = encode
+        self.published = published_count.labels(stream)
+        self.dropped = dropped_count.labels(stream)
+        self.subscriber_count = subscriber_count.labels(stream)
+        # Map from subscriber socket to its Subscription.
+        self.subscribers = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            sock.shutdown(socket.SHUT_RD)
+            self.subscribers[sock] = Subscription(sock)
+
+    def _drop(self, sock):
+        del self.subscribers[sock]
+        sock.close()
+
+    def publish(self, events):
+        """Sends events to every subscriber, without blocking.
+
+        Args:
+          events: list of events, e.g. CloseEvent.
+        """
+        self._accept()
+        self.published.inc(len(events))
+        if not self.subscribers:
+            self.subscriber_count.set(0)
+            return
+        data = ''.join(self.encode(e) for e in events)
+        for sock, sub in self.subscribers.items():
+            if len(sub.pending) + len(data) > self.max_pending:
+                sub.dropped += len(events)
+                self.dropped.inc(len(events))
+            else:
+                sub.pending += data
+            try:
+                sent = sock.send(sub.pending) if sub.pending else 0
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._drop(sock)
+                    continue
+                sent = 0
+            sub.pending = sub.pending[sent:]
+        self.subscriber_count.set(len(self.subscribers))
+
+    def close(self):
+        for sock in self.subscribers.keys():
+            self._drop(sock)
+        self.subscriber_count.set(0)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Subscriber(object):
+    """Receives events from a Publisher."""
+
+    def __init__(self, sock, decode=decode):
+        self.sock = sock
+        self.decode = decode
+        self.partial = ''
+
+    def receive(self, timeout):
+        """Waits up to timeout seconds for events.
+
+        Returns:
+          list of decoded events, empty on timeout, or None if the publisher
+          has gone away.
+        """
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.error:
+            data = ''
+        if not data:
+            self.close()
+            return None
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return [self.decode(line) for line in lines]
+
+    def close(self):
+        self.sock.close()
+
+
+def subscribe(path, decode=decode):
+    """Connects to the publisher at path.
+
+    Args:
+      path: str, the Unix socket path.
+      decode: callable, returns the event encoded in a line.
+    Returns:
+      a Subscriber, or None if there is no publisher.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return Subscriber(sock, decode)
@@ -0,0 +1,73 @@
+"""Tests for closebus."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import closebus
+
+
+def event(cid, remote='5.6.7.8'):
+  return closebus.CloseEvent(1400000000.25, cid, '1.2.3.4', 80, remote, 1234,
+                             1)
+
+
+class TestCloseBus(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'closes.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testEncoding(self):
+    e = event(7)
+    self.assertEqual(closebus.decode(closebus.encode(e).rstrip('\n')), e)
+    snap = {'LocalAddress': '1.2.3.4', 'LocalPort': 80,
+            'RemAddress': '5.6.7.8', 'RemPort': 1234, 'LocalAddressType': 1}
+    self.assertEqual(closebus.eventFromSnapshot(7, 1400000000.25, snap), e)
+
+  def testNoPublisher(self):
+    self.assertEqual(closebus.subscribe(self.path), None)
+
+  def testPublishSubscribe(self):
+    publisher = closebus.Publisher(self.path)
+    subscriber = closebus.subscribe(self.path)
+    publisher.publish([event(1), event(2)])
+    publisher.publish([event(3)])
+    received = []
+    while len(received) < 3:
+      received += subscriber.receive(1)
+    self.assertEqual([e.cid for e in received], [1, 2, 3])
+    self.assertEqual(subscriber.receive(0), [])
+    publisher.close()
+    self.assertEqual(subscriber.receive(1), None)
+    self.assertFalse(os.path.exists(self.path))
+
+  def testSlowSubscriberDropsEvents(self):
+    publisher = closebus.Publisher(self.path, max_pending=100)
+    subscriber = closebus.subscribe(self.path)
+    # Fill the socket buffers, then the pending buffer.
+    events = [event(i) for i in range(1000)]
+    for _ in range(1000):
+      publisher.publish(events)
+    sub = publisher.subscribers.values()[0]
+    self.assertTrue(len(sub.pending) <= 100)
+    self.assertTrue(sub.dropped > 0)
+    subscriber.close()
+    publisher.publish([event(1)])
+    publisher.publish([event(1)])
+    self.assertEqual(publisher.subscribers, {})
+    publisher.close()
+
+  def testStaleSocketIsReplaced(self):
+    closebus.Publisher(self.path).sock.close()
+    publisher = closebus.Publisher(self.path)
+    self.assertNotEqual(closebus.subscribe(self.path), None)
+    publisher.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
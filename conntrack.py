@@ -0,0 +1,117 @@
+"""
+conntrack.py: Incremental tracking of closed Web100 connections.
+
+The Web100 agent reports every connection on the host, including connections
+that have closed but have not yet been reaped by the kernel.  The daemons poll
+the agent periodically and must report each closed connection exactly once.
+ConnectionTracker remembers the closed connections seen on the previous poll
+in a hashed map, so that each poll costs O(connections) rather than
+O(connections * closed).
+"""
+
+from collections import namedtuple
+
+# Web100 State value for a closed connection.
+WEB100_STATE_CLOSED = 1
+
+# A connection generation.  Web100 connection ids are reused by the kernel, so
+# the cid alone does not identify a connection.  The 4-tuple plus the start
+# time does.
+Generation = namedtuple('Generation', ['cid', 'LocalAddress', 'LocalPort',
+                                       'RemAddress', 'RemPort',
+                                       'StartTimeSec'])
+
+# A newly closed connection, as returned by ConnectionTracker.poll().
+ClosedConnection = namedtuple('ClosedConnection', ['connection', 'generation'])
+
+# Per-poll accounting, as saved in ConnectionTracker.last_poll.
+#   scanned: connections returned by the agent.
+#   closed: connections in the closed state.
+#   emitted: closed connections not reported on a previous poll.
+#   reused: emitted connections whose cid was seen closed on the previous poll
+#           with a different generation.
+#   errors: connections that could not be read (e.g. reaped during the scan).
+#   vanished: connections that were open on the previous poll, and are gone
+#             without having been seen closed.  These are closes that were
+#             missed because the kernel reaped them between polls.
+PollStats = namedtuple('PollStats', ['scanned', 'closed', 'emitted', 'reused',
+                                     'errors', 'vanished'])
+
+
+class ConnectionTracker(object):
+    """Reports each closed connection generation exactly once.
+
+    Closed connections stay visible to the agent until the kernel reaps them,
+    usually for several polls.  The tracker keeps the generations that were
+    closed on the previous poll, keyed by cid, and only emits a connection
+    when its generation is not in that map.  A closed connection whose cid
+    and StartTimeSec match the map is taken to be the same generation, so
+    only State and StartTimeSec are read from it.
+    """
+
+    def __init__(self, error_callback=None):
+        """
+        Args:
+          error_callback: callable, invoked with the exception raised when a
+              connection cannot be read.  The connection is skipped.
+        """
+        self.error_callback = error_callback
+        # Map from cid to Generation for connections closed on the last poll.
+        self.closed = {}
+        # The cids of the connections that were open on the last poll.
+        self.open = set()
+        self.last_poll = PollStats(0, 0, 0, 0, 0, 0)
+
+    def generation(self, c, start=None):
+        """Read the Generation of connection c.
+
+        Args:
+          start: the StartTimeSec of c, if it was already read.
+        """
+        if start is None:
+            start = c.read('StartTimeSec')
+        return Generation(c.cid, c.read('LocalAddress'), c.read('LocalPort'),
+                          c.read('RemAddress'), c.read('RemPort'), start)
+
+    def poll(self, connections):
+        """Scan the connections, and return those that are newly closed.
+
+        Args:
+          connections: iterable of Web100 connection objects.
+        Returns:
+          list of ClosedConnection, in scan order.
+        """
+        previous = self.closed
+        closed = {}
+        still_open = set()
+        seen = set()
+        emitted = []
+        scanned = reused = errors = 0
+        for c in connections:
+            scanned += 1
+            seen.add(c.cid)
+            try:
+                if c.read('State') != WEB100_STATE_CLOSED:
+                    still_open.add(c.cid)
+                    continue
+                start = c.read('StartTimeSec')
+                old = previous.get(c.cid)
+                if old is not None and old.StartTimeSec == start:
+                    closed[c.cid] = old
+                    continue
+                gen = self.generation(c, start)
+            except Exception as e:
+                errors += 1
+                if self.error_callback:
+                    self.error_callback(e)
+                continue
+            closed[c.cid] = gen
+            if old is not None:
+                reused += 1
+            emitted.append(ClosedConnection(c, gen))
+        vanished = len(self.open - seen)
+        self.closed = closed
+        self.open = still_open
+        self.last_poll = PollStats(scanned, len(closed), len(emitted), reused,
+                                   errors, vanished)
+        return emitted
@@ -0,0 +1,103 @@
+"""Tests for conntrack."""
+
+import unittest
+
+import conntrack
+
+
+class FakeConnection(object):
+  '''Substitute for a Web100 connection that supports read().'''
+
+  def __init__(self, cid, state, start=100, local='1.2.3.4', remote='5.6.7.8'):
+    self.cid = cid
+    self.values = {'State': state, 'LocalAddress': local, 'LocalPort': 80,
+                   'RemAddress': remote, 'RemPort': 1234,
+                   'StartTimeSec': start}
+    self.reads = 0
+
+  def read(self, name):
+    self.reads += 1
+    if name not in self.values:
+      raise KeyError(name)
+    return self.values[name]
+
+
+class TestConnectionTracker(unittest.TestCase):
+
+  def testEmitsEachCloseOnce(self):
+    tracker = conntrack.ConnectionTracker()
+    conns = [FakeConnection(1, 5), FakeConnection(2, 1), FakeConnection(3, 1)]
+    closed = tracker.poll(conns)
+    self.assertEqual([c.connection.cid for c in closed], [2, 3])
+    self.assertEqual(closed[0].generation.RemAddress, '5.6.7.8')
+    self.assertEqual(tracker.last_poll, conntrack.PollStats(3, 2, 2, 0, 0, 0))
+
+    # Nothing new on the next poll, until cid 1 closes.
+    self.assertEqual(tracker.poll(conns), [])
+    self.assertEqual(tracker.last_poll, conntrack.PollStats(3, 2, 0, 0, 0, 0))
+    conns[0].values['State'] = 1
+    self.assertEqual([c.connection.cid for c in tracker.poll(conns)], [1])
+
+  def testOpenConnectionsOnlyReadState(self):
+    tracker = conntrack.ConnectionTracker()
+    c = FakeConnection(1, 5)
+    tracker.poll([c])
+    self.assertEqual(c.reads, 1)
+
+  def testEmittedConnectionsOnlyReadStateAndStart(self):
+    tracker = conntrack.ConnectionTracker()
+    conns = [FakeConnection(cid, 5) for cid in range(9)]
+    conns += [FakeConnection(cid, 1) for cid in range(9, 10)]
+    tracker.poll(conns)
+    self.assertEqual(conns[-1].reads, 6)
+    for c in conns:
+      c.reads = 0
+    self.assertEqual(tracker.poll(conns), [])
+    self.assertEqual(sum(c.reads for c in conns), 9 + 2)
+
+  def testReapedConnectionsAreForgotten(self):
+    tracker = conntrack.ConnectionTracker()
+    tracker.poll([FakeConnection(1, 1)])
+    tracker.poll([])
+    self.assertEqual(tracker.closed, {})
+    # A reaped and reused cid is reported again.
+    self.assertEqual(len(tracker.poll([FakeConnection(1, 1)])), 1)
+    self.assertEqual(tracker.last_poll.reused, 0)
+
+  def testCidReuse(self):
+    tracker = conntrack.ConnectionTracker()
+    tracker.poll([FakeConnection(7, 1, start=100)])
+    closed = tracker.poll([FakeConnection(7, 1, start=200)])
+    self.assertEqual(len(closed), 1)
+    self.assertEqual(closed[0].generation.StartTimeSec, 200)
+    self.assertEqual(tracker.last_poll.reused, 1)
+
+    closed = tracker.poll([FakeConnection(7, 1, start=300, remote='9.9.9.9')])
+    self.assertEqual(len(closed), 1)
+    self.assertEqual(closed[0].generation.RemAddress, '9.9.9.9')
+    self.assertEqual(tracker.last_poll.reused, 1)
+
+  def testVanished(self):
+    tracker = conntrack.ConnectionTracker()
+    tracker.poll([FakeConnection(1, 5), FakeConnection(2, 5),
+                  FakeConnection(3, 5)])
+    # cid 1 was seen closed, cid 2 closed and was reaped between polls.
+    tracker.poll([FakeConnection(1, 1), FakeConnection(3, 5)])
+    self.assertEqual(tracker.last_poll.vanished, 1)
+    tracker.poll([])
+    self.assertEqual(tracker.last_poll.vanished, 1)
+
+  def testReadErrors(self):
+    errors = []
+    tracker = conntrack.ConnectionTracker(error_callback=errors.append)
+    broken = FakeConnection(1, 1)
+    del broken.values['StartTimeSec']
+    closed = tracker.poll([broken, FakeConnection(2, 1)])
+    self.assertEqual([c.connection.cid for c in closed], [2])
+    self.assertEqual(tracker.last_poll.errors, 1)
+    self.assertEqual(len(errors), 1)
+    self.assertTrue(isinstance(errors[0], KeyError))
+
+
+if __name__ == '__main__':
+  unittest.main()
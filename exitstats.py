@@ -6,23 +6,43 @@ stats.
 """
 
 import BaseHTTPServer
+import fnmatch
+import gzip
+import json
 import os
+import Queue
 import re
+import signal
 import socket
 import SocketServer
 import sys
 import threading
 import time
+import zlib
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from operator import itemgetter
 
 import prometheus_client as prom
 
+import closebus
+import conntrack
+import pipeline
+import pollsched
+import sketch
+import sockdiag
+import web100bin
+
 try:
   from Web100 import *
 except ImportError:
   print 'Error importing web100'
 
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 PROMETHEUS_SERVER_PORT = 9090
 connection_count = prom.Counter('sidestream_connection_count',
                                 'Count of connections logged',
@@ -36,6 +56,88 @@ receive_bytes = prom.Counter('sidestream_receive_bytes_total',
 exception_count = prom.Counter('sidestream_exception_count',
                                'Count of exceptions.',
                                ['type'])
+poll_scanned = prom.Gauge('sidestream_poll_scanned_connections',
+                          'Connections scanned by the most recent poll')
+poll_emitted = prom.Gauge('sidestream_poll_emitted_connections',
+                          'Newly closed connections found by the most recent poll')
+reused_cid_count = prom.Counter('sidestream_reused_cid_count',
+                                'Count of closed connections reusing a cid')
+poll_duration = prom.Histogram(
+    'sidestream_poll_duration_seconds',
+    'Time to scan all connections and queue the newly closed ones',
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+poll_read_duration = prom.Histogram(
+    'sidestream_poll_read_duration_seconds',
+    'Time spent prefiltering and reading the newly closed connections of a '
+    'poll, in full, projected or counted reads',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+poll_scanned_histogram = prom.Histogram(
+    'sidestream_poll_scanned_connections_per_poll',
+    'Connections scanned per poll',
+    buckets=(100, 1000, 5000, 10000, 25000, 50000, 100000, 250000))
+poll_lateness = prom.Histogram(
+    'sidestream_poll_lateness_seconds',
+    'How late each poll started, after the interval chosen by the previous '
+    'poll',
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+last_poll_lateness = prom.Gauge('sidestream_last_poll_lateness_seconds',
+                                'How late the most recent poll started')
+# Observed per record and per flush, so these are sketch.HistogramFamily
+# children rather than prometheus_client Histograms, which are too slow for
+# that.  They are unlocked, so they are only observed under the writer's lock,
+# including when the HourRoller or stopWriters close logs.
+record_duration = sketch.HistogramFamily(
+    'sidestream_record_duration_seconds',
+    'Time to count and format a snapshot, and hand it to its log file',
+    [], (.00001, .00005, .0001, .00025, .0005, .001, .005, .01, .1)).labels()
+flush_duration = sketch.HistogramFamily(
+    'sidestream_log_flush_duration_seconds',
+    'Time to write and flush the pending records of a log file',
+    [], (.0001, .0005, .001, .005, .01, .05, .1, .5, 1.0, 5.0)).labels()
+log_opens = prom.Counter('sidestream_log_open_count',
+                         'Count of log files opened, including reopens')
+log_evictions = prom.Counter('sidestream_log_eviction_count',
+                             'Count of log files closed to stay under the cap')
+log_reopens = prom.Counter('sidestream_log_reopen_count',
+                           'Count of evicted log files opened again')
+classification_hits = prom.Counter(
+    'sidestream_classification_cache_hits',
+    'Count of address classifications found in the cache')
+classification_misses = prom.Counter(
+    'sidestream_classification_cache_misses',
+    'Count of address classifications not found in the cache')
+prefilter_count = prom.Counter(
+    'sidestream_prefilter_connection_count',
+    'Count of closed connections by how much of them was read',
+    ['stage'])
+sample_rate = prom.Gauge(
+    'sidestream_sample_rate',
+    'One in this many closed connections is logged, while shedding load')
+shed_count = prom.Counter(
+    'sidestream_shed_record_count',
+    'Count of records counted but not logged, while shedding load')
+
+
+# Distributions of the logged connections, per type and index, in constant
+# memory.  See sketch.py.
+min_rtt = sketch.HistogramFamily(
+    'sidestream_min_rtt_milliseconds', 'MinRTT of logged connections',
+    ['type', 'index'], sketch.logBuckets(0.1, 10000))
+smoothed_rtt = sketch.HistogramFamily(
+    'sidestream_smoothed_rtt_milliseconds', 'SmoothedRTT of logged connections',
+    ['type', 'index'], sketch.logBuckets(0.1, 10000))
+throughput = sketch.HistogramFamily(
+    'sidestream_throughput_bits_per_second',
+    'DataBytesOut over Duration of logged connections',
+    ['type', 'index'], sketch.logBuckets(1e3, 1e10))
+retransmit_ratio = sketch.HistogramFamily(
+    'sidestream_retransmit_ratio',
+    'PktsRetrans over DataPktsOut of logged connections',
+    ['type', 'index'], sketch.logBuckets(1e-4, 1))
+congestion_signal_rate = sketch.HistogramFamily(
+    'sidestream_congestion_signals_per_second',
+    'CongestionSignals over Duration of logged connections',
+    ['type', 'index'], sketch.logBuckets(1e-3, 1e3))
 
 
 # NOTE: In practice, we are observing M-Lab servers holding ESTABLISHED TCP
@@ -102,12 +204,558 @@ def octetToIndex(octet):
     return (index-1)
 
 
+def envFloat(name, default):
+    """Returns the environment variable name as a float, or default."""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return float(value)
+
+
+def envList(name):
+    """Returns the comma separated environment variable name as a list, or
+       None if it is not set.
+    """
+    value = os.environ.get(name)
+    if not value:
+        return None
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+# File name suffix for each supported log compression.
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class ZstdFile:
+    """Appends a zstd frame to a file.
+
+    Each flush ends a block, so everything written so far can be decompressed
+    by a reader, and close ends the frame.  A file may hold several frames,
+    e.g. if it is reopened after a restart.
+    """
+    def __init__(self, name):
+        self.raw = open(name, "ab")
+        self.stream = zstandard.ZstdCompressor().stream_writer(self.raw)
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush(zstandard.FLUSH_BLOCK)
+        self.raw.flush()
+
+    def close(self):
+        self.stream.flush(zstandard.FLUSH_FRAME)
+        self.raw.close()
+
+
+def openCompressed(name, compression=None):
+    """Opens name for appending, compressing the stream as requested.
+
+    Args:
+      name: str, file name, including the compression suffix.
+      compression: None, 'gzip' or 'zstd'.
+    Returns:
+      file like object supporting write, flush and close.
+    """
+    if compression is None:
+        return open(name, "a")
+    elif compression == 'gzip':
+        # Appending starts a new gzip member, which gunzip handles.
+        return gzip.open(name, "ab")
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard module')
+        return ZstdFile(name)
+    raise ValueError('unknown compression: %s' % compression)
+
+
+class BatchedLogFile:
+    """Collects the records for one log file and writes them in batches.
+
+    Records are held in memory until max_bytes are pending, or until the
+    oldest pending record is max_delay seconds old.  A max_delay of zero writes
+    and flushes every record immediately.
+    """
+    def __init__(self, f, max_bytes=0, max_delay=0):
+        self.f = f
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        now = time.time()
+        if self.deadline is None:
+            self.deadline = now + self.max_delay
+        if self.pending_bytes >= self.max_bytes or now >= self.deadline:
+            self.flush()
+
+    def flushIfDue(self, now):
+        """Flush if the oldest pending record has reached its deadline."""
+        if self.deadline is not None and now >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        if self.pending:
+            self.f.write("".join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+        self.deadline = None
+        self.f.flush()
+        flush_duration.observe(time.time() - start)
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+# The index of a local address that ipToIndex could not parse.
+PARSE_ERROR_INDEX = 'parse-error'
+
+
+class ClassificationCache:
+    """Bounded LRU caches of address classifications.
+
+    Local addresses map to their experiment index, and remote addresses to
+    their connection type.  get returns the Classification of a connection:
+    the index, the connection type, the connection_count, transmit_bytes and
+    receive_bytes children for those labels, and the children of the
+    distribution histograms.  Classifications are kept per label pair, of
+    which there are few.  A local address that failed to parse is counted
+    as an exception on every lookup, as if it were classified again.  A cache
+    is not locked, so the poller's Prefilter has its own.
+    """
+    Classification = namedtuple('Classification',
+                                ['index', 'conn_type', 'counters',
+                                 'distributions'])
+
+    def __init__(self, classify_local, classify_remote, capacity=65536):
+        """
+        Args:
+          classify_local: callable, returns the index for a local address.
+          classify_remote: callable, returns the type for a remote address.
+          capacity: int, maximum number of cached addresses of each kind.
+        """
+        self.classify_local = classify_local
+        self.classify_remote = classify_remote
+        self.capacity = capacity
+        self.indexes = OrderedDict()
+        self.types = OrderedDict()
+        self.classifications = {}
+
+    def _lookup(self, cache, classify, address):
+        try:
+            value = cache.pop(address)
+            classification_hits.inc()
+        except KeyError:
+            classification_misses.inc()
+            value = classify(address)
+            if len(cache) >= self.capacity:
+                cache.popitem(last=False)
+        # (Re)insert as the most recently used entry.
+        cache[address] = value
+        return value
+
+    def index(self, local):
+        """Returns the experiment index of a local address."""
+        cached = local in self.indexes
+        index = self._lookup(self.indexes, self.classify_local, local)
+        if cached and index == PARSE_ERROR_INDEX:
+            exception_count.labels('ip address parse error').inc()
+        return index
+
+    def connectionType(self, remote):
+        """Returns the connection type of a remote address."""
+        return self._lookup(self.types, self.classify_remote, remote)
+
+    def get(self, local, remote):
+        labels = (self.connectionType(remote), self.index(local))
+        value = self.classifications.get(labels)
+        if value is None:
+            conn_type, index = labels
+            value = self.classifications[labels] = self.Classification(
+                index, conn_type,
+                (connection_count.labels(conn_type, index),
+                 transmit_bytes.labels(conn_type, index),
+                 receive_bytes.labels(conn_type, index)),
+                (min_rtt.labels(conn_type, index),
+                 smoothed_rtt.labels(conn_type, index),
+                 throughput.labels(conn_type, index),
+                 retransmit_ratio.labels(conn_type, index),
+                 congestion_signal_rate.labels(conn_type, index)))
+        return value
+
+
+# Variables observeDistributions uses, besides DataBytesOut.
+DISTRIBUTION_VARS = ("MinRTT", "SmoothedRTT", "Duration", "DataPktsOut",
+                     "PktsRetrans", "CongestionSignals")
+
+
+def observeDistributions(distributions, snap):
+    """Adds a snapshot to the distribution histograms of its classification.
+
+    Variables missing from the snapshot, and rates of connections without a
+    Duration or without data packets, are skipped.
+    """
+    rtt, srtt, rate, retransmits, congestion = distributions
+    if "MinRTT" in snap:
+        rtt.observe(snap["MinRTT"])
+    if "SmoothedRTT" in snap:
+        srtt.observe(snap["SmoothedRTT"])
+    seconds = snap.get("Duration", 0) / 1e6
+    if seconds > 0:
+        rate.observe(snap["DataBytesOut"] * 8 / seconds)
+        if "CongestionSignals" in snap:
+            congestion.observe(snap["CongestionSignals"] / seconds)
+    packets = snap.get("DataPktsOut", 0)
+    if packets > 0 and "PktsRetrans" in snap:
+        retransmits.observe(snap["PktsRetrans"] / float(packets))
+
+
+class TextFormat:
+    """Formats Web100 snapshots as the K: and C: lines of .web100 files.
+
+    setkey compiles an itemgetter over the active variables, so formatting a
+    record is a single join.  The PollTime string is cached per second.
+    """
+    suffix = '.web100'
+
+    def __init__(self):
+        self.active_vars = None
+        self.poll_second = None
+        self.poll_string = None
+
+    def setkey(self, active_vars, snap):
+        self.active_vars = active_vars
+        if not active_vars:
+            self.values = lambda snap: ()
+        elif len(active_vars) == 1:
+            getter = itemgetter(active_vars[0])
+            self.values = lambda snap: (getter(snap),)
+        else:
+            self.values = itemgetter(*active_vars)
+
+    def header(self):
+        return "K: cid PollTime" + "".join(" "+k for k in self.active_vars) + "\n"
+
+    def sampling(self, poll_time, rate):
+        return "S: %s %d\n" % (self.pollTime(poll_time), rate)
+
+    def pollTime(self, poll_time):
+        second = int(poll_time)
+        if second != self.poll_second:
+            self.poll_string = time.strftime("%Y-%m-%d-%H:%M:%SZ",
+                                             time.gmtime(poll_time))
+            self.poll_second = second
+        return self.poll_string
+
+    def record(self, cid, poll_time, snap):
+        return " ".join(["C: %d" % cid, self.pollTime(poll_time)] +
+                        map(str, self.values(snap))) + "\n"
+
+
+# Log file formats, by name.
+FORMATS = {'text': TextFormat, 'binary': web100bin.BinaryFormat}
+
+# Connection sources, by name.  A source has an all_connections() method
+# returning objects with a cid, read(name) and readall(), like Web100Agent.
+SOURCES = {'web100': lambda: Web100Agent(),
+           'sockdiag': sockdiag.SockDiagAgent}
+
+# Variables read from every closed connection, logged or not: the addresses
+# for classification and close events, the byte counts for the counters, and
+# the inputs of the distribution histograms.
+REQUIRED_VARS = (
+    "LocalAddress", "LocalPort", "RemAddress", "RemPort", "LocalAddressType",
+    "DataBytesOut", "DataBytesIn", "MinRTT", "SmoothedRTT", "Duration",
+    "DataPktsOut", "PktsRetrans", "CongestionSignals")
+
+# Named projections, as (include, exclude) lists of fnmatch patterns.  An
+# include list of None selects every variable.
+PROFILES = {
+    'full': (None, []),
+    'standard': (None, ['X_dbg*', 'WAD_*']),
+    'minimal': ([
+        "LocalAddress", "LocalPort", "RemAddress", "RemPort", "State",
+        "StartTimeSec", "StartTimeUsec", "Duration", "PktsOut", "DataPktsOut",
+        "DataBytesOut", "PktsIn", "DataPktsIn", "DataBytesIn", "PktsRetrans",
+        "BytesRetrans", "CongestionSignals", "SndLimTimeSender",
+        "SndLimTimeCwnd", "SndLimTimeRwin", "MinRTT", "SmoothedRTT", "MaxRTT",
+        "CurMSS", "LocalAddressType"], []),
+}
+
+
+class Projection(object):
+    """Selects the Web100 variables to be logged."""
+
+    def __init__(self, include=None, exclude=()):
+        """
+        Args:
+          include: list of fnmatch patterns of the variables to log, or None
+              for all of them.
+          exclude: list of fnmatch patterns of variables not to log, even if
+              included.
+        """
+        self.include = include
+        self.exclude = list(exclude)
+
+    @classmethod
+    def fromProfile(cls, profile, include=None, exclude=()):
+        """Returns the named profile, with include replacing its include
+           list if given, and exclude added to its exclude list.
+        """
+        if profile not in PROFILES:
+            raise ValueError('unknown projection profile: %s' % profile)
+        profile_include, profile_exclude = PROFILES[profile]
+        if include is None:
+            include = profile_include
+        return cls(include, list(profile_exclude) + list(exclude))
+
+    def selects(self, name):
+        if self.include is not None and not any(
+                fnmatch.fnmatchcase(name, p) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(name, p) for p in self.exclude)
+
+    def readVars(self):
+        """Returns the variables to read from each connection, or None if
+           they cannot be known before reading one.
+        """
+        if self.include is None or any(
+                c in p for p in self.include for c in '*?['):
+            return None
+        names = [n for n in self.include if self.selects(n)]
+        return names + [n for n in REQUIRED_VARS if n not in names]
+
+
+# Variables read from a closed connection that is counted but not logged, in
+# addition to the Generation that the ConnectionTracker read: enough for the
+# counters and the distributions.
+COUNTED_VARS = (("DataBytesOut", "DataBytesIn", "LocalAddressType") +
+                DISTRIBUTION_VARS)
+
+
+class Prefilter(object):
+    """Decides how much of a closed connection to read, from its Generation.
+
+    Connections with an ignored port or remote address prefix are skipped:
+    neither read, counted nor logged, though their close events are still
+    published.  Loopback and PLC connections are counted, but never logged,
+    so only COUNTED_VARS are read from them.  Only the others are read in
+    full.
+    """
+    SKIP = 'skipped'
+    COUNT = 'counted'
+    LOG = 'logged'
+
+    def __init__(self, classifications, ignore_ports=(), ignore_prefixes=()):
+        """
+        Args:
+          classifications: ClassificationCache, classifies the connections.
+              It is used from the poller thread, so it should not be that of
+              the Web100StatsWriter.
+          ignore_ports: list of int, local or remote ports to skip.
+          ignore_prefixes: list of str, remote address prefixes to skip,
+              e.g. '10.1.' or '2001:db8:'.
+        """
+        self.classifications = classifications
+        self.ignore_ports = frozenset(ignore_ports)
+        self.ignore_prefixes = tuple(ignore_prefixes)
+        self.counters = dict((stage, prefilter_count.labels(stage))
+                             for stage in (self.SKIP, self.COUNT, self.LOG))
+
+    def stage(self, generation):
+        if (generation.LocalPort in self.ignore_ports or
+                generation.RemPort in self.ignore_ports or
+                (self.ignore_prefixes and
+                 generation.RemAddress.startswith(self.ignore_prefixes))):
+            stage = self.SKIP
+        elif self.classifications.connectionType(
+                generation.RemAddress).startswith('ipv'):
+            stage = self.LOG
+        else:
+            stage = self.COUNT
+        self.counters[stage].inc()
+        return stage
+
+
+class LoadShedder(object):
+    """Chooses the sampling rate of the logged records, after each poll.
+
+    The rate rises when the closes per second exceed max_records_per_second,
+    to the power of two that brings them within it.  It also doubles on every
+    poll that finds more than max_depth snapshots queued, or that starts more
+    than max_lateness seconds late, and halves again on every poll that does
+    not.  A zero threshold is never exceeded.  Rates are powers of two, so
+    the connections sampled at a rate are also sampled at every lower one.
+    """
+
+    def __init__(self, max_depth=0, max_lateness=0, max_records_per_second=0,
+                 max_rate=64):
+        self.max_depth = max_depth
+        self.max_lateness = max_lateness
+        self.max_records_per_second = max_records_per_second
+        self.max_rate = max_rate
+        self.pressure = 1
+        self.rate = 1
+        self.last_update = None
+
+    def update(self, now, records, depth, lateness):
+        """Returns the sampling rate, after a poll.
+
+        Args:
+          now: float, when the poll finished.
+          records: int, the number of closed connections it found.
+          depth: int, the number of snapshots queued for the writers.
+          lateness: float, how late the poll started, in seconds.
+        """
+        needed = 1
+        if self.max_records_per_second and self.last_update is not None:
+            elapsed = max(now - self.last_update, 1e-3)
+            while (records / elapsed > needed * self.max_records_per_second
+                   and needed < self.max_rate):
+                needed *= 2
+        self.last_update = now
+        if ((self.max_depth and depth > self.max_depth) or
+                (self.max_lateness and lateness > self.max_lateness)):
+            self.pressure = min(self.pressure * 2, self.max_rate)
+        else:
+            self.pressure = max(self.pressure // 2, 1)
+        self.rate = max(needed, self.pressure)
+        sample_rate.set(self.rate)
+        return self.rate
+
+
+def sampled(snap, rate):
+    """Whether the connection is in the deterministic 1 in rate sample."""
+    if rate == 1:
+        return True
+    key = "%s %s %s %s" % (snap["LocalAddress"], snap.get("LocalPort"),
+                           snap["RemAddress"], snap.get("RemPort"))
+    return (zlib.crc32(key) & 0xffffffff) % rate == 0
+
+
+def skippedSnapshot(generation):
+    """Returns the snapshot of a skipped connection, for its close event.
+
+    Nothing is read from the connection, so its LocalAddressType is inferred
+    from the local address.
+    """
+    if ':' in generation.LocalAddress:
+        address_type = sockdiag.WEB100_IPV6
+    else:
+        address_type = sockdiag.WEB100_IPV4
+    return {"LocalAddress": generation.LocalAddress,
+            "LocalPort": generation.LocalPort,
+            "RemAddress": generation.RemAddress,
+            "RemPort": generation.RemPort,
+            "LocalAddressType": address_type}
+
+
+def countedSnapshot(c, generation):
+    """Returns the snapshot of a connection that is counted, not logged.
+
+    Only COUNTED_VARS are read, as far as the connection has them.
+    """
+    snap = readSnapshot(c, COUNTED_VARS)
+    snap.update(LocalAddress=generation.LocalAddress,
+                LocalPort=generation.LocalPort,
+                RemAddress=generation.RemAddress,
+                RemPort=generation.RemPort)
+    return snap
+
+
+# Projections of at most this many variables are read from Web100 one
+# variable at a time.  Each read(name) reads one variable from its group file
+# in /proc, while readall() reads every group file and converts all of the
+# 120 or so variables.  REQUIRED_VARS alone is 13.
+MAX_NAMED_READS = 16
+
+
+def readSnapshot(c, read_vars=None):
+    """Reads the variables read_vars of connection c, or all of them.
+
+    Sources whose connections have readvars(names) read only those
+    variables.  For others, such as Web100, up to MAX_NAMED_READS variables
+    are read by name.  Larger projections, or ones naming a variable the
+    connection does not have, read everything and drop the rest, so that it
+    does not travel through the queue.
+    """
+    if read_vars is None:
+        return c.readall()
+    readvars = getattr(c, 'readvars', None)
+    if readvars is not None:
+        return readvars(read_vars)
+    if len(read_vars) <= MAX_NAMED_READS:
+        try:
+            return dict((k, c.read(k)) for k in read_vars)
+        except Exception:
+            # readall tells a missing variable from a connection gone away.
+            pass
+    snap = c.readall()
+    return dict((k, snap[k]) for k in read_vars if k in snap)
+
+
 class Web100StatsWriter:
-    ''' TODO - add documentation.
+    ''' Writes the Web100 snapshots of closed connections to hourly log files.
+
+    By default every record is written and flushed as it is logged.  Setting
+    flush_seconds batches records per log file: they are written once
+    flush_bytes are pending or the oldest has waited flush_seconds, and always
+    when the logs are closed at the end of each hour.
+
+    If compression is 'gzip' or 'zstd', the log files are written as
+    compressed streams, with a .gz or .zst suffix, and finalized when closed.
+    Batching is recommended with compression, since every flush of a
+    compressed stream costs some compression ratio.
+
+    log_format selects the text .web100 format, or the binary .web100b format
+    described in web100bin.
+
+    At most max_open_logs files are kept open, if it is non-zero.  The least
+    recently used file is closed to make room for another, and reopened for
+    appending, without a new header, if it is needed again within the hour.
+
+    While sample_rate is above one, all connections are counted, but only a
+    deterministic 1 in sample_rate of them are logged.  Each log notes the
+    rate in a sampling record before the first record logged at that rate.
     '''
-    def __init__(self, server_name):
+    def __init__(self, server_name, flush_bytes=0, flush_seconds=0,
+                 compression=None, log_format='text', max_open_logs=0,
+                 record_stream=None, projection=None):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError('unknown compression: %s' % compression)
+        if log_format not in FORMATS:
+            raise ValueError('unknown log format: %s' % log_format)
         self.server = server_name
+        # Serializes the writer threads, and the HourRoller's use of the
+        # writer.
+        self.lock = threading.Lock()
         self.active_vars = None
+        self.format = FORMATS[log_format]()
+        self.projection = projection or Projection()
+        self.max_open_logs = max_open_logs
+        # Map from log file name to the key_version of its last header.
+        self.headers = {}
+        self.key_version = 0
+        self.classifications = ClassificationCache(self.ipToIndex,
+                                                   self.connectionType)
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.compression = compression
+        # closebus.Publisher of the logged records, and the records logged
+        # since they were last published.
+        self.record_stream = record_stream
+        self.streamed = []
+        # Set by the poller from a LoadShedder.  Map from log file name to the
+        # rate of its last sampling record.
+        self.sample_rate = 1
+        self.sample_rates = {}
         self.closeLogs()
 
     stdvars=[
@@ -139,14 +787,23 @@ class Web100StatsWriter:
     ]
 
     active_vars = None
+    # The keys of the snapshot passed to the last setkey.
+    snap_keys = None
     server = ""
     one_hour = (60*60)
     LogInfo = namedtuple('LogInfo', ['name', 'f'])
 
-    # Map from IP address to LogInfo
+    # Map from IP address to LogInfo, in least recently used order.
     # May include key=None if we are not using per IP logs.
-    logs = {}
+    logs = OrderedDict()
     log_time = -1
+    # (hour, date directory, time stamp) strings of the last logName call.
+    log_name_cache = (None, None, None)
+    # Log files opened ahead of the next hour by an HourRoller.
+    Prepared = namedtuple('Prepared', ['hour', 'logs', 'headers'])
+    prepared = None
+    # Queue of the previous hour's logs, for an HourRoller to close.
+    retired = None
 
     def setkey(self, snap):
         """
@@ -157,11 +814,14 @@ class Web100StatsWriter:
 
         Keys in stdvars will be logged in consistent order.  Any new keys will
         be logged in the order they appear in the snapshot, after all the standard
-        keys.
+        keys.  Keys that the projection does not select are not logged.
 
         The keys will usually be same from data set to data set, but this
-        is not guaranteed.
+        is not guaranteed.  logSnapshot calls setkey again whenever the keys
+        of a snapshot differ from those of the last one, which writes a new
+        header to each open log.
         """
+        self.snap_keys = frozenset(snap)
         self.active_vars=[]
         s=snap.copy()
         for k in self.stdvars:
@@ -170,12 +830,17 @@ class Web100StatsWriter:
                 del s[k]
         for k in s:
             self.active_vars.append(k)
+        self.active_vars = [k for k in self.active_vars
+                            if self.projection.selects(k)]
+        self.format.setkey(self.active_vars, snap)
+        self.key_version += 1
+        # Records written from now on follow the new key.
+        for v in self.logs.values():
+            self.logHeader(v.f)
+            self.headers[v.name] = self.key_version
 
     def logHeader(self, f):
-        f.write("K: cid PollTime")
-        for k in self.active_vars:
-          f.write(" "+k)
-        f.write("\n")
+        f.write(self.format.header())
 
     def mkdirs(self, name):
         """ Fake mkdir -p """
@@ -193,10 +858,45 @@ class Web100StatsWriter:
 
     def closeLogs(self):
         ''' Close all log files, e.g. at the top of each hour.
+
+        This includes logs prepared for the next hour, and any retired logs
+        that an HourRoller has not closed yet.
         '''
         for k, v in self.logs.items():
             if v.f: v.f.close()
         self.logs.clear()
+        self.headers.clear()
+        self.sample_rates.clear()
+        prepared, self.prepared = self.prepared, None
+        if prepared:
+            for v in prepared.logs.values():
+                v.f.close()
+        while self.retired is not None:
+            try:
+                old = self.retired.get_nowait()
+            except Queue.Empty:
+                break
+            for v in old:
+                v.f.close()
+
+    def flushLogs(self, now=None):
+        ''' Flush the log files whose oldest pending record is due, or all of
+            them if now is None.
+        '''
+        for v in self.logs.values():
+            if now is None:
+                v.f.flush()
+            else:
+                v.f.flushIfDue(now)
+        self.publishRecords()
+
+    def publishRecords(self):
+        ''' Publish the records logged since the last call to the record
+            stream subscribers, if any.
+        '''
+        if self.record_stream is not None:
+            streamed, self.streamed = self.streamed, []
+            self.record_stream.publish(streamed)
 
     def useLocalIP(self):
         ''' Interpret local environment variable to determine whether to use
@@ -208,22 +908,120 @@ class Web100StatsWriter:
     def logName(self, local_time, local_ip):
         ''' Form directory name and file name for log file.
         '''
-        gm = time.gmtime(local_time)
-        logdir= time.strftime("%Y/%m/%d/", gm) + self.server
-        ts = time.strftime("%Y%m%dT%TZ", gm)
+        # The time strings only change once per hour, so cache them.
+        cache_time, datedir, ts = self.log_name_cache
+        if cache_time != local_time:
+            gm = time.gmtime(local_time)
+            datedir = time.strftime("%Y/%m/%d/", gm)
+            ts = time.strftime("%Y%m%dT%TZ", gm)
+            # A single assignment, since an HourRoller may call this too.
+            self.log_name_cache = (local_time, datedir, ts)
+        logdir = datedir + self.server
+        suffix = self.format.suffix + COMPRESSION_SUFFIXES[self.compression]
         if local_ip != None:
-          return logdir, "%s_%s_%d.web100"%(ts , local_ip, 0)
+          return logdir, "%s_%s_%d%s"%(ts , local_ip, 0, suffix)
         else:
-          return logdir, "%s_ALL%d.web100"%(ts ,0)
+          return logdir, "%s_ALL%d%s"%(ts ,0, suffix)
+
+    def openLogFile(self, logdir, logname, headers=None, key=None):
+        ''' Open a log file, and write the header unless it already has it.
 
-    def openLogFile(self, logdir, logname):
+        An HourRoller passes its own headers, and the key as a
+        (key_version, header) pair taken under self.lock, since the writer
+        threads may change the key while it opens files.
+        '''
+        headers = self.headers if headers is None else headers
+        key_version, header = key or (self.key_version, None)
+        name = logdir+logname
         self.mkdirs(logdir)
-        print "Opening:", logdir+logname
-        logf = open(logdir+logname, "a")
-        self.logHeader(logf)
-        # Add the entry to the logs dict.
+        print "Opening:", name
+        logf = BatchedLogFile(openCompressed(name, self.compression),
+                              self.flush_bytes, self.flush_seconds)
+        log_opens.inc()
+        # A file reopened after eviction only needs a header if the key
+        # changed since it was last written.
+        if name in headers:
+            log_reopens.inc()
+        if headers.get(name) != key_version:
+            if header is None:
+                self.logHeader(logf)
+            else:
+                logf.write(header)
+            headers[name] = key_version
         return logf
 
+    def prepareHour(self, hour_time, keys):
+        ''' Open the log files for hour_time ahead of time.
+
+        Called by an HourRoller shortly before the hour, with the keys of the
+        logs that are currently open.  getLogFile swaps the prepared logs in
+        at the start of the hour.  self.lock is held to take self.prepared
+        and the current header, to close stale logs, and to install the new
+        logs, but not while the files are opened.  Logs already prepared for the same hour are
+        reused, and those prepared for another hour are closed.  If the key
+        changes in the meantime, rollLogs writes the new header.
+        '''
+        with self.lock:
+            stale, self.prepared = self.prepared, None
+            key = None
+            if self.active_vars is not None:
+                key = (self.key_version, self.format.header())
+            if stale and stale.hour != hour_time:
+                # Closing flushes, which is serialized with the writers.
+                for v in stale.logs.values():
+                    v.f.close()
+                stale = None
+        if stale:
+            logs, headers = stale.logs, stale.headers
+        else:
+            logs, headers = OrderedDict(), {}
+        # Without a key, no logs have been written to yet.
+        for local_ip in keys if key else ():
+            if local_ip in logs:
+                continue
+            logdir, logname = self.logName(hour_time, local_ip)
+            logf = self.openLogFile(logdir, logname, headers, key)
+            logs[local_ip] = self.LogInfo(logdir+logname, logf)
+        with self.lock:
+            self.prepared = self.Prepared(hour_time, logs, headers)
+
+    def rollLogs(self, hour_time):
+        ''' Start using the logs for hour_time, retiring the current ones.
+
+        Logs prepared for another hour are retired with them.  Retired logs
+        are a list of LogInfo, since the two sets may share keys.
+        '''
+        old = self.logs.values()
+        prepared, self.prepared = self.prepared, None
+        if prepared and prepared.hour == hour_time:
+            self.logs, self.headers = prepared.logs, prepared.headers
+            # The key may have changed since the logs were prepared.
+            for v in self.logs.values():
+                if self.headers.get(v.name) != self.key_version:
+                    self.logHeader(v.f)
+                    self.headers[v.name] = self.key_version
+        else:
+            if prepared:
+                old += prepared.logs.values()
+            self.logs, self.headers = OrderedDict(), {}
+        self.sample_rates = {}
+        self.log_time = hour_time
+        if not old:
+            return
+        if self.retired is not None:
+            self.retired.put(old)
+        else:
+            for v in old:
+                v.f.close()
+
+    def evictLogs(self, room):
+        ''' Close the least recently used logs, leaving room for more.
+        '''
+        while self.logs and len(self.logs) + room > self.max_open_logs:
+            _, v = self.logs.popitem(last=False)
+            v.f.close()
+            log_evictions.inc()
+
     def getLogFile(self, local_time, local_ip=None):
         ''' getLogFile returns the appropriate logFile for the current time
             and local_ip address.
@@ -235,18 +1033,24 @@ class Web100StatsWriter:
         # Every hour, we close all the log files and start new ones.
         if hour_time > self.log_time:
             print('Closing all log files')
-            self.closeLogs()
-            self.log_time = hour_time
+            self.rollLogs(hour_time)
 
-        use_local = self.useLocalIP()  # Is this a speed concern?
         local_ip = local_ip if self.useLocalIP() else None
         if local_ip in self.logs:
-            return self.logs[local_ip].f
+            if self.max_open_logs:
+                # Move to the most recently used end.
+                self.logs[local_ip] = self.logs.pop(local_ip)
+            log = self.logs[local_ip]
         else:
+            if self.max_open_logs:
+                self.evictLogs(1)
             logdir, logname = self.logName(hour_time, local_ip)
             logf = self.openLogFile(logdir, logname)
-            self.logs[local_ip] = self.LogInfo(logdir+logname, logf)
-            return logf
+            log = self.logs[local_ip] = self.LogInfo(logdir+logname, logf)
+        if self.sample_rates.get(log.name, 1) != self.sample_rate:
+            log.f.write(self.format.sampling(local_time, self.sample_rate))
+            self.sample_rates[log.name] = self.sample_rate
+        return log.f
 
     def ipToIndex(self, local):
         """Convert the last octet of a local IP to an experiment index str."""
@@ -256,7 +1060,7 @@ class Web100StatsWriter:
         if last_octet == None:
             print 'address failed to match pattern: ' + local
             exception_count.labels('ip address parse error').inc()
-            return 'parse-error'
+            return PARSE_ERROR_INDEX
         else:
             return '{0}'.format(octetToIndex(int(last_octet.group(1),10)))
 
@@ -277,36 +1081,214 @@ class Web100StatsWriter:
             return 'ipv4'
 
     def logConnection(self, c):
-        snap = c.readall()
-        if not self.active_vars:
-            self.setkey(snap)
+        self.logSnapshot(c.cid, c.readall())
+
+    def logSnapshot(self, cid, snap, poll_time=None):
+        ''' Count and log the snapshot of a closed connection.
+
+        Args:
+          cid: int, the Web100 connection id.
+          snap: dict, the Web100 variables of the connection.
+          poll_time: float, when the connection was seen closed.  Defaults to
+              now.
+        '''
+        start = time.time()
 
         # Update connection count.  Use the least significant bits
         # of the local address to distinguish slices.
-        index = self.ipToIndex(snap["LocalAddress"])
-        conn_type = self.connectionType(snap["RemAddress"])
-        connection_count.labels(conn_type, index).inc()
+        classification = self.classifications.get(snap["LocalAddress"],
+                                                  snap["RemAddress"])
+        count, transmit, receive = classification.counters
+        count.inc()
 
         # Count the 'Data*' fields to include retransmit data. TCP/IP headers
         # are not included.
-        transmit_bytes.labels(conn_type, index).inc(snap["DataBytesOut"])
-        receive_bytes.labels(conn_type, index).inc(snap["DataBytesIn"])
+        transmit.inc(snap["DataBytesOut"])
+        receive.inc(snap["DataBytesIn"])
+        observeDistributions(classification.distributions, snap)
 
-        # If it isn't loopback or plc, then log it.
-        if conn_type.startswith('ipv'):
+        # If it isn't loopback or plc, then log it, unless it is shed.
+        if classification.conn_type.startswith('ipv'):
+            if self.sample_rate > 1 and not sampled(snap, self.sample_rate):
+                shed_count.inc()
+                record_duration.observe(time.time() - start)
+                return
+            if self.snap_keys != snap.viewkeys():
+                self.setkey(snap)
             # pick/open a logfile as needed, based on the close poll time
-            t = time.time()
+            t = time.time() if poll_time is None else poll_time
             logf = self.getLogFile(t, snap["LocalAddress"])
-            logf.write("C: %d %s"%
-                       (c.cid, time.strftime("%Y-%m-%d-%H:%M:%SZ",
-                                             time.gmtime(t))))
-            for v in self.active_vars:
-                logf.write(" "+str(snap[v]))
-            logf.write("\n")
-            logf.flush()
+            logf.write(self.format.record(cid, t, snap))
+            if self.record_stream is not None and self.record_stream.subscribers:
+                self.streamed.append(Snapshot(cid, t, snap))
+        record_duration.observe(time.time() - start)
+
+class HourRoller(threading.Thread):
+    """Moves hourly log rollover work off the writer's path.
+
+    lead_seconds before each hour, the roller creates the directories and
+    opens the files for the next hour, for the logs that are currently open.
+    After the writer swaps in the new logs, the roller flushes and closes the
+    previous hour's files, taking the writer's lock for each.
+    """
+
+    def __init__(self, writer, lock, lead_seconds=60):
+        """
+        Args:
+          writer: Web100StatsWriter, whose logs to prepare and close.
+          lock: threading.Lock, held while using the writer from other
+              threads, the writer's lock.
+          lead_seconds: float, how long before the hour to prepare the logs.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.writer = writer
+        self.lock = lock
+        self.lead_seconds = lead_seconds
+        writer.retired = Queue.Queue()
+
+    def run(self):
+        prepared_hour = None
+        while True:
+            now = time.time()
+            one_hour = self.writer.one_hour
+            next_hour = (int(now / one_hour) + 1) * one_hour
+            if prepared_hour == next_hour:
+                wait = next_hour - now
+            else:
+                wait = next_hour - self.lead_seconds - now
+            try:
+                old = self.writer.retired.get(timeout=max(wait, 0.01))
+            except Queue.Empty:
+                old = None
+            if old is not None:
+                # Closing flushes, and observes flush_duration like the
+                # writers do, so it is serialized with them, one log at a
+                # time.
+                for v in old:
+                    with self.lock:
+                        try:
+                            v.f.close()
+                        except Exception as e:
+                            countException(e)
+                continue
+            if prepared_hour != next_hour and time.time() < next_hour:
+                with self.lock:
+                    keys = list(self.writer.logs)
+                try:
+                    self.writer.prepareHour(next_hour, keys)
+                except Exception as e:
+                    countException(e)
+                prepared_hour = next_hour
+
 
 # Main
 
+# A closed connection, as passed from the poller to the writer threads.
+Snapshot = namedtuple('Snapshot', ['cid', 'poll_time', 'values'])
+
+
+def recordJson(record):
+    """Encodes a logged Snapshot as a line of JSON, for the record stream."""
+    values = dict(record.values, cid=record.cid, PollTime=record.poll_time)
+    return json.dumps(values, separators=(',', ':')) + '\n'
+
+
+def countException(e):
+    """Count and print an exception raised while handling a connection.
+
+    We should handle all exceptions deeper in the call stack.  We instrument
+    this so that we can detect exceptions and track them down.
+    """
+    exception_count.labels(type(e)).inc()
+    print e
+
+
+def startWriters(stats_writer, queue, count):
+    """Starts count WriterThreads that log the snapshots put on queue.
+
+    Returns:
+      (lock, threads), the lock serializing use of stats_writer, and the
+      started threads.
+    """
+    lock = stats_writer.lock
+    writers = []
+    for _ in range(count):
+        writer = pipeline.WriterThread(
+            queue,
+            lambda s: stats_writer.logSnapshot(s.cid, s.values, s.poll_time),
+            idle=stats_writer.flushLogs, lock=lock,
+            error_callback=countException)
+        writer.start()
+        writers.append(writer)
+    return lock, writers
+
+
+def stopWriters(stats_writer, queue, writers):
+    """Waits for the writers to drain the queue, and closes the logs."""
+    queue.close()
+    for writer in writers:
+        writer.join()
+    # An HourRoller may still be closing retired logs.
+    with stats_writer.lock:
+        stats_writer.publishRecords()
+        stats_writer.closeLogs()
+
+
+def pollConnections(agent, tracker, queue, publisher=None, read_vars=None,
+                    prefilter=None):
+    """Queues the snapshots of the connections closed since the last poll.
+
+    Args:
+      publisher: closebus.Publisher, if not None, receives a CloseEvent for
+          each closed connection.
+      read_vars: list of the variables to read, or None for all of them.
+      prefilter: Prefilter, if not None, decides which connections are
+          skipped, or only read enough to be counted.
+    Returns:
+      conntrack.PollStats for the poll.
+    """
+    start = time.time()
+    read_seconds = 0.0
+    events = []
+    for closed in tracker.poll(agent.all_connections()):
+        try:
+            c = closed.connection
+            read_start = time.time()
+            stage = Prefilter.LOG
+            if prefilter is not None:
+                stage = prefilter.stage(closed.generation)
+            if stage == Prefilter.SKIP:
+                if publisher is not None:
+                    events.append(closebus.eventFromSnapshot(
+                        c.cid, read_start, skippedSnapshot(closed.generation)))
+                continue
+            elif stage == Prefilter.COUNT:
+                snap = countedSnapshot(c, closed.generation)
+            else:
+                snap = readSnapshot(c, read_vars)
+            read_seconds += time.time() - read_start
+            queue.put(Snapshot(c.cid, read_start, snap))
+            if publisher is not None:
+                events.append(closebus.eventFromSnapshot(c.cid, read_start,
+                                                         snap))
+        except Exception as e:
+            countException(e)
+    if publisher is not None:
+        try:
+            publisher.publish(events)
+        except Exception as e:
+            countException(e)
+    poll_duration.observe(time.time() - start)
+    poll_read_duration.observe(read_seconds)
+    poll = tracker.last_poll
+    poll_scanned_histogram.observe(poll.scanned)
+    poll_scanned.set(poll.scanned)
+    poll_emitted.set(poll.emitted)
+    reused_cid_count.inc(poll.reused)
+    return poll
+
+
 def main(argv):
     print "Starting exitstats"
 
@@ -321,29 +1303,104 @@ def main(argv):
     # Start prometheus server to export metrics.
     start_http_server(PROMETHEUS_SERVER_PORT)
 
-    stats_writer = Web100StatsWriter(server)
+    # Stream the logged records as lines of JSON to the subscribers of
+    # SIDESTREAM_RECORD_STREAM, if set.
+    record_stream = None
+    stream_path = os.environ.get('SIDESTREAM_RECORD_STREAM')
+    if stream_path:
+        record_stream = closebus.Publisher(stream_path, encode=recordJson,
+                                           stream='records')
 
-    agent = Web100Agent()
-    closed = []
-    while True:
-        conns = agent.all_connections()
-        newclosed = []
-        for c in conns:
-            try:
-                if c.read('State') == 1:
-                    newclosed.append(c.cid)
-                    if not c.cid in closed:
-                        stats_writer.logConnection(c)
-            except Exception as e:
-                # We should handle all exceptions deeper in the call stack.
-                # We instrument this so that we can detect exceptions and
-                # track them down.
-                exception_count.labels(type(e)).inc()
-                print e
-                pass
-        closed = newclosed;
-        # Wait 5 seconds before running polling again.
-        time.sleep(5)
+    # SIDESTREAM_FLUSH_SECONDS bounds how long a record may stay unflushed.
+    stats_writer = Web100StatsWriter(
+        server,
+        flush_bytes=envFloat('SIDESTREAM_FLUSH_BYTES', 64*1024),
+        flush_seconds=envFloat('SIDESTREAM_FLUSH_SECONDS', 0),
+        compression=os.environ.get('SIDESTREAM_COMPRESSION') or None,
+        log_format=os.environ.get('SIDESTREAM_LOG_FORMAT', 'text'),
+        max_open_logs=int(envFloat('SIDESTREAM_MAX_OPEN_LOGS', 256)),
+        record_stream=record_stream,
+        projection=Projection.fromProfile(
+            os.environ.get('SIDESTREAM_PROFILE', 'full'),
+            include=envList('SIDESTREAM_INCLUDE'),
+            exclude=envList('SIDESTREAM_EXCLUDE') or ()))
+    read_vars = stats_writer.projection.readVars()
+    # Connections to SIDESTREAM_IGNORE_PORTS, or from remote addresses
+    # starting with one of SIDESTREAM_IGNORE_PREFIXES, are neither counted
+    # nor logged.
+    prefilter = Prefilter(
+        ClassificationCache(stats_writer.ipToIndex,
+                            stats_writer.connectionType),
+        ignore_ports=[int(p) for p in envList('SIDESTREAM_IGNORE_PORTS') or ()],
+        ignore_prefixes=envList('SIDESTREAM_IGNORE_PREFIXES') or ())
+
+    source = os.environ.get('SIDESTREAM_SOURCE', 'web100')
+    if source not in SOURCES:
+        raise ValueError('unknown connection source: %s' % source)
+    agent = SOURCES[source]()
+
+    # Exit through the finally clause below on SIGTERM, so that buffered
+    # records are written and compressed streams are finalized.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # The poller hands snapshots to the writer threads through a bounded
+    # queue, so that slow disk I/O does not delay the next poll.
+    queue = pipeline.SnapshotQueue(
+        int(envFloat('SIDESTREAM_QUEUE_SIZE', 100000)),
+        policy=os.environ.get('SIDESTREAM_QUEUE_POLICY', pipeline.BLOCK),
+        spill_dir=os.environ.get('SIDESTREAM_SPILL_DIR'))
+    writer_lock, writers = startWriters(
+        stats_writer, queue, int(envFloat('SIDESTREAM_WRITER_THREADS', 1)))
+    HourRoller(stats_writer, writer_lock).start()
+
+    tracker = conntrack.ConnectionTracker(error_callback=countException)
+    # Publish close events for paris_rollins, so that it need not scan the
+    # connections too.  An empty SIDESTREAM_CLOSE_EVENTS disables this.
+    publisher = None
+    events_path = os.environ.get('SIDESTREAM_CLOSE_EVENTS',
+                                 closebus.DEFAULT_PATH)
+    if events_path:
+        try:
+            publisher = closebus.Publisher(events_path)
+        except (OSError, socket.error) as e:
+            print 'Not publishing close events:', e
+    # The interval adapts to the close rate, between SIDESTREAM_MIN_INTERVAL
+    # and SIDESTREAM_MAX_INTERVAL seconds.  Connections that were open on one
+    # poll and gone by the next are counted as missed closes.  A poll that
+    # runs long delays the next one, which is recorded as lateness.
+    scheduler = pollsched.AdaptiveInterval(
+        minimum=envFloat('SIDESTREAM_MIN_INTERVAL', 1),
+        maximum=envFloat('SIDESTREAM_MAX_INTERVAL', 10),
+        busy_missed=int(envFloat('SIDESTREAM_BUSY_MISSED_CLOSES', 10)),
+        slow_fraction=envFloat('SIDESTREAM_SLOW_POLL_FRACTION', 0.2))
+    # Under overload, log only a sample of the connections.  See LoadShedder.
+    shedder = LoadShedder(
+        max_depth=int(envFloat('SIDESTREAM_SHED_QUEUE_DEPTH', 0)),
+        max_lateness=envFloat('SIDESTREAM_SHED_LATENESS', 0),
+        max_records_per_second=envFloat('SIDESTREAM_RECORD_BUDGET', 0),
+        max_rate=int(envFloat('SIDESTREAM_MAX_SAMPLE_RATE', 64)))
+    next_poll = time.time()
+    try:
+        while True:
+            time.sleep(max(0, next_poll - time.time()))
+            start = time.time()
+            lateness = max(0, start - next_poll)
+            poll_lateness.observe(lateness)
+            last_poll_lateness.set(lateness)
+            poll = pollConnections(agent, tracker, queue, publisher, read_vars,
+                                   prefilter)
+            now = time.time()
+            interval = scheduler.update(poll.emitted, now - start,
+                                        poll.vanished)
+            stats_writer.sample_rate = shedder.update(now, poll.emitted,
+                                                      len(queue), lateness)
+            next_poll = start + interval
+    finally:
+        if publisher is not None:
+            publisher.close()
+        stopWriters(stats_writer, queue, writers)
+        if record_stream is not None:
+            record_stream.close()
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -4,9 +4,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import gzip
+import json
 import logging
 import os
+import Queue
 import re
+import shutil
+import tempfile
 import time
 import unittest
 import urllib2
@@ -15,7 +20,9 @@ from test.test_support import EnvironmentVarGuard
 import prometheus_client as prom
 from freezegun import freeze_time
 
+import closebus
 import exitstats
+import web100sim
 
 # TODO(gfr) Ideally we should use black box testing, but taking a shortcut
 # here to get decent test coverage.  Do not extend these tests until they
@@ -72,6 +79,10 @@ class FakeConnection():
     '''Returns dictionary of metrics'''
     return self.values
 
+  def read(self, name):
+    '''Returns one metric'''
+    return self.values[name]
+
   def setall(self, v):
     self.values = v
 
@@ -392,5 +403,728 @@ class TestExitstats(unittest.TestCase):
     # TODO(gfr) Consider adding tests for incorrect main arguments.
 
 
+class TestOpenLogCap(unittest.TestCase):
+
+  @freeze_time("2014-02-23 10:23:34", tz_offset=0)
+  def testEvictAndReopen(self):
+    writer = exitstats.Web100StatsWriter('server/', max_open_logs=2)
+    logdir = '2014/02/23/server/'
+    locals = ['1.2.3.10', '1.2.3.11', '1.2.3.12']
+    lognames = ['20140223T10:00:00Z_%s_0.web100' % ip for ip in locals]
+    for logname in lognames:
+      remove_file(logdir, logname)
+    conns = []
+    for i, ip in enumerate(locals):
+      c = FakeConnection()
+      c.cid = i
+      c.setall({"RemAddress": "5.4.3.2", "LocalAddress": ip,
+                "DataBytesOut": 0, "DataBytesIn": 0})
+      conns.append(c)
+
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'True')
+      for c in conns + conns[:1]:
+        writer.logConnection(c)
+      self.assertEqual(len(writer.logs), 2)
+      self.assertEqual(list(writer.logs), ['1.2.3.12', '1.2.3.10'])
+      writer.closeLogs()
+
+    lines = open(logdir + lognames[0]).read().splitlines()
+    for logname in lognames:
+      remove_file(logdir, logname)
+    self.assertEqual([line[:2] for line in lines], ['K:', 'C:', 'C:'])
+
+
+class TestHourRollover(unittest.TestCase):
+
+  def testPreparedLogsAreSwappedIn(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    writer.retired = Queue.Queue()
+    logdir = '2014/02/23/server/'
+    logname10 = '20140223T10:00:00Z_ALL0.web100'
+    logname11 = '20140223T11:00:00Z_ALL0.web100'
+    remove_file(logdir, logname10)
+    remove_file(logdir, logname11)
+    writer.setkey({'foo':3})
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:59:00", tz_offset=0):
+        old = writer.getLogFile(time.time())
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+        prepared = writer.prepared.logs[None].f
+        self.assertTrue(os.path.exists(logdir + logname11))
+        self.assertIs(writer.getLogFile(time.time()), old)
+      with freeze_time("2014-02-23 11:00:01", tz_offset=0):
+        new = writer.getLogFile(time.time())
+        self.assertIs(new, prepared)
+      # The old logs are left for the roller to close.
+      self.assertEqual(writer.retired.get_nowait()[0].f, old)
+    writer.closeLogs()
+    remove_file(logdir, logname10)
+    remove_file(logdir, logname11)
+
+  def testPreparingTwiceReusesLogs(self):
+    writer = exitstats.Web100StatsWriter('server/', compression='gzip')
+    logdir = '2014/02/23/server/'
+    logname11 = '20140223T11:00:00Z_ALL0.web100.gz'
+    logname12 = '20140223T12:00:00Z_ALL0.web100.gz'
+    writer.setkey({'foo':3})
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:59:00", tz_offset=0):
+        writer.getLogFile(time.time())
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+        first = writer.prepared.logs[None].f
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+        self.assertIs(writer.prepared.logs[None].f, first)
+        # Preparing another hour closes the stale logs.
+        writer.prepareHour(time.time() + 3660, list(writer.logs))
+        self.assertEqual(writer.prepared.logs.keys(), [None])
+    writer.closeLogs()
+    self.assertEqual(gzip.open(logdir + logname11).read(),
+                     'K: cid PollTime foo\n')
+    self.assertEqual(gzip.open(logdir + logname12).read(),
+                     'K: cid PollTime foo\n')
+    for logname in ('20140223T10:00:00Z_ALL0.web100.gz', logname11,
+                    logname12):
+      remove_file(logdir, logname)
+
+  def testRollAfterStalePrepare(self):
+    writer = exitstats.Web100StatsWriter('server/', flush_seconds=60,
+                                         compression='gzip')
+    logdir = '2014/02/23/server/'
+    logname10 = '20140223T10:00:00Z_ALL0.web100.gz'
+    logname11 = '20140223T11:00:00Z_ALL0.web100.gz'
+    logname12 = '20140223T12:00:00Z_ALL0.web100.gz'
+    snap = {'LocalAddress': '1.2.3.4', 'RemAddress': '5.6.7.8',
+            'DataBytesOut': 0, 'DataBytesIn': 0}
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:59:00", tz_offset=0):
+        writer.logSnapshot(1, snap)
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+      # The 11:00 roll never happened, so the prepared logs are stale.
+      with freeze_time("2014-02-23 12:00:01", tz_offset=0):
+        writer.logSnapshot(2, snap)
+    writer.closeLogs()
+    header = 'K: cid PollTime LocalAddress RemAddress DataBytesOut DataBytesIn'
+    self.assertEqual(gzip.open(logdir + logname10).read().splitlines(),
+                     [header, 'C: 1 2014-02-23-10:59:00Z 1.2.3.4 5.6.7.8 0 0'])
+    self.assertEqual(gzip.open(logdir + logname11).read().splitlines(),
+                     [header])
+    self.assertEqual(gzip.open(logdir + logname12).read().splitlines(),
+                     [header, 'C: 2 2014-02-23-12:00:01Z 1.2.3.4 5.6.7.8 0 0'])
+    for logname in (logname10, logname11, logname12):
+      remove_file(logdir, logname)
+
+  def testHeaderRewrittenOnKeyChange(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    logdir = '2014/02/23/server/'
+    logname11 = '20140223T11:00:00Z_ALL0.web100'
+    remove_file(logdir, logname11)
+    writer.setkey({'foo':3})
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:59:00", tz_offset=0):
+        writer.getLogFile(time.time())
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+        writer.setkey({'bar':3})
+      with freeze_time("2014-02-23 11:00:01", tz_offset=0):
+        writer.getLogFile(time.time())
+    writer.closeLogs()
+    lines = open(logdir + logname11).read().splitlines()
+    remove_file(logdir, logname11)
+    remove_file(logdir, '20140223T10:00:00Z_ALL0.web100')
+    self.assertEqual(lines, ['K: cid PollTime foo', 'K: cid PollTime bar'])
+
+  def testKeyChangeWhileOpening(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    logdir = '2014/02/23/server/'
+    logname11 = '20140223T11:00:00Z_ALL0.web100'
+    remove_file(logdir, logname11)
+    writer.setkey({'foo':3})
+    mkdirs = writer.mkdirs
+    def changeKey(name):
+      # A writer thread changes the key while the roller opens the file.
+      writer.mkdirs = mkdirs
+      writer.setkey({'bar':3})
+      mkdirs(name)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:59:00", tz_offset=0):
+        writer.getLogFile(time.time())
+        writer.mkdirs = changeKey
+        writer.prepareHour(time.time() + 60, list(writer.logs))
+      with freeze_time("2014-02-23 11:00:01", tz_offset=0):
+        writer.getLogFile(time.time())
+    writer.closeLogs()
+    lines = open(logdir + logname11).read().splitlines()
+    remove_file(logdir, logname11)
+    remove_file(logdir, '20140223T10:00:00Z_ALL0.web100')
+    self.assertEqual(lines, ['K: cid PollTime foo', 'K: cid PollTime bar'])
+
+  def testRollerClosesUnderLock(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    exitstats.HourRoller(writer, writer.lock).start()
+    closed = Queue.Queue()
+    class Log(object):
+      def close(self):
+        closed.put(writer.lock.locked())
+    writer.retired.put([writer.LogInfo('retired', Log())])
+    self.assertTrue(closed.get(timeout=5))
+
+
+class TestClassificationCache(unittest.TestCase):
+
+  def testLRU(self):
+    calls = []
+    def classify_local(local):
+      calls.append(local)
+      return 'host'
+    cache = exitstats.ClassificationCache(classify_local, lambda r: 'ipv4',
+                                          capacity=2)
+    first = cache.get('1.2.3.9', '5.4.3.2')
+    self.assertEqual(first.index, 'host')
+    self.assertEqual(first.conn_type, 'ipv4')
+    self.assertEqual(len(first.counters), 3)
+    self.assertIs(cache.get('1.2.3.9', '5.4.3.2'), first)
+    self.assertEqual(len(calls), 1)
+
+    # Addresses are cached on their own, not by pair.
+    self.assertIs(cache.get('1.2.3.9', '5.4.3.3'), first)
+    cache.get('1.2.3.9', '5.4.3.2')
+    # Evicts 5.4.3.3, the least recently used remote address.
+    cache.get('1.2.3.9', '5.4.3.4')
+    self.assertEqual(list(cache.types), ['5.4.3.2', '5.4.3.4'])
+    self.assertEqual(list(cache.indexes), ['1.2.3.9'])
+    self.assertEqual(len(calls), 1)
+
+  def testParseErrorsCountedPerLookup(self):
+    w = exitstats.Web100StatsWriter('server/')
+    cache = exitstats.ClassificationCache(w.ipToIndex, w.connectionType)
+    labels = {'type': 'ip address parse error'}
+    get = prom.REGISTRY.get_sample_value
+    before = get('sidestream_exception_count', labels) or 0
+    for remote in ('5.4.3.2', '5.4.3.2', '5.4.3.3'):
+      self.assertEqual(cache.get('bad-address', remote).index, 'parse-error')
+    self.assertEqual(get('sidestream_exception_count', labels) - before, 3)
+
+
+class TestDistributions(unittest.TestCase):
+
+  def sample(self, name, suffix='_count', **labels):
+    labels.setdefault('type', 'loopback-ipv4')
+    labels.setdefault('index', '9')
+    return prom.REGISTRY.get_sample_value(name + suffix, labels) or 0
+
+  def testObserved(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    names = ['sidestream_min_rtt_milliseconds',
+             'sidestream_smoothed_rtt_milliseconds',
+             'sidestream_throughput_bits_per_second',
+             'sidestream_retransmit_ratio',
+             'sidestream_congestion_signals_per_second']
+    before = [self.sample(name) for name in names]
+    # Loopback connections are counted, but not logged to a file.
+    snap = {'LocalAddress': '1.2.3.19', 'RemAddress': '127.0.0.1',
+            'DataBytesOut': 1000000, 'DataBytesIn': 0, 'MinRTT': 20,
+            'SmoothedRTT': 30, 'Duration': 2000000, 'DataPktsOut': 1000,
+            'PktsRetrans': 10, 'CongestionSignals': 4}
+    writer.logSnapshot(1, snap)
+    self.assertEqual([self.sample(name) - b for name, b in zip(names, before)],
+                     [1] * 5)
+    self.assertEqual(
+        self.sample('sidestream_throughput_bits_per_second', '_sum'), 4e6)
+    self.assertEqual(self.sample('sidestream_retransmit_ratio', '_bucket',
+                                 le='0.01'), 1)
+
+    # Without the variables or a duration, only the counters are updated.
+    writer.logSnapshot(2, {'LocalAddress': '1.2.3.19',
+                           'RemAddress': '127.0.0.1', 'DataBytesOut': 0,
+                           'DataBytesIn': 0})
+    self.assertEqual([self.sample(name) - b for name, b in zip(names, before)],
+                     [1] * 5)
+
+
+class TestProjection(unittest.TestCase):
+
+  def testProfiles(self):
+    standard = exitstats.Projection.fromProfile('standard')
+    self.assertTrue(standard.selects('DataBytesOut'))
+    self.assertFalse(standard.selects('X_dbg1'))
+    self.assertFalse(standard.selects('WAD_NoAI'))
+    minimal = exitstats.Projection.fromProfile('minimal', exclude=['State'])
+    self.assertTrue(minimal.selects('MinRTT'))
+    self.assertFalse(minimal.selects('State'))
+    self.assertFalse(minimal.selects('SndUna'))
+    with self.assertRaises(ValueError):
+      exitstats.Projection.fromProfile('tiny')
+
+  def testReadVars(self):
+    self.assertEqual(exitstats.Projection().readVars(), None)
+    self.assertEqual(exitstats.Projection(['Cur*']).readVars(), None)
+    read_vars = exitstats.Projection(['State', 'CurMSS'],
+                                     ['CurMSS']).readVars()
+    self.assertEqual(read_vars[0], 'State')
+    self.assertFalse('CurMSS' in read_vars)
+    self.assertTrue(set(exitstats.REQUIRED_VARS) <= set(read_vars))
+
+  def testHeaderIsProjected(self):
+    writer = exitstats.Web100StatsWriter(
+        'server/', projection=exitstats.Projection(exclude=['X_*']))
+    writer.setkey({'LocalAddress': '1.2.3.4', 'X_dbg1': 0, 'Extra': 1})
+    self.assertEqual(writer.format.header(),
+                     'K: cid PollTime LocalAddress Extra\n')
+
+  def testReadSnapshot(self):
+    c = FakeConnection()
+    c.setall({'a': 1, 'b': 2, 'c': 3})
+    self.assertEqual(exitstats.readSnapshot(c), {'a': 1, 'b': 2, 'c': 3})
+    self.assertEqual(exitstats.readSnapshot(c, ['a', 'c', 'd']),
+                     {'a': 1, 'c': 3})
+    # Small projections are read by name, without readall.
+    c.readall = None
+    self.assertEqual(exitstats.readSnapshot(c, ['a', 'c']), {'a': 1, 'c': 3})
+    # Sources that can read a subset of the variables are asked to.
+    c.readvars = lambda names: {'only': names}
+    self.assertEqual(exitstats.readSnapshot(c, ['a']), {'only': ['a']})
+
+
+class TestPrefilter(unittest.TestCase):
+
+  def generation(self, remote, local_port=80, remote_port=1234):
+    return exitstats.conntrack.Generation(1, '1.2.3.4', local_port, remote,
+                                          remote_port, 100)
+
+  def testStages(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    prefilter = exitstats.Prefilter(writer.classifications, ignore_ports=[22],
+                                    ignore_prefixes=['10.1.'])
+    self.assertEqual(prefilter.stage(self.generation('5.6.7.8')), 'logged')
+    self.assertEqual(prefilter.stage(self.generation('127.0.0.1')), 'counted')
+    self.assertEqual(prefilter.stage(self.generation('128.112.139.2')),
+                     'counted')
+    self.assertEqual(prefilter.stage(self.generation('10.1.2.3')), 'skipped')
+    self.assertEqual(prefilter.stage(self.generation('5.6.7.8', 22)),
+                     'skipped')
+    self.assertEqual(
+        prefilter.stage(self.generation('5.6.7.8', remote_port=22)), 'skipped')
+
+  def testStagesUseClassificationCache(self):
+    calls = []
+    def classify_remote(remote):
+      calls.append(remote)
+      return 'ipv4'
+    cache = exitstats.ClassificationCache(lambda local: '0', classify_remote)
+    prefilter = exitstats.Prefilter(cache)
+    prefilter.stage(self.generation('5.6.7.8'))
+    prefilter.stage(self.generation('5.6.7.8'))
+    cache.get('1.2.3.4', '5.6.7.8')
+    self.assertEqual(calls, ['5.6.7.8'])
+
+  def testSkippedClosesArePublished(self):
+    class Publisher(object):
+      events = []
+      def publish(self, events):
+        self.events += events
+
+    class Connection(object):
+      cid = 1
+      def read(self, name):
+        return {'State': 1, 'LocalAddress': '1.2.3.4', 'LocalPort': 22,
+                'RemAddress': '5.6.7.8', 'RemPort': 1234,
+                'StartTimeSec': 100}[name]
+
+    class Agent(object):
+      def all_connections(self):
+        return [Connection()]
+
+    writer = exitstats.Web100StatsWriter('server/')
+    queue = exitstats.pipeline.SnapshotQueue(10)
+    publisher = Publisher()
+    exitstats.pollConnections(
+        Agent(), exitstats.conntrack.ConnectionTracker(), queue, publisher,
+        prefilter=exitstats.Prefilter(writer.classifications,
+                                      ignore_ports=[22]))
+    self.assertEqual(len(queue), 0)
+    self.assertEqual([(e.cid, e.RemAddress, e.LocalAddressType)
+                      for e in publisher.events], [(1, '5.6.7.8', 1)])
+
+  def testPollReadsCountedConnectionsPartially(self):
+    clock = [1000.0]
+    agent = web100sim.SimulatedAgent(connections=100, close_rate=100,
+                                     loopback_fraction=0.5, plc_fraction=0,
+                                     clock=lambda: clock[0])
+    writer = exitstats.Web100StatsWriter('server/')
+    tracker = exitstats.conntrack.ConnectionTracker()
+    queue = exitstats.pipeline.SnapshotQueue(1000)
+    clock[0] += 1
+    poll = exitstats.pollConnections(
+        agent, tracker, queue,
+        prefilter=exitstats.Prefilter(writer.classifications))
+    snaps = [queue.get(0).values for _ in range(poll.emitted)]
+    counted = [snap for snap in snaps
+               if snap['RemAddress'] in ('127.0.0.1', '::1')]
+    logged = [snap for snap in snaps if snap not in counted]
+    self.assertTrue(counted and logged)
+    for snap in counted:
+      # The simulated connections have no DataPktsOut.
+      self.assertEqual(sorted(snap), sorted(
+          set(exitstats.COUNTED_VARS) - set(['DataPktsOut']) |
+          set(['LocalAddress', 'LocalPort', 'RemAddress', 'RemPort'])))
+      # Counted connections are observed in the distributions too.
+      self.assertTrue('MinRTT' in snap and 'Duration' in snap)
+    for snap in logged:
+      self.assertTrue('MinRTT' in snap)
+
+
+class TestLoadShedder(unittest.TestCase):
+
+  def testRates(self):
+    shedder = exitstats.LoadShedder(max_depth=100, max_lateness=1,
+                                    max_records_per_second=1000, max_rate=8)
+    self.assertEqual(shedder.update(0, 5000, 0, 0), 1)
+    self.assertEqual(shedder.update(1, 3000, 0, 0), 4)
+    self.assertEqual(shedder.update(2, 100000, 0, 0), 8)
+    self.assertEqual(shedder.update(3, 500, 0, 0), 1)
+    self.assertEqual(shedder.update(4, 500, 200, 0), 2)
+    self.assertEqual(shedder.update(5, 500, 0, 2), 4)
+    self.assertEqual(shedder.update(6, 500, 0, 0), 2)
+    self.assertEqual(shedder.update(7, 500, 0, 0), 1)
+    self.assertEqual(
+        prom.REGISTRY.get_sample_value('sidestream_sample_rate'), 1)
+
+  def testSamplesAreNested(self):
+    snaps = [{'LocalAddress': '1.2.3.4', 'LocalPort': 80,
+              'RemAddress': '5.6.7.8', 'RemPort': port}
+             for port in range(1000)]
+    by_rate = dict((rate, [s for s in snaps if exitstats.sampled(s, rate)])
+                   for rate in (1, 2, 4))
+    self.assertEqual(len(by_rate[1]), 1000)
+    self.assertTrue(200 < len(by_rate[4]) < 300)
+    self.assertTrue(all(s in by_rate[2] for s in by_rate[4]))
+
+  def testSampledLog(self):
+    writer = exitstats.Web100StatsWriter('server/')
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100'
+    remove_file(logdir, logname)
+    get = prom.REGISTRY.get_sample_value
+    shed_before = get('sidestream_shed_record_count') or 0
+    labels = {'type': 'ipv4', 'index': writer.ipToIndex('1.2.3.4')}
+    count_before = get('sidestream_connection_count', labels) or 0
+    snaps = [{'LocalAddress': '1.2.3.4', 'LocalPort': 80,
+              'RemAddress': '5.6.7.8', 'RemPort': port,
+              'DataBytesOut': 0, 'DataBytesIn': 0} for port in range(100)]
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+        writer.logSnapshot(1, snaps[0])
+        writer.sample_rate = 4
+        for i, snap in enumerate(snaps):
+          writer.logSnapshot(i, snap)
+        writer.sample_rate = 1
+        writer.logSnapshot(1, snaps[0])
+    writer.closeLogs()
+    lines = open(logdir + logname).read().splitlines()
+    remove_file(logdir, logname)
+    sampled = [s for s in snaps if exitstats.sampled(s, 4)]
+    self.assertEqual(lines[:3], ['K: cid PollTime LocalAddress LocalPort '
+                                 'RemAddress RemPort DataBytesOut DataBytesIn',
+                                 lines[1], 'S: 2014-02-23-10:23:34Z 4'])
+    self.assertEqual([line.split()[6] for line in lines[3:-2]],
+                     [str(s['RemPort']) for s in sampled])
+    self.assertEqual(lines[-2], 'S: 2014-02-23-10:23:34Z 1')
+    self.assertEqual(lines[-1][:2], 'C:')
+    self.assertEqual(get('sidestream_shed_record_count') - shed_before,
+                     100 - len(sampled))
+    self.assertEqual(get('sidestream_connection_count', labels) - count_before,
+                     102)
+
+
+def legacyRecord(cid, poll_time, active_vars, snap):
+  '''Formats a C: line variable by variable, as before TextFormat.'''
+  record = "C: %d %s" % (cid, time.strftime("%Y-%m-%d-%H:%M:%SZ",
+                                            time.gmtime(poll_time)))
+  for v in active_vars:
+    record += " " + str(snap[v])
+  return record + "\n"
+
+
+class TestTextFormat(unittest.TestCase):
+
+  def testByteIdentical(self):
+    w = exitstats.Web100StatsWriter("server/")
+    snap = dict((k, i * 7) for i, k in enumerate(w.stdvars))
+    snap.update({"LocalAddress": "1.2.3.4", "RemAddress": "::1", "extra": 3L})
+    fmt = exitstats.TextFormat()
+    for keys in ([], ["MinRTT"], w.stdvars + ["extra"]):
+      fmt.setkey(keys, snap)
+      for t in (1393151014.0, 1393151014.9, 1393151015.2, 1393151014.5):
+        self.assertEqual(fmt.record(1234, t, snap),
+                         legacyRecord(1234, t, keys, snap))
+
+
+class FakeFile(object):
+  '''Records the writes and flushes made to a file.'''
+  def __init__(self):
+    self.writes = []
+    self.flushes = 0
+    self.closed = False
+
+  def write(self, data):
+    self.writes.append(data)
+
+  def flush(self):
+    self.flushes += 1
+
+  def close(self):
+    self.closed = True
+
+
+class TestInstrumentation(unittest.TestCase):
+
+  def count(self, name):
+    return prom.REGISTRY.get_sample_value(name + '_count') or 0
+
+  def testPollAndRecordMetrics(self):
+    clock = [1000.0]
+    agent = web100sim.SimulatedAgent(connections=100, close_rate=100,
+                                     clock=lambda: clock[0])
+    writer = exitstats.Web100StatsWriter('server/')
+    tracker = exitstats.conntrack.ConnectionTracker()
+    queue = exitstats.pipeline.SnapshotQueue(1000)
+    names = ('sidestream_poll_duration_seconds',
+             'sidestream_poll_read_duration_seconds',
+             'sidestream_poll_scanned_connections_per_poll',
+             'sidestream_record_duration_seconds',
+             'sidestream_log_flush_duration_seconds')
+    before = dict((name, self.count(name)) for name in names)
+    tracker.poll(agent.all_connections())
+    clock[0] += 1
+    poll = exitstats.pollConnections(
+        agent, tracker, queue,
+        prefilter=exitstats.Prefilter(writer.classifications))
+    self.assertTrue(poll.emitted > 0)
+    self.assertEqual(prom.REGISTRY.get_sample_value(
+        'sidestream_poll_scanned_connections'), poll.scanned)
+    self.assertEqual(prom.REGISTRY.get_sample_value(
+        'sidestream_poll_emitted_connections'), poll.emitted)
+    # Loopback connections are counted, not logged, so that the counts of
+    # other tests are not disturbed.
+    for _ in range(poll.emitted):
+      s = queue.get(0)
+      writer.logSnapshot(s.cid, dict(s.values, RemAddress='127.0.0.1'))
+    logf = exitstats.BatchedLogFile(FakeFile(), max_bytes=100, max_delay=60)
+    logf.write('x')
+    logf.close()
+    after = dict((name, self.count(name)) for name in names)
+    for name in names[:3]:
+      self.assertEqual(after[name], before[name] + 1)
+    self.assertEqual(after['sidestream_record_duration_seconds'],
+                     before['sidestream_record_duration_seconds'] +
+                     poll.emitted)
+    self.assertEqual(after['sidestream_log_flush_duration_seconds'],
+                     before['sidestream_log_flush_duration_seconds'] + 1)
+
+
+class TestBatchedLogFile(unittest.TestCase):
+
+  def testUnbatched(self):
+    f = FakeFile()
+    log = exitstats.BatchedLogFile(f)
+    log.write('a')
+    log.write('b')
+    self.assertEqual(f.writes, ['a', 'b'])
+    self.assertEqual(f.flushes, 2)
+
+  def testSizeThreshold(self):
+    f = FakeFile()
+    log = exitstats.BatchedLogFile(f, max_bytes=4, max_delay=60)
+    log.write('ab')
+    log.write('c')
+    self.assertEqual(f.writes, [])
+    log.write('d')
+    self.assertEqual(f.writes, ['abcd'])
+    self.assertEqual(f.flushes, 1)
+
+  def testDeadline(self):
+    f = FakeFile()
+    log = exitstats.BatchedLogFile(f, max_bytes=1000, max_delay=10)
+    with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+      log.write('a')
+      log.flushIfDue(time.time() + 9)
+      self.assertEqual(f.writes, [])
+    with freeze_time("2014-02-23 10:23:40", tz_offset=0):
+      log.write('b')
+      self.assertEqual(f.writes, [])
+    with freeze_time("2014-02-23 10:23:44", tz_offset=0):
+      log.flushIfDue(time.time())
+      self.assertEqual(f.writes, ['ab'])
+      # A later record starts a new deadline.
+      log.write('c')
+      log.flushIfDue(time.time() + 9)
+      self.assertEqual(f.writes, ['ab'])
+
+  def testClose(self):
+    f = FakeFile()
+    log = exitstats.BatchedLogFile(f, max_bytes=1000, max_delay=10)
+    log.write('a')
+    log.close()
+    self.assertEqual(f.writes, ['a'])
+    self.assertTrue(f.closed)
+
+  @freeze_time("2014-02-23 10:23:34", tz_offset=0)
+  def testBatchedWriter(self):
+    '''Records are written when the logs are flushed or closed.'''
+    writer = exitstats.Web100StatsWriter('server/', flush_bytes=1000,
+                                         flush_seconds=10)
+    c1 = FakeConnection()
+    c1.cid = 1234
+    c1.setall({"RemAddress": "5.4.3.2", "LocalAddress": "1.2.3.4",
+               "DataBytesOut": 0, "DataBytesIn": 0})
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100'
+    remove_file(logdir, logname)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      writer.logConnection(c1)
+      self.assertEqual(os.stat(logdir + logname).st_size, 0)
+      writer.flushLogs(time.time())
+      self.assertEqual(os.stat(logdir + logname).st_size, 0)
+      writer.flushLogs()
+      size = os.stat(logdir + logname).st_size
+      self.assertTrue(size > 0)
+      writer.logConnection(c1)
+      writer.closeLogs()
+      self.assertTrue(os.stat(logdir + logname).st_size > size)
+    remove_file(logdir, logname)
+
+
+class TestCompression(unittest.TestCase):
+
+  def logAndRead(self, compression, suffix, decompress):
+    writer = exitstats.Web100StatsWriter('server/', compression=compression)
+    c1 = FakeConnection()
+    c1.cid = 1234
+    c1.setall({"RemAddress": "5.4.3.2", "LocalAddress": "1.2.3.4",
+               "DataBytesOut": 0, "DataBytesIn": 0})
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100' + suffix
+    remove_file(logdir, logname)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+        writer.logConnection(c1)
+      # The hour rollover finalizes the stream.
+      with freeze_time("2014-02-23 11:00:01", tz_offset=0):
+        writer.getLogFile(time.time())
+    writer.closeLogs()
+    contents = decompress(logdir + logname)
+    remove_file(logdir, logname)
+    remove_file(logdir, '20140223T11:00:00Z_ALL0.web100' + suffix)
+    self.assertEqual(contents.splitlines(), [
+        'K: cid PollTime LocalAddress RemAddress DataBytesOut DataBytesIn',
+        'C: 1234 2014-02-23-10:23:34Z 1.2.3.4 5.4.3.2 0 0'])
+
+  def testGzip(self):
+    self.logAndRead('gzip', '.gz', lambda name: gzip.open(name).read())
+
+  def testZstd(self):
+    if exitstats.zstandard is None:
+      print('skipping zstd test, because zstandard is not installed.')
+      return
+    def decompress(name):
+      reader = exitstats.zstandard.ZstdDecompressor().stream_reader(
+          open(name, 'rb'))
+      return reader.read(1 << 20)
+    self.logAndRead('zstd', '.zst', decompress)
+
+  def testBinaryFormat(self):
+    writer = exitstats.Web100StatsWriter('server/', compression='gzip',
+                                         log_format='binary')
+    c1 = FakeConnection()
+    c1.cid = 1234
+    c1.setall({"RemAddress": "5.4.3.2", "LocalAddress": "1.2.3.4",
+               "DataBytesOut": 7, "DataBytesIn": 0})
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100b.gz'
+    remove_file(logdir, logname)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+        writer.logConnection(c1)
+        writer.logConnection(c1)
+    writer.closeLogs()
+    columns = exitstats.web100bin.readColumns(logdir + logname)
+    remove_file(logdir, logname)
+    self.assertEqual(list(columns['cid']), [1234, 1234])
+    self.assertEqual(list(columns['DataBytesOut']), [7, 7])
+
+  def testSchemaChange(self):
+    writer = exitstats.Web100StatsWriter('server/', log_format='binary')
+    snap = {"RemAddress": "5.4.3.2", "LocalAddress": "1.2.3.4",
+            "DataBytesOut": 7, "DataBytesIn": 0}
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100b'
+    remove_file(logdir, logname)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+        writer.logSnapshot(1, snap)
+        writer.logSnapshot(2, dict(snap, MinRTT=5))
+        writer.logSnapshot(3, dict(snap, MinRTT=6))
+    writer.closeLogs()
+    data = open(logdir + logname, 'rb').read()
+    remove_file(logdir, logname)
+    segments = exitstats.web100bin.readSegments(data)
+    self.assertEqual([list(s['cid']) for s in segments], [[1], [2, 3]])
+    self.assertFalse('MinRTT' in segments[0].dtype.names)
+    self.assertEqual(list(segments[1]['MinRTT']), [5, 6])
+
+  def testUnknownCompression(self):
+    with self.assertRaises(ValueError):
+      exitstats.Web100StatsWriter('server/', compression='lzw')
+
+
+class TestRecordStream(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testSubscriberReceivesLoggedRecords(self):
+    path = os.path.join(self.tmpdir, 'records.sock')
+    stream = closebus.Publisher(path, encode=exitstats.recordJson,
+                                stream='records')
+    writer = exitstats.Web100StatsWriter('server/', record_stream=stream)
+    c1 = FakeConnection()
+    c1.cid = 1234
+    c1.setall({"RemAddress": "5.4.3.2", "LocalAddress": "1.2.3.4",
+               "DataBytesOut": 7, "DataBytesIn": 0})
+    logdir = '2014/02/23/server/'
+    logname = '20140223T10:00:00Z_ALL0.web100'
+    remove_file(logdir, logname)
+    with EnvironmentVarGuard() as env:
+      env.set('SIDESTREAM_USE_LOCAL_IP', 'False')
+      with freeze_time("2014-02-23 10:23:34", tz_offset=0):
+        # Nobody is subscribed, so nothing is kept for the stream.
+        writer.logConnection(c1)
+        self.assertEqual(writer.streamed, [])
+        subscriber = closebus.subscribe(path, decode=json.loads)
+        writer.flushLogs(time.time())
+        writer.logConnection(c1)
+        writer.flushLogs(time.time())
+    writer.closeLogs()
+    remove_file(logdir, logname)
+    records = subscriber.receive(1)
+    self.assertEqual(records, [{
+        "cid": 1234, "PollTime": 1393151014.0, "RemAddress": "5.4.3.2",
+        "LocalAddress": "1.2.3.4", "DataBytesOut": 7, "DataBytesIn": 0}])
+    stream.close()
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -19,19 +19,31 @@
 # TODO(joshb): this is for experimental use only. The next step is to replace
 # the old wrapper with this one.
 
+import collections
+import fcntl
 import heapq
 import multiprocessing
 import optparse
 import os
 import random
 import re
+import socket
 import subprocess
 import sys
 import time
 
 import platform
+import prometheus_client as prom
+
+import closebus
+import pollsched
+import sockdiag
+
+# Exceptions raised by reads from a connection that has gone away.
+READ_ERRORS = (sockdiag.error,)
 try:
     import Web100
+    READ_ERRORS += (Web100.error,)
 except ImportError:
     print "Error importing web100"
 
@@ -58,6 +70,18 @@ WEB100_STATE_CLOSED = 1
 WEB100_IPV4 = 1
 # Base source port to use when running traceroute
 PARIS_TRACEROUTE_SOURCE_PORT_BASE = 33457
+# Maximum number of closed connections waiting for a worker (more will be
+# discarded), and how long after it closed a connection may still be
+# tracerouted.
+MAX_PENDING_TRACEROUTES = 1000
+MAX_TRACEROUTE_WAIT_SECONDS = 60
+# Remember this many recently tracerouted networks, whose connections wait
+# behind those to other networks.
+KNOWN_NETWORKS_CAPACITY = 65536
+# Estimated probe packets sent by one exhaustive paris-traceroute: up to 30
+# hops, with the 6 probes per hop that its multipath detection needs at
+# least to rule out a second next hop.
+PROBES_PER_TRACEROUTE = 180
 # Do not traceroute to an IP more than once in this many seconds. Randomness
 # added to prevent pattern propagation in the face of portscans and
 # rumplestiltskin attacks, but the wait time will always be a random number
@@ -65,6 +89,8 @@ PARIS_TRACEROUTE_SOURCE_PORT_BASE = 33457
 MIN_IP_CACHE_TIME_SECONDS = 30
 MEAN_IP_CACHE_TIME_SECONDS = 120
 MAX_IP_CACHE_TIME_SECONDS = 600
+# Remember at most this many recently tracerouted addresses.
+IP_CACHE_CAPACITY = 65536
 
 # Don't traceroute to these networks.
 # TODO(joshb): would be nice to use IP address library, but it isn't installed
@@ -74,8 +100,72 @@ IGNORE_IPV4_NETS = (
   '128.112.139.', # PLC control
 )
 
+# Metrics of the scans for closed connections.
+scan_duration = prom.Histogram(
+    'sidestream_traceroute_scan_duration_seconds',
+    'Time taken to scan the connections for closed ones',
+    buckets=(0.001, 0.01, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+scan_connections = prom.Gauge(
+    'sidestream_traceroute_scan_connections',
+    'Connections seen by the last scan, by state: open, closed but handled '
+    'by an earlier scan, newly closed, and selected for traceroute',
+    ['state'])
+cache_entries = prom.Gauge('sidestream_traceroute_cache_entries',
+                           'Addresses in the recent address cache')
+cache_evictions = prom.Counter(
+    'sidestream_traceroute_cache_eviction_count',
+    'Count of addresses evicted from the full recent address cache')
+cache_lookups = prom.Counter(
+    'sidestream_traceroute_cache_lookup_count',
+    'Count of recent address cache lookups, by result, as of the last poll',
+    ['result'])
+traceroute_requests = prom.Counter(
+    'sidestream_traceroute_request_count',
+    'Count of traceroute requests, by what happened to them', ['event'])
+throttled_requests = prom.Counter(
+    'sidestream_traceroute_throttled_count',
+    'Count of times traceroutes that could have started waited for a budget, '
+    'by budget', ['budget'])
+pending_traceroutes = prom.Gauge('sidestream_traceroute_pending_requests',
+                                 'Traceroute requests waiting for a worker')
+
 optparser = optparse.OptionParser()
 optparser.add_option('-l', '--logpath', default='/tmp', help='directory to log to')
+optparser.add_option('--min-interval', type='float', default=1,
+                     help='minimum seconds between polls')
+optparser.add_option('--max-interval', type='float', default=10,
+                     help='maximum seconds between polls')
+optparser.add_option('--busy-missed-closes', type='int', default=10,
+                     help='missed closes per poll that shorten the interval')
+optparser.add_option('--slow-poll-fraction', type='float', default=0.2,
+                     help='fraction of the interval a poll must take to '
+                     'shorten it')
+optparser.add_option('--source', default='web100',
+                     help='connection source: web100 or sockdiag')
+optparser.add_option('--close-events', default=closebus.DEFAULT_PATH,
+                     help='socket to receive close events from exitstats on, '
+                     'or empty to always poll')
+optparser.add_option('--prometheus-port', type='int', default=9091,
+                     help='port to export metrics on')
+optparser.add_option('--ip-cache-size', type='int', default=IP_CACHE_CAPACITY,
+                     help='maximum number of recent addresses to remember')
+optparser.add_option('--executor', default='pool',
+                     help='how to run traceroutes: pool, of worker processes, '
+                     'or subprocess, run directly')
+optparser.add_option('--max-workers', type='int', default=MAX_WORKERS,
+                     help='maximum number of simultaneous traceroutes')
+optparser.add_option('--traceroutes-per-second', type='float', default=0,
+                     help='maximum traceroutes started per second, on '
+                     'average, or 0 for no limit')
+optparser.add_option('--probes-per-second', type='float', default=0,
+                     help='maximum estimated probe packets sent per second, '
+                     'on average, or 0 for no limit')
+optparser.add_option('--probes-per-traceroute', type='float',
+                     default=PROBES_PER_TRACEROUTE,
+                     help='estimated probe packets sent per traceroute')
+optparser.add_option('--aggregate', action='store_true', default=False,
+                     help='traceroute to one address per /24 or /48 network '
+                     'at a time')
 
 
 def log_worker(message):
@@ -92,16 +182,11 @@ def make_log_file_name(log_file_root, log_time, mlab_hostname,
   return log_file
 
 
-# Try to run paris-traceroute and log output to a file. We assume any
-# errors are transient (Eg, temporarily out of disk space), so do not
-# crash if the run fails.
-def run_worker(log_file_root, log_time, mlab_hostname, traceroute_port,
-               remote_ip, remote_port, local_ip, local_port):
-  os.nice(WORKER_NICE)
-  command = (
-    TIMEOUT_BIN,
-    str(WORKER_TIMEOUT) + 's',
-    PARIS_TRACEROUTE_BIN,
+# Return the paris-traceroute command line for a connection.
+def traceroute_command(traceroute_port, remote_ip, remote_port,
+                       traceroute_bin=None):
+  return (
+    traceroute_bin or PARIS_TRACEROUTE_BIN,
     '--algo=exhaustive',
     '-picmp',
     '-s',
@@ -109,8 +194,12 @@ def run_worker(log_file_root, log_time, mlab_hostname, traceroute_port,
     '-d',
     str(remote_port),
     remote_ip)
-  log_command = ' '.join(command)
-  log_worker(log_command)
+
+
+# Open the log file for a traceroute, creating its directory.  Returns None
+# if it cannot be opened.
+def open_log_file(log_file_root, log_time, mlab_hostname,
+                  remote_ip, remote_port, local_ip, local_port):
   log_file_name = make_log_file_name(
     log_file_root, log_time, mlab_hostname,
     remote_ip, remote_port, local_ip, local_port)
@@ -123,11 +212,27 @@ def run_worker(log_file_root, log_time, mlab_hostname, traceroute_port,
       pass
   if not os.path.exists(log_file_dir):
     log_worker('cannot create %s' % log_file_dir)
-    return False
+    return None
   try:
-    log_file = open(log_file_name, 'w')
+    return open(log_file_name, 'w')
   except IOError:
     log_worker('cannot open log file %s' % log_file_name)
+    return None
+
+
+# Try to run paris-traceroute and log output to a file. We assume any
+# errors are transient (Eg, temporarily out of disk space), so do not
+# crash if the run fails.
+def run_worker(log_file_root, log_time, mlab_hostname, traceroute_port,
+               remote_ip, remote_port, local_ip, local_port):
+  os.nice(WORKER_NICE)
+  command = (TIMEOUT_BIN, str(WORKER_TIMEOUT) + 's') + traceroute_command(
+    traceroute_port, remote_ip, remote_port)
+  log_command = ' '.join(command)
+  log_worker(log_command)
+  log_file = open_log_file(log_file_root, log_time, mlab_hostname,
+                           remote_ip, remote_port, local_ip, local_port)
+  if log_file is None:
     return False
   try:
     returncode = subprocess.call(command, stdout=log_file)
@@ -141,17 +246,45 @@ def run_worker(log_file_root, log_time, mlab_hostname, traceroute_port,
   return True
 
 
+# Return the /24 (IPv4) or /48 (IPv6) network of an address.
+def network(address):
+  if ':' in address:
+    try:
+      packed = socket.inet_pton(socket.AF_INET6, address)
+    except socket.error:
+      return address
+    return socket.inet_ntop(socket.AF_INET6, packed[:6] + '\0' * 10) + '/48'
+  return address.rsplit('.', 1)[0] + '.0/24'
+
+
 # Test if an IP address has been seen within the timeout period.
+#
+# At most capacity addresses are remembered.  Adding another evicts the one
+# that would expire first, so a flood of unique addresses only shortens how
+# long each is remembered.  Expired addresses are no longer cached, but are
+# only removed by expire(), which should be called once per poll.  With
+# aggregate, addresses are remembered by network (/24 for IPv4, /48 for
+# IPv6), so that only one address per network is tracerouted.
 class RecentIPAddressCache(object):
 
-  def __init__(self, expected_cache_timeout, min_wait, max_wait):
+  def __init__(self, expected_cache_timeout, min_wait, max_wait,
+               capacity=IP_CACHE_CAPACITY, aggregate=False):
+    if capacity < 1:
+      raise ValueError('cache capacity must be at least 1: %s' % capacity)
     self.expected_cache_timeout = expected_cache_timeout
     self.min_wait = min_wait
     self.max_wait = max_wait
-    # The cache maps addresses to expiration times.
+    self.capacity = capacity
+    self.aggregate = aggregate
+    # The cache maps keys to expiration times.
     self.cache = {}
-    # The heap holds (time, address) pairs, with the lowest time on top.
+    # The heap holds (time, key) pairs, with the lowest time on top.  Pairs
+    # whose time is no longer that of the key in the cache are stale, and are
+    # skipped.
     self.heap = []
+    # Lookups since the last expire(), which exports them.
+    self.hits = 0
+    self.misses = 0
 
   # Calculate a new random expiration time. It should be memoryless, but we're
   # willing to deviate from that requirement to prevent absurdly long or short
@@ -160,61 +293,421 @@ class RecentIPAddressCache(object):
     return max(self.min_wait, min(self.max_wait,
         random.expovariate(1.0/self.expected_cache_timeout)))
 
-  # Expire all addresses up to 2 cache timeout periods ago.
-  def _expire(self, now):
-    expired = []
-    while self.heap and self.heap[0][0] < now:
-      expired.append(heapq.heappop(self.heap))
-    for _, key in expired:
+  # Return the key an address is cached by.
+  def _key(self, address):
+    if not self.aggregate:
+      return address
+    return network(address)
+
+  # Remove the entry on top of the heap, if it is not stale.
+  def _pop(self):
+    expiration, key = heapq.heappop(self.heap)
+    if self.cache.get(key) == expiration:
       del self.cache[key]
+      return True
+    return False
 
-  # Add an IP to the cache, if it isn't there already.
+  # Remove all expired addresses.
+  def expire(self, now=None):
+    now = time.time() if now is None else now
+    while self.heap and self.heap[0][0] < now:
+      self._pop()
+    cache_entries.set(len(self.cache))
+    cache_lookups.labels('hit').inc(self.hits)
+    cache_lookups.labels('miss').inc(self.misses)
+    self.hits = self.misses = 0
+
+  def _lookup(self, key, now):
+    expiration = self.cache.get(key)
+    if expiration is not None and expiration >= now:
+      self.hits += 1
+      return True
+    self.misses += 1
+    return False
+
+  # Add an IP to the cache, if it isn't there already.  Returns true if it
+  # was added.
   def add(self, address):
-    if not self.cached(address):
-      # Not in the cache or stale entry, so add a new entry.
-      now = time.time()
-      expiration = now + self._new_wait_time()
-      self.cache[address] = None
-      heapq.heappush(self.heap, (expiration, address))
+    now = time.time()
+    key = self._key(address)
+    if self._lookup(key, now):
+      return False
+    if key not in self.cache:
+      while len(self.cache) >= self.capacity:
+        if self._pop():
+          cache_evictions.inc()
+    expiration = now + self._new_wait_time()
+    self.cache[key] = expiration
+    heapq.heappush(self.heap, (expiration, key))
+    return True
 
   # Returns true if an address was seen too recently.
   def cached(self, address):
-    now = time.time()
-    self._expire(now)
-    return address in self.cache
+    return self._lookup(self._key(address), time.time())
 
 
 # Manage a pool of worker subprocessors to run traceoutes in.
 class ParisTraceroutePool(object):
 
-  def __init__(self, log_file_root):
-    self.pool = multiprocessing.Pool(processes=MAX_WORKERS)
+  def __init__(self, log_file_root, max_workers=MAX_WORKERS):
+    self.pool = multiprocessing.Pool(processes=max_workers)
     self.log_file_root = log_file_root
+    self.max_workers = max_workers
+    # (result, traceroute port) of the running workers, and the ports of the
+    # workers that finished since the last call to finished_ports.
     self.busy = []
+    self.finished = []
+
+  def _reap(self):
+    running = []
+    for result, port in self.busy:
+      if result.ready():
+        self.finished.append(port)
+      else:
+        running.append((result, port))
+    self.busy = running
 
   def busy_workers_count(self):
-    self.busy = [result for result in self.busy if not result.ready()]
+    self._reap()
     return len(self.busy)
 
+  # Return the traceroute ports of the workers that finished since the last
+  # call.
+  def finished_ports(self):
+    self._reap()
+    finished, self.finished = self.finished, []
+    return finished
+
   # Return true if we have capacity to run more traceroutes.
   def free(self):
-    return self.busy_workers_count() < MAX_WORKERS
+    return self.busy_workers_count() < self.max_workers
+
+  # Return how many more traceroutes can start, as of the last reap.
+  def free_workers_count(self):
+    return max(0, self.max_workers - len(self.busy))
 
   # Return true if no workers running.
   def idle(self):
     return self.busy_workers_count() == 0
 
+  # Return when the next running traceroute times out, or None.  The timeout
+  # binary kills the pool's traceroutes itself.
+  def next_deadline(self):
+    return None
+
   # Return true if we have spare capacity and we scheduled a traceroute.
+  # Finished workers are only reaped if all seemed busy.
   def run_async(self, log_time, mlab_hostname, traceroute_port,
                 remote_ip, remote_port, local_ip, local_port):
-    if self.free():
-      self.busy.append(self.pool.apply_async(run_worker,
+    if self.free_workers_count() or self.free():
+      self.busy.append((self.pool.apply_async(run_worker,
         args=(self.log_file_root, log_time, mlab_hostname, traceroute_port,
-              remote_ip, remote_port, local_ip, local_port)))
+              remote_ip, remote_port, local_ip, local_port)),
+        traceroute_port))
       return True
     return False
 
 
+# Lower the priority of a child process, and have the descriptors it
+# inherited, other than stdin, stdout and stderr, close when it executes the
+# traceroute.  Popen's close_fds closes every possible descriptor, one at a
+# time, which takes longer than the fork.
+def setup_child(nice):
+  os.nice(nice)
+  try:
+    fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+  except OSError:
+    fds = range(3, subprocess.MAXFD)
+  for fd in fds:
+    if fd > 2:
+      try:
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+      except (IOError, OSError):
+        pass
+
+
+# Run traceroutes as subprocesses of this process, without a pool of worker
+# processes that only wait for them.  Each running traceroute costs a Popen
+# and an open log file, so max_workers can be far above MAX_WORKERS.
+# paris-traceroute writes straight to its log file, and is killed if it runs
+# longer than timeout seconds.  Finished traceroutes are reaped, and those
+# past their timeout killed, whenever the number of busy workers is asked
+# for, so callers should ask again by next_deadline(); see dispatch_wait.
+class TracerouteExecutor(object):
+
+  def __init__(self, log_file_root, max_workers=MAX_WORKERS,
+               timeout=WORKER_TIMEOUT, nice=WORKER_NICE, traceroute_bin=None,
+               clock=time.time):
+    self.log_file_root = log_file_root
+    self.max_workers = max_workers
+    self.timeout = timeout
+    self.nice = nice
+    self.traceroute_bin = traceroute_bin
+    self.clock = clock
+    # (process, log file, traceroute port, deadline) of the running
+    # traceroutes, and the ports of those that finished since the last call
+    # to finished_ports.
+    self.busy = []
+    self.finished = []
+
+  def _reap(self):
+    now = self.clock()
+    running = []
+    for job in self.busy:
+      process, log_file, port, deadline = job
+      returncode = process.poll()
+      if returncode is None and now > deadline:
+        log_worker('%s timed out' % ' '.join(process.args))
+        process.kill()
+        returncode = process.wait()
+      if returncode is None:
+        running.append(job)
+        continue
+      log_file.close()
+      if returncode != 0:
+        log_worker('%s returned %d' % (' '.join(process.args), returncode))
+      self.finished.append(port)
+    self.busy = running
+
+  def busy_workers_count(self):
+    self._reap()
+    return len(self.busy)
+
+  # Return the traceroute ports of the workers that finished since the last
+  # call.
+  def finished_ports(self):
+    self._reap()
+    finished, self.finished = self.finished, []
+    return finished
+
+  # Return true if we have capacity to run more traceroutes.
+  def free(self):
+    return self.busy_workers_count() < self.max_workers
+
+  # Return how many more traceroutes can start, as of the last reap.
+  def free_workers_count(self):
+    return max(0, self.max_workers - len(self.busy))
+
+  # Return true if no workers running.
+  def idle(self):
+    return self.busy_workers_count() == 0
+
+  # Return when the next running traceroute times out, or None.
+  def next_deadline(self):
+    if not self.busy:
+      return None
+    return min(deadline for _, _, _, deadline in self.busy)
+
+  # Return true if we had spare capacity.  A traceroute that could not be
+  # started is logged, and reported finished at once.  Finished traceroutes
+  # are only reaped if all workers seemed busy.
+  def run_async(self, log_time, mlab_hostname, traceroute_port,
+                remote_ip, remote_port, local_ip, local_port):
+    if not self.free_workers_count() and not self.free():
+      return False
+    command = traceroute_command(traceroute_port, remote_ip, remote_port,
+                                 self.traceroute_bin)
+    log_worker(' '.join(command))
+    log_file = open_log_file(self.log_file_root, log_time, mlab_hostname,
+                             remote_ip, remote_port, local_ip, local_port)
+    if log_file is None:
+      self.finished.append(traceroute_port)
+      return True
+    nice = self.nice
+    try:
+      process = subprocess.Popen(command, stdout=log_file,
+                                 preexec_fn=lambda: setup_child(nice))
+    except OSError:
+      log_worker('could not run %s' % ' '.join(command))
+      log_file.close()
+      self.finished.append(traceroute_port)
+      return True
+    process.args = command
+    self.busy.append((process, log_file, traceroute_port,
+                      self.clock() + self.timeout))
+    return True
+
+  # Kill the running traceroutes.
+  def close(self):
+    for process, log_file, _, _ in self.busy:
+      if process.poll() is None:
+        process.kill()
+        process.wait()
+      log_file.close()
+    self.busy = []
+
+
+# Lease source ports to traceroutes, so that no two running traceroutes use
+# the same one.  The lowest free port is leased first.
+class SourcePortAllocator(object):
+
+  def __init__(self, base=PARIS_TRACEROUTE_SOURCE_PORT_BASE,
+               count=MAX_WORKERS):
+    self.free = range(base, base + count)
+    self.leased = set()
+
+  # Return a free port, or None if all are leased.
+  def lease(self):
+    if not self.free:
+      return None
+    port = heapq.heappop(self.free)
+    self.leased.add(port)
+    return port
+
+  def release(self, port):
+    if port in self.leased:
+      self.leased.remove(port)
+      heapq.heappush(self.free, port)
+
+
+# Limit the rate of a cost, such as traceroutes or probe packets, to rate per
+# second on average, and burst at once.
+class TokenBucket(object):
+
+  def __init__(self, rate, burst=None, clock=time.time):
+    self.rate = rate
+    self.burst = max(rate, 1) if burst is None else burst
+    self.clock = clock
+    self.tokens = self.burst
+    self.last = clock()
+
+  def _refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  # Return true if cost can be taken now.
+  def available(self, cost=1):
+    self._refill()
+    return self.tokens >= cost
+
+  def take(self, cost=1):
+    self._refill()
+    self.tokens -= cost
+
+
+# Queue traceroutes to closed connections, and start them as workers and
+# source ports become free.
+#
+# Connections to networks that have not been tracerouted recently are started
+# before the others.  At most max_pending connections wait: a new one is
+# dropped if it would be last in line, otherwise the last one in line is.
+# Connections that have waited longer than max_age seconds since they closed
+# are dropped too.
+#
+# budgets is a list of (name, TokenBucket, cost of a traceroute), e.g. of
+# traceroutes or of probe packets.  Traceroutes wait until every budget has
+# room for them.
+class TracerouteScheduler(object):
+  # Priorities, in order.
+  NEW_NETWORK = 0
+  KNOWN_NETWORK = 1
+
+  def __init__(self, pool, mlab_hostname, ports=None,
+               max_pending=MAX_PENDING_TRACEROUTES,
+               max_age=MAX_TRACEROUTE_WAIT_SECONDS,
+               known_networks=KNOWN_NETWORKS_CAPACITY, budgets=(),
+               clock=time.time):
+    self.pool = pool
+    self.mlab_hostname = mlab_hostname
+    self.ports = ports or SourcePortAllocator()
+    self.max_pending = max_pending
+    self.max_age = max_age
+    self.budgets = budgets
+    self.clock = clock
+    # Pending connections, by priority, oldest first.
+    self.pending = (collections.deque(), collections.deque())
+    # Networks tracerouted recently, least recently first.
+    self.known = collections.OrderedDict()
+    self.known_capacity = known_networks
+    self.counters = dict(
+        (event, traceroute_requests.labels(event))
+        for event in ('queued', 'started', 'dropped', 'expired', 'completed'))
+
+  def __len__(self):
+    return len(self.pending[0]) + len(self.pending[1])
+
+  def _priority(self, remote_ip):
+    if network(remote_ip) in self.known:
+      return self.KNOWN_NETWORK
+    return self.NEW_NETWORK
+
+  def _remember(self, remote_ip):
+    net = network(remote_ip)
+    self.known.pop(net, None)
+    self.known[net] = True
+    if len(self.known) > self.known_capacity:
+      self.known.popitem(last=False)
+
+  # Queue closed connections, as (log_time, remote_ip, remote_port, local_ip,
+  # local_port) tuples.
+  def submit(self, connections):
+    for connection in connections:
+      priority = self._priority(connection[1])
+      if len(self) >= self.max_pending:
+        known = self.pending[self.KNOWN_NETWORK]
+        self.counters['dropped'].inc()
+        if priority == self.KNOWN_NETWORK or not known:
+          continue
+        known.pop()
+      self.pending[priority].append(connection)
+      self.counters['queued'].inc()
+    pending_traceroutes.set(len(self))
+
+  # Drop connections that waited too long, then start as many of the others
+  # as there are free workers and ports for.  The pool reaps its workers once,
+  # in finished_ports.
+  def dispatch(self):
+    for port in self.pool.finished_ports():
+      self.ports.release(port)
+      self.counters['completed'].inc()
+    deadline = self.clock() - self.max_age
+    for queue in self.pending:
+      while queue and queue[0][0] < deadline:
+        queue.popleft()
+        self.counters['expired'].inc()
+    free = self.pool.free_workers_count()
+    while free > 0:
+      queue = self._next_queue()
+      if queue is None:
+        break
+      budget = self._exhausted_budget()
+      if budget is not None:
+        throttled_requests.labels(budget).inc()
+        break
+      port = self.ports.lease()
+      if port is None:
+        break
+      log_time, remote_ip, remote_port, local_ip, local_port = queue[0]
+      if not self.pool.run_async(log_time, self.mlab_hostname, port,
+                                 remote_ip, remote_port, local_ip,
+                                 local_port):
+        self.ports.release(port)
+        break
+      queue.popleft()
+      free -= 1
+      self._remember(remote_ip)
+      for _, bucket, cost in self.budgets:
+        bucket.take(cost)
+      self.counters['started'].inc()
+    pending_traceroutes.set(len(self))
+
+  # Return the highest priority queue with connections in it, or None.
+  def _next_queue(self):
+    for queue in self.pending:
+      if queue:
+        return queue
+    return None
+
+  # Return the name of a budget without room for another traceroute, or None.
+  def _exhausted_budget(self):
+    for name, bucket, cost in self.budgets:
+      if not bucket.available(cost):
+        return name
+    return None
+
+
 # return true if should ignore an IP address (eg localhost).
 def ignore_ip(ip):
   for net in IGNORE_IPV4_NETS:
@@ -223,31 +716,138 @@ def ignore_ip(ip):
   return False
 
 
+# return true if a closed connection's remote IP should be tracerouted, and if
+# so remember it as recently tracerouted.
+def should_traceroute(recent_ip_cache, remote_ip, address_type):
+  return (address_type == WEB100_IPV4 and
+          not ignore_ip(remote_ip) and
+          recent_ip_cache.add(remote_ip))
+
+
+# The connections seen by the previous scan for closed connections.
+#   handled: (cid, StartTimeSec) of the connections found closed, which need
+#       not be read again.  Web100 reuses cids, so a cid alone is not enough.
+#   open: cids found open.
+#   new_closes: connections found newly closed by the last scan.
+#   vanished: connections open on the scan before the last, and gone without
+#       being seen closed: closes that were missed because the kernel reaped
+#       them between scans.
+class ScanState(object):
+
+  def __init__(self):
+    self.handled = set()
+    self.open = set()
+    self.new_closes = 0
+    self.vanished = 0
+
+
 # return list of recently closed connections, not already seen.
-def uncached_closed_connections(agent, recent_ip_cache):
+#
+# Only State is read from open connections.  Closed connections are read in a
+# single snapshot, unless state, a ScanState, shows that the previous scan
+# found them closed already, which takes reading their StartTimeSec.  Closed
+# connections stay visible until they are reaped, so without state every scan
+# reads them again.  Connections whose reads raise one of read_errors have gone
+# away, and are skipped.
+def uncached_closed_connections(agent, recent_ip_cache, state=None,
+                                read_errors=READ_ERRORS):
+   start = time.time()
    closed_connections = []
+   closed_keys = set()
+   open_cids = set()
+   seen = set()
+   handled = state.handled if state is not None else ()
+   scanned = already_handled = 0
    for connection in agent.all_connections():
+     scanned += 1
+     seen.add(connection.cid)
      try:
-       state = connection.read('State')
-       remote_ip = connection.read('RemAddress')
-       remote_port = connection.read('RemPort')
-       local_ip = connection.read('LocalAddress')
-       local_port = connection.read('LocalPort')
-       address_type = connection.read('LocalAddressType')
-     except Web100.error:
+       if connection.read('State') != WEB100_STATE_CLOSED:
+         open_cids.add(connection.cid)
+         continue
+       key = (connection.cid, connection.read('StartTimeSec'))
+       closed_keys.add(key)
+       if key in handled:
+         already_handled += 1
+         continue
+       snap = connection.readall()
+     except read_errors:
        continue
 
-     if (state == WEB100_STATE_CLOSED and
-         address_type == WEB100_IPV4 and
-         not ignore_ip(remote_ip) and
-         not recent_ip_cache.cached(remote_ip)):
-       recent_ip_cache.add(remote_ip)
+     if should_traceroute(recent_ip_cache, snap['RemAddress'],
+                          snap['LocalAddressType']):
        log_time = time.time()
        closed_connections.append((
-           log_time, remote_ip, remote_port, local_ip, local_port))
+           log_time, snap['RemAddress'], snap['RemPort'],
+           snap['LocalAddress'], snap['LocalPort']))
+   new_closes = len(closed_keys) - already_handled
+   if state is not None:
+     state.vanished = len(state.open - seen)
+     state.handled = closed_keys
+     state.open = open_cids
+     state.new_closes = new_closes
+   scan_duration.observe(time.time() - start)
+   scan_connections.labels('open').set(len(open_cids))
+   scan_connections.labels('handled').set(already_handled)
+   scan_connections.labels('closed').set(new_closes)
+   scan_connections.labels('selected').set(len(closed_connections))
+   return closed_connections
+
+
+# return list of closed connections from close events, not already seen.
+def uncached_close_events(events, recent_ip_cache):
+   closed_connections = []
+   for e in events:
+     if should_traceroute(recent_ip_cache, e.RemAddress, e.LocalAddressType):
+       closed_connections.append((
+           e.time, e.RemAddress, e.RemPort, e.LocalAddress, e.LocalPort))
    return closed_connections
 
 
+# Return the connection source with the given name.
+def new_agent(source):
+  if source == 'sockdiag':
+    return sockdiag.SockDiagAgent()
+  if source == 'web100':
+    return Web100.Web100Agent()
+  optparser.error('unknown connection source %s' % source)
+
+
+# Return the traceroute executor with the given name.
+def new_executor(executor, log_file_root, max_workers):
+  if executor == 'subprocess':
+    return TracerouteExecutor(log_file_root, max_workers=max_workers)
+  if executor == 'pool':
+    return ParisTraceroutePool(log_file_root, max_workers)
+  optparser.error('unknown traceroute executor %s' % executor)
+
+
+# Return how long the main loop may wait, up to limit seconds, before it
+# dispatches again: to start waiting traceroutes, check at least once a
+# second, and to kill a traceroute at its timeout.
+def dispatch_wait(pool, traceroutes, limit, clock=time.time):
+  if len(traceroutes):
+    limit = min(limit, 1)
+  deadline = pool.next_deadline()
+  if deadline is not None:
+    limit = min(limit, max(0, deadline - clock()))
+  return limit
+
+
+# Return the traceroute budgets for the options, see TracerouteScheduler.
+def new_budgets(options, clock=time.time):
+  budgets = []
+  if options.traceroutes_per_second > 0:
+    budgets.append(('traceroutes', TokenBucket(
+        options.traceroutes_per_second, clock=clock), 1))
+  if options.probes_per_second > 0:
+    cost = options.probes_per_traceroute
+    budgets.append(('probes', TokenBucket(
+        options.probes_per_second,
+        burst=max(options.probes_per_second, cost), clock=clock), cost))
+  return budgets
+
+
 # Return short version (mlabN.xyzNN) of hostname, if an M-Lab host.
 # Otherwise return just hostname.
 def get_mlab_hostname():
@@ -260,17 +860,56 @@ def get_mlab_hostname():
 
 if __name__ == '__main__':
     (options, args) = optparser.parse_args()
+    if options.ip_cache_size < 1:
+      optparser.error('--ip-cache-size must be at least 1')
     mlab_hostname = get_mlab_hostname()
     recent_ip_cache = RecentIPAddressCache(MEAN_IP_CACHE_TIME_SECONDS,
                                            min_wait=MIN_IP_CACHE_TIME_SECONDS,
-                                           max_wait=MAX_IP_CACHE_TIME_SECONDS)
-    pool = ParisTraceroutePool(options.logpath)
-    agent = Web100.Web100Agent()
-
+                                           max_wait=MAX_IP_CACHE_TIME_SECONDS,
+                                           capacity=options.ip_cache_size,
+                                           aggregate=options.aggregate)
+    pool = new_executor(options.executor, options.logpath,
+                        options.max_workers)
+    traceroutes = TracerouteScheduler(
+        pool, mlab_hostname, SourcePortAllocator(count=options.max_workers),
+        budgets=new_budgets(options))
+    prom.start_http_server(options.prometheus_port)
+    # Poll more often while connections are closing quickly, and less often
+    # when idle.
+    scheduler = pollsched.AdaptiveInterval(
+        minimum=options.min_interval, maximum=options.max_interval,
+        busy_missed=options.busy_missed_closes,
+        slow_fraction=options.slow_poll_fraction)
+
+    # Prefer the close events published by exitstats, which scans the
+    # connections anyway.  Poll the connections ourselves only while there is
+    # no publisher.
+    subscriber = None
+    agent = None
+    scan = ScanState()
     while True:
-      connections = uncached_closed_connections(agent, recent_ip_cache)
-      for log_time, remote_ip, remote_port, local_ip, local_port in connections:
-          traceroute_port = PARIS_TRACEROUTE_SOURCE_PORT_BASE + pool.busy_workers_count()
-          pool.run_async(log_time, mlab_hostname, traceroute_port,
-                         remote_ip, remote_port, local_ip, local_port)
-      time.sleep(5)
+      start = time.time()
+      recent_ip_cache.expire(start)
+      if subscriber is None and options.close_events:
+        subscriber = closebus.subscribe(options.close_events)
+      if subscriber is not None:
+        events = subscriber.receive(
+            dispatch_wait(pool, traceroutes, options.max_interval))
+        if events is None:
+          subscriber = None
+        else:
+          traceroutes.submit(uncached_close_events(events, recent_ip_cache))
+        traceroutes.dispatch()
+        continue
+
+      if agent is None:
+        agent = new_agent(options.source)
+      connections = uncached_closed_connections(agent, recent_ip_cache, scan)
+      traceroutes.submit(connections)
+      traceroutes.dispatch()
+      interval = scheduler.update(scan.new_closes, time.time() - start,
+                                  scan.vanished)
+      next_poll = start + interval
+      while time.time() < next_poll:
+        time.sleep(dispatch_wait(pool, traceroutes, next_poll - time.time()))
+        traceroutes.dispatch()
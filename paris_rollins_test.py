@@ -9,6 +9,8 @@ import shutil
 import tempfile
 import time
 import unittest
+import closebus
+import prometheus_client as prom
 import paris_rollins as paris_rollins
 
 class ParisRollinsTestCase(unittest.TestCase):
@@ -73,6 +75,42 @@ class ParisRollinsTestCase(unittest.TestCase):
       self.assertTrue(cache.cached(ip))
       time.sleep(cache_timeout + .1)
 
+  def test_cache_capacity(self):
+    get = prom.REGISTRY.get_sample_value
+    evictions = get('sidestream_traceroute_cache_eviction_count') or 0
+    cache = paris_rollins.RecentIPAddressCache(60, 10, 600, capacity=100)
+    for i in range(1000):
+      self.assertTrue(cache.add('10.0.%d.%d' % (i // 256, i % 256)))
+    self.assertEqual(len(cache.cache), 100)
+    self.assertEqual(len(cache.heap), 100)
+    self.assertEqual(get('sidestream_traceroute_cache_eviction_count'),
+                     evictions + 900)
+    self.assertFalse(cache.add(cache.cache.keys()[0]))
+    self.assertRaises(ValueError, paris_rollins.RecentIPAddressCache,
+                      60, 10, 600, capacity=0)
+
+  def test_cache_batched_expiry(self):
+    cache = paris_rollins.RecentIPAddressCache(60, 60, 60)
+    cache.add('5.6.7.8')
+    cache.add('5.6.7.9')
+    now = time.time()
+    cache.expire(now)
+    self.assertEqual(len(cache.cache), 2)
+    cache.expire(now + 61)
+    self.assertEqual(cache.cache, {})
+    self.assertEqual(cache.heap, [])
+
+  def test_cache_aggregate(self):
+    cache = paris_rollins.RecentIPAddressCache(60, 60, 60, aggregate=True)
+    self.assertTrue(cache.add('5.6.7.8'))
+    self.assertFalse(cache.add('5.6.7.9'))
+    self.assertTrue(cache.add('5.6.8.8'))
+    self.assertTrue(cache.add('2001:db8:1:2::1'))
+    self.assertTrue(cache.cached('2001:db8:1:3::1'))
+    self.assertFalse(cache.cached('2001:db8:2::1'))
+    self.assertEqual(sorted(cache.cache),
+                     ['2001:db8:1::/48', '5.6.7.0/24', '5.6.8.0/24'])
+
   def test_cache_randomness(self):
     lo, av, hi = 1, 5, 100
     cache = paris_rollins.RecentIPAddressCache(av, lo, hi)
@@ -84,6 +122,251 @@ class ParisRollinsTestCase(unittest.TestCase):
     self.assertTrue(max(times) <= hi)
     self.assertTrue(max(times) > lo)
 
+  def test_uncached_close_events(self):
+    cache = paris_rollins.RecentIPAddressCache(60, 60, 60)
+    events = [
+        closebus.CloseEvent(1.5, 1, '1.2.3.4', 80, '5.6.7.8', 1234, 1),
+        closebus.CloseEvent(2.5, 2, '1.2.3.4', 80, '5.6.7.8', 1235, 1),
+        closebus.CloseEvent(3.5, 3, '1.2.3.4', 80, '127.0.0.1', 1236, 1),
+        closebus.CloseEvent(4.5, 4, '::1', 80, '2001:db8::1', 1237, 2)]
+    self.assertEqual(paris_rollins.uncached_close_events(events, cache),
+                     [(1.5, '5.6.7.8', 1234, '1.2.3.4', 80)])
+    self.assertTrue(cache.cached('5.6.7.8'))
+
+  def test_uncached_closed_connections(self):
+    class Connection(object):
+      def __init__(self, cid, state, remote_ip, start=100):
+        self.cid = cid
+        self.values = {'State': state, 'RemAddress': remote_ip, 'RemPort': 80,
+                       'LocalAddress': '1.2.3.4', 'LocalPort': 1234,
+                       'LocalAddressType': paris_rollins.WEB100_IPV4,
+                       'StartTimeSec': start}
+        self.reads = []
+      def read(self, name):
+        self.reads.append(name)
+        return self.values[name]
+      def readall(self):
+        self.reads.append(None)
+        return dict(self.values)
+
+    class Agent(object):
+      def all_connections(self):
+        return connections
+
+    closed = paris_rollins.WEB100_STATE_CLOSED
+    connections = [Connection(1, 5, '5.6.7.8'),
+                   Connection(2, closed, '5.6.7.9'),
+                   Connection(3, closed, '127.0.0.1')]
+    cache = paris_rollins.RecentIPAddressCache(60, 60, 60)
+    state = paris_rollins.ScanState()
+    self.assertEqual(
+        [c[1] for c in paris_rollins.uncached_closed_connections(
+            Agent(), cache, state)], ['5.6.7.9'])
+    self.assertEqual(state.handled, set([(2, 100), (3, 100)]))
+    self.assertEqual(state.open, set([1]))
+    self.assertEqual(state.new_closes, 2)
+    self.assertEqual([c.reads for c in connections],
+                     [['State'], ['State', 'StartTimeSec', None],
+                      ['State', 'StartTimeSec', None]])
+    # cid 1 is reaped without being seen closed.
+    del connections[0]
+    connections.append(Connection(4, closed, '5.6.7.10'))
+    self.assertEqual(
+        [c[1] for c in paris_rollins.uncached_closed_connections(
+            Agent(), cache, state)], ['5.6.7.10'])
+    self.assertEqual(state.handled, set([(2, 100), (3, 100), (4, 100)]))
+    self.assertEqual((state.new_closes, state.vanished), (1, 1))
+    self.assertEqual(connections[0].reads,
+                     ['State', 'StartTimeSec', None, 'State', 'StartTimeSec'])
+    # cid 2 is reused by a connection that closes before the next scan.
+    connections[0] = Connection(2, closed, '5.6.7.11', start=200)
+    self.assertEqual(
+        [c[1] for c in paris_rollins.uncached_closed_connections(
+            Agent(), cache, state)], ['5.6.7.11'])
+    self.assertEqual(state.handled, set([(2, 200), (3, 100), (4, 100)]))
+    self.assertEqual(state.new_closes, 1)
+
+  def test_source_port_allocator(self):
+    ports = paris_rollins.SourcePortAllocator(100, 3)
+    self.assertEqual([ports.lease() for _ in range(4)], [100, 101, 102, None])
+    ports.release(101)
+    ports.release(101)
+    self.assertEqual(ports.lease(), 101)
+    self.assertEqual(ports.lease(), None)
+
+  def test_traceroute_scheduler(self):
+    class Pool(object):
+      def __init__(self):
+        self.started = []
+        self.finished = []
+      def free_workers_count(self):
+        return 2 - len(self.started)
+      def finished_ports(self):
+        finished, self.finished = self.finished, []
+        return finished
+      def run_async(self, log_time, hostname, port, remote_ip, *args):
+        self.started.append((port, remote_ip))
+        return True
+
+    clock = [100.0]
+    pool = Pool()
+    scheduler = paris_rollins.TracerouteScheduler(
+        pool, 'test.host', paris_rollins.SourcePortAllocator(100, 2),
+        max_pending=3, max_age=60, clock=lambda: clock[0])
+
+    def connection(log_time, remote_ip):
+      return (log_time, remote_ip, 80, '1.2.3.4', 1234)
+    scheduler.submit([connection(100, '5.6.7.8'), connection(100, '5.6.7.9')])
+    scheduler.dispatch()
+    self.assertEqual(pool.started, [(100, '5.6.7.8'), (101, '5.6.7.9')])
+    # Connections to new networks go first, and push out known ones.
+    scheduler.submit([connection(100, '5.6.7.10'), connection(101, '5.6.7.11'),
+                      connection(102, '9.9.9.9'), connection(103, '8.8.8.8')])
+    self.assertEqual(len(scheduler), 3)
+    pool.started = []
+    pool.finished = [101]
+    scheduler.dispatch()
+    self.assertEqual(pool.started, [(101, '9.9.9.9')])
+    # The known network connection expires.
+    clock[0] = 161.5
+    pool.started = []
+    pool.finished = [100, 101]
+    scheduler.dispatch()
+    self.assertEqual(pool.started, [(100, '8.8.8.8')])
+    self.assertEqual(len(scheduler), 0)
+
+  def test_token_bucket(self):
+    clock = [0.0]
+    bucket = paris_rollins.TokenBucket(2, burst=4, clock=lambda: clock[0])
+    self.assertTrue(bucket.available(4))
+    bucket.take(3)
+    self.assertFalse(bucket.available(2))
+    clock[0] = 0.5
+    self.assertTrue(bucket.available(2))
+    clock[0] = 100
+    self.assertFalse(bucket.available(5))
+
+  def test_traceroute_budgets(self):
+    class Pool(object):
+      started = 0
+      def free_workers_count(self):
+        return 100
+      def finished_ports(self):
+        return []
+      def run_async(self, *args):
+        self.started += 1
+        return True
+
+    clock = [100.0]
+    pool = Pool()
+    options, _ = paris_rollins.optparser.parse_args(
+        ['--traceroutes-per-second=2', '--probes-per-second=200',
+         '--probes-per-traceroute=100'])
+    budgets = paris_rollins.new_budgets(options, clock=lambda: clock[0])
+    scheduler = paris_rollins.TracerouteScheduler(
+        pool, 'test.host', paris_rollins.SourcePortAllocator(100, 100),
+        budgets=budgets, clock=lambda: clock[0])
+    scheduler.submit([(100, '10.0.%d.1' % i, 80, '1.2.3.4', 1234)
+                      for i in range(10)])
+    throttled = prom.REGISTRY.get_sample_value(
+        'sidestream_traceroute_throttled_count', {'budget': 'traceroutes'})
+    scheduler.dispatch()
+    self.assertEqual(pool.started, 2)
+    self.assertEqual(prom.REGISTRY.get_sample_value(
+        'sidestream_traceroute_throttled_count', {'budget': 'traceroutes'}),
+                     (throttled or 0) + 1)
+    # The probe budget allows two traceroutes a second, too.
+    clock[0] += 1
+    scheduler.dispatch()
+    self.assertEqual(pool.started, 4)
+    clock[0] += 0.5
+    scheduler.dispatch()
+    self.assertEqual(pool.started, 5)
+
+  def stub(self, script):
+    name = os.path.join(self.tmpdir, 'stub')
+    with open(name, 'w') as f:
+      f.write('#!/bin/sh\n' + script + '\n')
+    os.chmod(name, 0755)
+    return name
+
+  def test_executor(self):
+    executor = paris_rollins.TracerouteExecutor(
+        self.tmpdir, max_workers=50,
+        traceroute_bin=self.stub('echo "$@"; nice'))
+    for port in range(50):
+      self.assertTrue(executor.run_async(0, 'test.host', port, '5.6.7.8',
+                                         port, '1.2.3.4', 1234))
+    while not executor.idle():
+      time.sleep(0.01)
+    self.assertEqual(sorted(executor.finished_ports()), range(50))
+    log = paris_rollins.make_log_file_name(self.tmpdir, 0, 'test.host',
+                                           '5.6.7.8', 7, '1.2.3.4', 1234)
+    self.assertEqual(open(log).read().splitlines(),
+                     ['--algo=exhaustive -picmp -s 7 -d 7 5.6.7.8',
+                      str(paris_rollins.WORKER_NICE)])
+
+  def test_executor_timeout(self):
+    clock = [0.0]
+    executor = paris_rollins.TracerouteExecutor(
+        self.tmpdir, max_workers=1, timeout=5,
+        traceroute_bin=self.stub('exec sleep 60'), clock=lambda: clock[0])
+    self.assertTrue(executor.run_async(0, 'test.host', 7, '5.6.7.8', 80,
+                                       '1.2.3.4', 1234))
+    self.assertFalse(executor.run_async(0, 'test.host', 8, '5.6.7.9', 80,
+                                        '1.2.3.4', 1234))
+    self.assertEqual(executor.finished_ports(), [])
+    self.assertEqual(executor.next_deadline(), 5)
+    clock[0] = 6
+    self.assertEqual(executor.finished_ports(), [7])
+    self.assertTrue(executor.idle())
+    self.assertEqual(executor.next_deadline(), None)
+
+  def test_dispatch_wait(self):
+    class Pool(object):
+      deadline = None
+      def next_deadline(self):
+        return self.deadline
+
+    pool = Pool()
+    clock = lambda: 100.0
+    self.assertEqual(paris_rollins.dispatch_wait(pool, [], 30, clock), 30)
+    # Waiting traceroutes are dispatched at least once a second.
+    self.assertEqual(paris_rollins.dispatch_wait(pool, [1], 30, clock), 1)
+    # Running traceroutes are killed at their timeout.
+    pool.deadline = 104.5
+    self.assertEqual(paris_rollins.dispatch_wait(pool, [], 30, clock), 4.5)
+    self.assertEqual(paris_rollins.dispatch_wait(pool, [], 2, clock), 2)
+    pool.deadline = 99.0
+    self.assertEqual(paris_rollins.dispatch_wait(pool, [], 30, clock), 0)
+
+  def test_dispatch_reaps_once(self):
+    executor = paris_rollins.TracerouteExecutor(
+        self.tmpdir, max_workers=10, traceroute_bin=self.stub('exec sleep 60'))
+    reaps = []
+    reap = executor._reap
+    def counting_reap():
+      reaps.append(len(executor.busy))
+      reap()
+    executor._reap = counting_reap
+    scheduler = paris_rollins.TracerouteScheduler(
+        executor, 'test.host', paris_rollins.SourcePortAllocator(100, 10))
+    scheduler.submit([(time.time(), '10.0.%d.1' % i, 80, '1.2.3.4', 1234)
+                      for i in range(12)])
+    scheduler.dispatch()
+    self.assertEqual(len(executor.busy), 10)
+    self.assertEqual(len(scheduler), 2)
+    # Reaped once before starting traceroutes, not once per traceroute.
+    self.assertEqual(reaps, [0])
+    executor.close()
+
+  def test_executor_missing_binary(self):
+    executor = paris_rollins.TracerouteExecutor(
+        self.tmpdir, traceroute_bin=os.path.join(self.tmpdir, 'missing'))
+    self.assertTrue(executor.run_async(0, 'test.host', 7, '5.6.7.8', 80,
+                                       '1.2.3.4', 1234))
+    self.assertEqual(executor.finished_ports(), [7])
+
 
 if __name__ == '__main__':
     unittest.main()
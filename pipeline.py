@@ -0,0 +1,183 @@
+"""
+pipeline.py: Bounded queue and writer threads that decouple polling from I/O.
+
+The poller puts connection snapshots into a SnapshotQueue, and WriterThreads
+take them off and write them.  When the queue is full, the overflow policy
+decides whether the poller waits (BLOCK), the oldest snapshot is discarded
+(DROP_OLDEST), or snapshots are pickled to a spill file on disk until the
+writers catch up (SPILL).
+"""
+
+import collections
+import cPickle
+import tempfile
+import threading
+import time
+
+import prometheus_client as prom
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+queue_depth = prom.Gauge('sidestream_queue_depth',
+                         'Snapshots waiting to be written, including spilled')
+queue_dropped = prom.Counter('sidestream_queue_dropped_count',
+                             'Count of snapshots dropped from a full queue')
+queue_spilled = prom.Counter('sidestream_queue_spilled_count',
+                             'Count of snapshots spilled to disk')
+
+
+class Closed(Exception):
+    """Raised by SnapshotQueue.get() once the queue is closed and empty."""
+
+
+class SnapshotQueue(object):
+    """A bounded FIFO queue with a configurable overflow policy.
+
+    Spilled items are always newer than the items held in memory, so get()
+    returns items in the order they were put.
+    """
+
+    def __init__(self, maxsize, policy=BLOCK, spill_dir=None):
+        """
+        Args:
+          maxsize: int, number of items held in memory.
+          policy: one of POLICIES, what to do when maxsize items are queued.
+          spill_dir: str, directory for the spill file, for the SPILL policy.
+        """
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        # Spill file, and the offset of the next item to read back from it.
+        self.spill = None
+        self.spill_count = 0
+        self.spill_offset = 0
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items) + self.spill_count
+
+    def put(self, item):
+        """Queue an item, applying the overflow policy if the queue is full."""
+        with self.cond:
+            if self.policy == BLOCK:
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.cond.wait()
+            if self.spill_count or len(self.items) >= self.maxsize:
+                if self.policy == SPILL:
+                    self._spillItem(item)
+                    self.cond.notify()
+                    return
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                    queue_dropped.inc()
+            self.items.append(item)
+            queue_depth.set(len(self.items) + self.spill_count)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item.
+
+        Args:
+          timeout: float, seconds to wait for an item, or None to wait forever.
+        Returns:
+          the item, or None if the timeout expired.
+        Raises:
+          Closed: the queue is closed and all items have been returned.
+        """
+        with self.cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.items:
+                if self.spill_count:
+                    self._unspill()
+                    break
+                if self.closed:
+                    raise Closed()
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            item = self.items.popleft()
+            queue_depth.set(len(self.items) + self.spill_count)
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        """Stop accepting items; get() raises Closed once the queue drains."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _spillItem(self, item):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix='sidestream-spill',
+                                                dir=self.spill_dir)
+        self.spill.seek(0, 2)
+        cPickle.dump(item, self.spill, cPickle.HIGHEST_PROTOCOL)
+        self.spill_count += 1
+        queue_spilled.inc()
+        queue_depth.set(len(self.items) + self.spill_count)
+
+    def _unspill(self):
+        """Move up to maxsize items from the spill file back into memory."""
+        self.spill.seek(self.spill_offset)
+        while self.spill_count and len(self.items) < self.maxsize:
+            self.items.append(cPickle.load(self.spill))
+            self.spill_count -= 1
+        self.spill_offset = self.spill.tell()
+        if not self.spill_count:
+            # Everything was read back, so the file can be reused.
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_offset = 0
+
+
+class WriterThread(threading.Thread):
+    """Takes items off a SnapshotQueue and passes them to a handler.
+
+    The handler runs under the lock, so several WriterThreads may share a
+    handler that is not thread safe.  idle is called with the current time at
+    least every idle_seconds, e.g. to flush batched output.
+    """
+
+    def __init__(self, queue, handle, idle=None, idle_seconds=1, lock=None,
+                 error_callback=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.handle = handle
+        self.idle = idle
+        self.idle_seconds = idle_seconds
+        self.lock = lock or threading.Lock()
+        self.error_callback = error_callback
+
+    def run(self):
+        next_idle = time.time() + self.idle_seconds
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_seconds)
+            except Closed:
+                return
+            with self.lock:
+                if item is not None:
+                    try:
+                        self.handle(item)
+                    except Exception as e:
+                        if self.error_callback:
+                            self.error_callback(e)
+                now = time.time()
+                if self.idle and now >= next_idle:
+                    self.idle(now)
+                    next_idle = now + self.idle_seconds
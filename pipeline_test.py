@@ -0,0 +1,106 @@
+"""Tests for pipeline."""
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pipeline
+
+
+class TestSnapshotQueue(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testFifo(self):
+    q = pipeline.SnapshotQueue(10)
+    for i in range(5):
+      q.put(i)
+    self.assertEqual(len(q), 5)
+    self.assertEqual([q.get() for _ in range(5)], range(5))
+    self.assertEqual(q.get(timeout=0.01), None)
+
+  def testUnknownPolicy(self):
+    with self.assertRaises(ValueError):
+      pipeline.SnapshotQueue(10, policy='lose-everything')
+
+  def testDropOldest(self):
+    q = pipeline.SnapshotQueue(3, policy=pipeline.DROP_OLDEST)
+    for i in range(5):
+      q.put(i)
+    self.assertEqual(q.dropped, 2)
+    self.assertEqual([q.get() for _ in range(3)], [2, 3, 4])
+
+  def testSpill(self):
+    q = pipeline.SnapshotQueue(3, policy=pipeline.SPILL,
+                               spill_dir=self.tmpdir)
+    for i in range(10):
+      q.put({'cid': i})
+    self.assertEqual(len(q), 10)
+    self.assertEqual(q.spill_count, 7)
+    self.assertEqual([q.get()['cid'] for _ in range(5)], range(5))
+    # Items put while older items are spilled must not overtake them.
+    q.put({'cid': 10})
+    self.assertEqual([q.get()['cid'] for _ in range(6)], range(5, 11))
+    self.assertEqual(len(q), 0)
+    self.assertEqual(q.spill_offset, 0)
+
+  def testBlock(self):
+    q = pipeline.SnapshotQueue(1)
+    q.put(1)
+    putter = threading.Thread(target=q.put, args=(2,))
+    putter.start()
+    putter.join(0.05)
+    self.assertTrue(putter.is_alive())
+    self.assertEqual(q.get(), 1)
+    putter.join()
+    self.assertEqual(q.get(), 2)
+
+  def testClose(self):
+    q = pipeline.SnapshotQueue(10)
+    q.put(1)
+    q.close()
+    self.assertEqual(q.get(), 1)
+    with self.assertRaises(pipeline.Closed):
+      q.get()
+
+
+class TestWriterThread(unittest.TestCase):
+
+  def testDrainsQueue(self):
+    q = pipeline.SnapshotQueue(10)
+    handled = []
+    errors = []
+
+    def handle(item):
+      if item == 'bad':
+        raise ValueError(item)
+      handled.append(item)
+
+    writer = pipeline.WriterThread(q, handle, error_callback=errors.append)
+    writer.start()
+    for item in ('a', 'bad', 'b'):
+      q.put(item)
+    q.close()
+    writer.join()
+    self.assertEqual(handled, ['a', 'b'])
+    self.assertEqual(len(errors), 1)
+
+  def testIdle(self):
+    q = pipeline.SnapshotQueue(10)
+    idle = threading.Event()
+    writer = pipeline.WriterThread(q, lambda item: None,
+                                   idle=lambda now: idle.set(),
+                                   idle_seconds=0.01)
+    writer.start()
+    self.assertTrue(idle.wait(5))
+    q.close()
+    writer.join()
+
+
+if __name__ == '__main__':
+  unittest.main()
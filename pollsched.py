@@ -0,0 +1,82 @@
+"""
+pollsched.py: Adaptive poll interval for the Web100 pollers.
+
+Closed connections stay visible to the Web100 agent only until the kernel
+reaps them.  At high churn a fixed interval misses closes, and at idle it walks
+every socket for nothing.  AdaptiveInterval halves the interval after a busy
+poll, and grows it slowly after quiet ones, within configured bounds.  The
+number of new closes per poll settles between the quiet and busy thresholds.
+"""
+
+import prometheus_client as prom
+
+poll_interval = prom.Gauge('sidestream_poll_interval_seconds',
+                           'Current interval between polls')
+missed_close_count = prom.Counter(
+    'sidestream_missed_close_count',
+    'Estimated count of closed connections reaped before a poll saw them')
+
+
+class AdaptiveInterval(object):
+    """Chooses the interval before the next poll from the last one.
+
+    A poll is busy if it found more than busy_closes new closes, missed more
+    than busy_missed closes, or took longer than slow_fraction of the current
+    interval.  The interval is multiplied by shrink after a busy poll, and by
+    grow after a quiet poll, which found fewer than quiet_closes new closes
+    in less than half that time.  Up to busy_missed missed closes are
+    tolerated, since reused cids and very short connections cause some even
+    at the minimum interval.
+    """
+
+    def __init__(self, minimum=1.0, maximum=10.0, initial=5.0,
+                 busy_closes=500, quiet_closes=50, busy_missed=10,
+                 slow_fraction=0.2, shrink=0.5, grow=1.25):
+        """
+        Args:
+          minimum, maximum: float, bounds of the interval, in seconds.
+          initial: float, interval before the first update, in seconds.
+          busy_closes, quiet_closes: int, new closes per poll above which a
+              poll is busy, and below which it may be quiet.
+          busy_missed: int, missed closes per poll above which a poll is
+              busy.
+          slow_fraction: float, fraction of the interval that a poll must
+              take to be busy.
+          shrink, grow: float, factors applied to the interval.
+        """
+        if minimum > maximum:
+            raise ValueError('minimum interval %s exceeds maximum %s' % (
+                minimum, maximum))
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.busy_closes = busy_closes
+        self.quiet_closes = quiet_closes
+        self.busy_missed = busy_missed
+        self.slow_fraction = slow_fraction
+        self.shrink = shrink
+        self.grow = grow
+        self.interval = self._clamp(initial)
+        poll_interval.set(self.interval)
+
+    def _clamp(self, interval):
+        return min(self.maximum, max(self.minimum, interval))
+
+    def update(self, closes, poll_seconds, missed=0):
+        """Accounts for a poll, and returns the interval before the next one.
+
+        Args:
+          closes: int, new closes found by the poll.
+          poll_seconds: float, duration of the poll.
+          missed: int, estimated closes that were reaped before the poll.
+        Returns:
+          float, seconds from the start of this poll to the start of the next.
+        """
+        missed_close_count.inc(missed)
+        slow_poll = self.interval * self.slow_fraction
+        if (missed > self.busy_missed or closes > self.busy_closes or
+                poll_seconds > slow_poll):
+            self.interval = self._clamp(self.interval * self.shrink)
+        elif closes < self.quiet_closes and poll_seconds < slow_poll / 2:
+            self.interval = self._clamp(self.interval * self.grow)
+        poll_interval.set(self.interval)
+        return self.interval
@@ -0,0 +1,68 @@
+"""Tests for pollsched."""
+
+import unittest
+
+import prometheus_client as prom
+
+import pollsched
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+
+  def testBusyPollsShrink(self):
+    sched = pollsched.AdaptiveInterval(minimum=1, maximum=10, initial=8)
+    self.assertEqual(sched.update(1000, 0.1), 4)
+    self.assertEqual(sched.update(10, 2.0), 2)
+    self.assertEqual(sched.update(10, 0.1, missed=30), 1)
+    # Never below the minimum.
+    self.assertEqual(sched.update(1000, 0.1), 1)
+
+  def testQuietPollsGrow(self):
+    sched = pollsched.AdaptiveInterval(minimum=1, maximum=10, initial=4)
+    self.assertEqual(sched.update(0, 0.1), 5)
+    for _ in range(10):
+      sched.update(0, 0.1)
+    self.assertEqual(sched.interval, 10)
+
+  def testFewMissedClosesDoNotShrink(self):
+    sched = pollsched.AdaptiveInterval(minimum=1, maximum=10, initial=1,
+                                       busy_missed=5)
+    self.assertEqual(sched.update(10, 0.05, missed=5), 1.25)
+    self.assertEqual(sched.update(10, 0.05, missed=6), 1)
+
+  def testSlowPollIsRelativeToInterval(self):
+    sched = pollsched.AdaptiveInterval(minimum=1, maximum=10, initial=8,
+                                       slow_fraction=0.25)
+    # Two seconds is slow for a 4 second interval, but not for 8.
+    self.assertEqual(sched.update(100, 1.5), 8)
+    self.assertEqual(sched.update(100, 2.5), 4)
+    self.assertEqual(sched.update(100, 1.5), 2)
+
+  def testSteadyPollsHold(self):
+    sched = pollsched.AdaptiveInterval(initial=4)
+    self.assertEqual(sched.update(100, 0.1), 4)
+    # A poll that is fast but not quiet, or quiet but not fast, holds too.
+    self.assertEqual(sched.update(10, 0.7), 4)
+
+  def testFixedInterval(self):
+    sched = pollsched.AdaptiveInterval(minimum=5, maximum=5, initial=1)
+    self.assertEqual(sched.interval, 5)
+    self.assertEqual(sched.update(100000, 100), 5)
+
+  def testBadBounds(self):
+    with self.assertRaises(ValueError):
+      pollsched.AdaptiveInterval(minimum=10, maximum=1)
+
+  def testMetrics(self):
+    before = prom.REGISTRY.get_sample_value('sidestream_missed_close_count')
+    sched = pollsched.AdaptiveInterval(initial=4)
+    sched.update(0, 0.1, missed=70)
+    self.assertEqual(
+        prom.REGISTRY.get_sample_value('sidestream_missed_close_count'),
+        before + 70)
+    self.assertEqual(
+        prom.REGISTRY.get_sample_value('sidestream_poll_interval_seconds'), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
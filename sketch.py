@@ -0,0 +1,119 @@
+"""
+sketch.py: Constant memory distributions, exported as Prometheus histograms.
+
+A LogHistogram counts observations in fixed buckets spaced evenly in log
+scale, so its memory does not grow with the number of observations, and two
+histograms with the same buckets merge by adding their counts.  That makes it
+a mergeable quantile sketch, with a relative error bounded by the bucket
+spacing: across indexes, across servers, or over time.
+
+prometheus_client's own Histogram scans its buckets linearly under a lock on
+every observation, which is too slow for the per record path.  HistogramFamily
+finds the bucket by bisection, and only builds the Prometheus samples when
+they are scraped.
+"""
+
+import bisect
+import threading
+
+import prometheus_client as prom
+from prometheus_client.core import HistogramMetricFamily
+
+
+def logBuckets(low, high, per_decade=4):
+    """Returns histogram bucket bounds spaced evenly in log scale.
+
+    Args:
+      low: float, the first bound.
+      high: float, the last bound is the first at or above high.
+      per_decade: int, number of bounds per factor of ten.
+    """
+    buckets = []
+    i = 0
+    while not buckets or buckets[-1] < high:
+        buckets.append(float('%.3g' % (low * 10 ** (i / float(per_decade)))))
+        i += 1
+    return tuple(buckets)
+
+
+class LogHistogram(object):
+    """Counts of observations, by bucket.
+
+    counts[i] is the number of observations above bounds[i-1] and at most
+    bounds[i].  The last count is for observations above all bounds.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        """Adds the observations of other, which has the same bounds."""
+        if other.bounds != self.bounds:
+            raise ValueError('cannot merge histograms with different buckets')
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile."""
+        total = sum(self.counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class HistogramFamily(object):
+    """LogHistograms by label values, collected as one Prometheus histogram.
+
+    Observations are not locked.  Callers observing from several threads must
+    serialize them, as the exitstats writer threads do.
+    """
+
+    def __init__(self, name, documentation, labelnames, bounds,
+                 registry=prom.REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.bounds = bounds
+        self.children = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Returns the LogHistogram for the label values."""
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = LogHistogram(self.bounds)
+            return child
+
+    def collect(self):
+        family = HistogramMetricFamily(self.name, self.documentation,
+                                       labels=self.labelnames)
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            counts = list(child.counts)
+            buckets = []
+            total = 0
+            for bound, count in zip(self.bounds, counts):
+                total += count
+                buckets.append((repr(bound), total))
+            buckets.append(('+Inf', total + counts[-1]))
+            family.add_metric(list(values), buckets, child.sum)
+        yield family
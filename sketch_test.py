@@ -0,0 +1,60 @@
+"""Tests for sketch."""
+
+import unittest
+
+import prometheus_client as prom
+
+import sketch
+
+
+class TestLogHistogram(unittest.TestCase):
+
+  def testLogBuckets(self):
+    self.assertEqual(sketch.logBuckets(1, 100, 2),
+                     (1.0, 3.16, 10.0, 31.6, 100.0))
+
+  def testObserve(self):
+    h = sketch.LogHistogram((1.0, 10.0, 100.0))
+    for v in (0.5, 1, 5, 10, 50, 1000):
+      h.observe(v)
+    self.assertEqual(h.counts, [2, 2, 1, 1])
+    self.assertEqual(h.sum, 1066.5)
+
+  def testMergeAndQuantile(self):
+    a = sketch.LogHistogram((1.0, 10.0, 100.0))
+    b = sketch.LogHistogram((1.0, 10.0, 100.0))
+    for v in range(1, 10):
+      a.observe(v)
+    b.observe(50)
+    a.merge(b)
+    self.assertEqual(a.counts, [1, 8, 1, 0])
+    self.assertEqual(a.quantile(0.5), 10.0)
+    self.assertEqual(a.quantile(1), 100.0)
+    self.assertEqual(sketch.LogHistogram((1.0,)).quantile(0.5), None)
+    with self.assertRaises(ValueError):
+      a.merge(sketch.LogHistogram((1.0,)))
+
+
+class TestHistogramFamily(unittest.TestCase):
+
+  def testCollect(self):
+    registry = prom.CollectorRegistry()
+    family = sketch.HistogramFamily('test_seconds', 'Test', ['type'],
+                                    (1.0, 10.0), registry=registry)
+    family.labels('a').observe(0.5)
+    family.labels('a').observe(20)
+    family.labels('b').observe(5)
+    get = registry.get_sample_value
+    self.assertEqual(get('test_seconds_bucket', {'type': 'a', 'le': '1.0'}), 1)
+    self.assertEqual(get('test_seconds_bucket', {'type': 'a', 'le': '10.0'}),
+                     1)
+    self.assertEqual(get('test_seconds_bucket', {'type': 'a', 'le': '+Inf'}),
+                     2)
+    self.assertEqual(get('test_seconds_count', {'type': 'b'}), 1)
+    self.assertEqual(get('test_seconds_sum', {'type': 'a'}), 20.5)
+    self.assertTrue('test_seconds_bucket{le="10.0",type="b"} 1.0' in
+                    prom.generate_latest(registry))
+
+
+if __name__ == '__main__':
+  unittest.main()
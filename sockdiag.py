@@ -0,0 +1,314 @@
+"""
+sockdiag.py: A connection source that reads TCP statistics through netlink.
+
+Web100 needs a patched kernel, and is read one connection and one variable at
+a time.  On a stock Linux kernel, NETLINK_SOCK_DIAG dumps every TCP socket,
+with its struct tcp_info, in a stream of large messages.  SockDiagAgent turns
+each dump into connections with the interface of Web100.Web100Agent:
+all_connections() returns objects with a cid, read(name) and readall(), so
+that conntrack.ConnectionTracker and Web100StatsWriter.logConnection work
+unchanged.  tcp_info is decoded into the Web100 variable names it has an
+equivalent for.
+
+The kernel forgets a socket when it closes, instead of keeping it for a while
+like Web100.  The agent remembers the last dump of every socket, keyed by its
+socket cookie, and returns a socket that disappeared from the dump once more,
+on the next call, with State set to closed.  Its statistics are those of the
+previous dump, so they may miss the last poll interval of the connection.
+"""
+
+import os
+import socket
+import struct
+import time
+
+from collections import namedtuple
+
+# Web100 State value for a closed connection.
+WEB100_STATE_CLOSED = 1
+
+# Web100 LocalAddressType values.
+WEB100_IPV4 = 1
+WEB100_IPV6 = 2
+
+# Map from Linux TCP states (include/net/tcp_states.h) to Web100 states.
+WEB100_STATES = {
+    1: 5,    # ESTABLISHED
+    2: 3,    # SYN_SENT
+    3: 4,    # SYN_RECV
+    4: 6,    # FIN_WAIT1
+    5: 7,    # FIN_WAIT2
+    6: 11,   # TIME_WAIT
+    7: 1,    # CLOSE
+    8: 8,    # CLOSE_WAIT
+    9: 9,    # LAST_ACK
+    10: 2,   # LISTEN
+    11: 10,  # CLOSING
+}
+
+# Dump full sockets only.  Listening sockets are not connections, and
+# TIME_WAIT and SYN_RECV minisockets have no tcp_info.
+DUMP_STATES = sum(1 << s for s in (1, 2, 4, 5, 7, 8, 9, 11))
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_INFO = 2
+INET_DIAG_NOCOOKIE = 0xffffffffffffffff
+
+# struct nlmsghdr.
+NLMSGHDR = struct.Struct('=IHHII')
+# struct inet_diag_req_v2, with its inet_diag_sockid.
+INET_DIAG_REQ = struct.Struct('=BBBBIHH16s16sIQ')
+# struct inet_diag_msg.  The ports and addresses are in network order.
+INET_DIAG_MSG = struct.Struct('=BBBB2s2s16s16sIQIIIII')
+# struct rtattr.
+RTATTR = struct.Struct('=HH')
+
+# struct tcp_info, as of Linux 5.4.  Older kernels send a prefix of it, and
+# the missing fields read as zero.
+TCP_INFO = struct.Struct('=8B24I4Q6I4Q2I2Q4I')
+TcpInfo = namedtuple('TcpInfo', [
+    'state', 'ca_state', 'retransmits', 'probes', 'backoff', 'options',
+    'wscale', 'app_limited',
+    'rto', 'ato', 'snd_mss', 'rcv_mss', 'unacked', 'sacked', 'lost',
+    'retrans', 'fackets', 'last_data_sent', 'last_ack_sent',
+    'last_data_recv', 'last_ack_recv', 'pmtu', 'rcv_ssthresh', 'rtt',
+    'rttvar', 'snd_ssthresh', 'snd_cwnd', 'advmss', 'reordering', 'rcv_rtt',
+    'rcv_space', 'total_retrans',
+    'pacing_rate', 'max_pacing_rate', 'bytes_acked', 'bytes_received',
+    'segs_out', 'segs_in', 'notsent_bytes', 'min_rtt', 'data_segs_in',
+    'data_segs_out',
+    'delivery_rate', 'busy_time', 'rwnd_limited', 'sndbuf_limited',
+    'delivered', 'delivered_ce',
+    'bytes_sent', 'bytes_retrans',
+    'dsack_dups', 'reord_seen', 'rcv_ooopack', 'snd_wnd'])
+EMPTY_TCP_INFO = '\0' * TCP_INFO.size
+
+# tcp_info options bits.
+TCPI_OPT_TIMESTAMPS = 1
+TCPI_OPT_SACK = 2
+TCPI_OPT_ECN = 8
+
+# The largest 32 bit value, which tcp_info uses for "not measured yet".
+UINT32_MAX = 0xffffffff
+
+RECV_BUFFER = 1 << 16
+
+
+class error(Exception):
+    """Raised for netlink errors, and for reads of unknown variables."""
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def decode(msg, state, start, seen):
+    """Decodes an inet_diag_msg into Web100 variables.
+
+    Args:
+      msg: str, an inet_diag_msg followed by its attributes.
+      state: int, the Web100 State to report.
+      start: float, when the socket was first seen.
+      seen: float, when msg was dumped.
+    Returns:
+      dict of Web100 variable names to values.
+    """
+    (family, _, _, _, sport, dport, src, dst, _, _, _, rqueue, wqueue, _,
+     _) = INET_DIAG_MSG.unpack_from(msg)
+    raw = EMPTY_TCP_INFO
+    offset = INET_DIAG_MSG.size
+    while offset + RTATTR.size <= len(msg):
+        length, kind = RTATTR.unpack_from(msg, offset)
+        if length < RTATTR.size:
+            break
+        if kind == INET_DIAG_INFO:
+            raw = msg[offset + RTATTR.size:offset + length]
+            raw = raw[:TCP_INFO.size] + EMPTY_TCP_INFO[len(raw):]
+            break
+        offset += _align(length)
+    info = TcpInfo._make(TCP_INFO.unpack(raw))
+
+    if family == socket.AF_INET:
+        local = socket.inet_ntoa(src[:4])
+        remote = socket.inet_ntoa(dst[:4])
+        address_type = WEB100_IPV4
+    else:
+        local = socket.inet_ntop(socket.AF_INET6, src)
+        remote = socket.inet_ntop(socket.AF_INET6, dst)
+        address_type = WEB100_IPV6
+    mss = info.snd_mss
+    busy = info.busy_time
+    return {
+        'LocalAddress': local,
+        'LocalPort': struct.unpack('!H', sport)[0],
+        'RemAddress': remote,
+        'RemPort': struct.unpack('!H', dport)[0],
+        'State': state,
+        'SACKEnabled': int(bool(info.options & TCPI_OPT_SACK)),
+        'TimestampsEnabled': int(bool(info.options & TCPI_OPT_TIMESTAMPS)),
+        'ECNEnabled': int(bool(info.options & TCPI_OPT_ECN)),
+        'SndWinScale': info.wscale & 0xf,
+        'RcvWinScale': info.wscale >> 4,
+        'WinScaleRcvd': info.wscale & 0xf,
+        'WinScaleSent': info.wscale >> 4,
+        'MSSRcvd': info.rcv_mss,
+        'PktsOut': info.segs_out,
+        'DataPktsOut': info.data_segs_out,
+        'DataBytesOut': info.bytes_sent or info.bytes_acked,
+        'PktsIn': info.segs_in,
+        'DataPktsIn': info.data_segs_in,
+        'DataBytesIn': info.bytes_received,
+        'ThruBytesAcked': info.bytes_acked,
+        'ThruBytesReceived': info.bytes_received,
+        'StartTimeSec': int(start),
+        'StartTimeUsec': int(start * 1e6) % 1000000,
+        'Duration': int((seen - start) * 1e6),
+        'SndLimTimeSender': info.sndbuf_limited,
+        'SndLimTimeRwin': info.rwnd_limited,
+        'SndLimTimeCwnd': max(0, busy - info.rwnd_limited -
+                              info.sndbuf_limited),
+        'CurCwnd': info.snd_cwnd * mss,
+        'CurSsthresh': min(info.snd_ssthresh * mss, UINT32_MAX),
+        'PktsRetrans': info.total_retrans,
+        'BytesRetrans': info.bytes_retrans,
+        'DSACKDups': info.dsack_dups,
+        'SmoothedRTT': info.rtt // 1000,
+        'RTTVar': info.rttvar // 1000,
+        'MinRTT': (info.min_rtt // 1000
+                   if info.min_rtt != UINT32_MAX else 0),
+        'CurRTO': info.rto // 1000,
+        'CurMSS': mss,
+        'CurAppWQueue': wqueue,
+        'CurAppRQueue': rqueue,
+        'CurRwinRcvd': info.snd_wnd,
+        'LocalAddressType': address_type,
+        'X_RcvRTT': info.rcv_rtt // 1000,
+        'X_rcv_ssthresh': info.rcv_ssthresh,
+    }
+
+
+class SockDiagConnection(object):
+    """A TCP socket from a sock_diag dump.
+
+    Only the State is decoded up front.  The rest of the message is decoded
+    on the first read of any other variable.
+    """
+
+    __slots__ = ('cid', 'state', 'msg', 'start', 'seen', '_values')
+
+    def __init__(self, cid, state, msg, start, seen):
+        self.cid = cid
+        self.state = state
+        self.msg = msg
+        self.start = start
+        self.seen = seen
+        self._values = None
+
+    def closed(self):
+        """Returns a copy of this connection, in the closed state."""
+        return SockDiagConnection(self.cid, WEB100_STATE_CLOSED, self.msg,
+                                  self.start, self.seen)
+
+    def _decoded(self):
+        if self._values is None:
+            self._values = decode(self.msg, self.state, self.start, self.seen)
+        return self._values
+
+    def read(self, name):
+        if name == 'State':
+            return self.state
+        try:
+            return self._decoded()[name]
+        except KeyError:
+            raise error('no variable %s' % name)
+
+    def readall(self):
+        return dict(self._decoded())
+
+    def readvars(self, names):
+        """Returns the variables in names that this connection has."""
+        values = self._decoded()
+        return dict((k, values[k]) for k in names if k in values)
+
+
+class SockDiagAgent(object):
+    """A stand in for Web100.Web100Agent, backed by NETLINK_SOCK_DIAG."""
+
+    def __init__(self, families=(socket.AF_INET, socket.AF_INET6),
+                 clock=time.time):
+        """
+        Args:
+          families: address families to dump.
+          clock: callable, returns the current time in seconds.
+        """
+        self.families = families
+        self.clock = clock
+        self.seq = 0
+        # Map from socket cookie to the SockDiagConnection of the last dump.
+        self.sockets = {}
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                      NETLINK_SOCK_DIAG)
+            self.sock.bind((0, 0))
+        except (AttributeError, socket.error) as e:
+            raise error('cannot open NETLINK_SOCK_DIAG: %s' % e)
+
+    def close(self):
+        self.sock.close()
+
+    def dump(self, family):
+        """Yields (cookie, Linux TCP state, message) for each socket."""
+        self.seq += 1
+        request = INET_DIAG_REQ.pack(
+            family, socket.IPPROTO_TCP, 1 << (INET_DIAG_INFO - 1), 0,
+            DUMP_STATES, 0, 0, '', '', 0, INET_DIAG_NOCOOKIE)
+        self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(request),
+                                     SOCK_DIAG_BY_FAMILY,
+                                     NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0) +
+                       request)
+        header_size = NLMSGHDR.size
+        while True:
+            data = self.sock.recv(RECV_BUFFER)
+            offset = 0
+            while offset + header_size <= len(data):
+                length, kind, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+                if length < header_size:
+                    raise error('truncated netlink message')
+                if seq != self.seq:
+                    offset += _align(length)
+                    continue
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    errno = -struct.unpack_from('=i', data,
+                                                offset + header_size)[0]
+                    raise error('sock_diag dump failed: %s' %
+                                os.strerror(errno))
+                msg = data[offset + header_size:offset + length]
+                yield (INET_DIAG_MSG.unpack_from(msg)[9], ord(msg[1]), msg)
+                offset += _align(length)
+
+    def all_connections(self):
+        """Returns the open sockets, and those that closed since last call."""
+        now = self.clock()
+        previous = self.sockets
+        current = {}
+        connections = []
+        for family in self.families:
+            for cookie, state, msg in self.dump(family):
+                old = previous.get(cookie)
+                c = SockDiagConnection(
+                    cookie, WEB100_STATES.get(state, 0), msg,
+                    old.start if old is not None else now, now)
+                current[cookie] = c
+                connections.append(c)
+        for cookie, c in previous.iteritems():
+            if cookie not in current and c.state != WEB100_STATE_CLOSED:
+                connections.append(c.closed())
+        self.sockets = current
+        return connections
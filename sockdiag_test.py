@@ -0,0 +1,149 @@
+"""Tests for sockdiag."""
+
+import socket
+import struct
+import unittest
+
+import conntrack
+import sockdiag
+
+
+def fakeMessage(cookie, state, info=None, family=socket.AF_INET):
+  '''Builds an inet_diag_msg for 10.0.0.1:80 -> 10.0.0.2:4321.'''
+  if family == socket.AF_INET:
+    src = socket.inet_aton('10.0.0.1') + '\0' * 12
+    dst = socket.inet_aton('10.0.0.2') + '\0' * 12
+  else:
+    src = socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+    dst = socket.inet_pton(socket.AF_INET6, '2001:db8::2')
+  msg = sockdiag.INET_DIAG_MSG.pack(
+      family, state, 0, 0, struct.pack('!H', 80), struct.pack('!H', 4321),
+      src, dst, 0, cookie, 0, 0, 0, 0, 0)
+  if info is not None:
+    msg += sockdiag.RTATTR.pack(sockdiag.RTATTR.size + len(info),
+                                sockdiag.INET_DIAG_INFO) + info
+  return msg
+
+
+class FakeAgent(sockdiag.SockDiagAgent):
+  '''A SockDiagAgent that dumps a list of messages instead of the kernel.'''
+
+  def __init__(self):
+    self.families = (socket.AF_INET,)
+    self.clock = lambda: 1000.0
+    self.sockets = {}
+    self.messages = []
+
+  def dump(self, family):
+    for msg in self.messages:
+      yield sockdiag.INET_DIAG_MSG.unpack_from(msg)[9], ord(msg[1]), msg
+
+
+class TestDecode(unittest.TestCase):
+
+  def testTcpInfo(self):
+    fields = dict((f, 0) for f in sockdiag.TcpInfo._fields)
+    fields.update(options=sockdiag.TCPI_OPT_SACK, wscale=0x72, snd_mss=1000,
+                  snd_cwnd=10, rtt=25000, min_rtt=20000, total_retrans=3,
+                  bytes_acked=5000, bytes_received=700, busy_time=900,
+                  rwnd_limited=100, sndbuf_limited=200)
+    info = sockdiag.TCP_INFO.pack(*sockdiag.TcpInfo(**fields))
+    snap = sockdiag.decode(fakeMessage(7, 1, info), 5, 990.5, 1000.0)
+    self.assertEqual(snap['LocalAddress'], '10.0.0.1')
+    self.assertEqual(snap['RemPort'], 4321)
+    self.assertEqual(snap['State'], 5)
+    self.assertEqual(snap['SACKEnabled'], 1)
+    self.assertEqual(snap['TimestampsEnabled'], 0)
+    self.assertEqual((snap['SndWinScale'], snap['RcvWinScale']), (2, 7))
+    self.assertEqual(snap['CurCwnd'], 10000)
+    self.assertEqual(snap['SmoothedRTT'], 25)
+    self.assertEqual(snap['MinRTT'], 20)
+    self.assertEqual(snap['PktsRetrans'], 3)
+    self.assertEqual(snap['DataBytesOut'], 5000)
+    self.assertEqual(snap['DataBytesIn'], 700)
+    self.assertEqual(snap['SndLimTimeCwnd'], 600)
+    self.assertEqual((snap['StartTimeSec'], snap['StartTimeUsec']),
+                     (990, 500000))
+    self.assertEqual(snap['Duration'], 9500000)
+
+  def testShortTcpInfo(self):
+    # Older kernels send less of tcp_info.  The rest reads as zero.
+    snap = sockdiag.decode(fakeMessage(7, 1, '\0' * 104, socket.AF_INET6),
+                           5, 1000, 1000)
+    self.assertEqual(snap['RemAddress'], '2001:db8::2')
+    self.assertEqual(snap['LocalAddressType'], sockdiag.WEB100_IPV6)
+    self.assertEqual(snap['DataBytesIn'], 0)
+
+  def testSameKeysWithoutTcpInfo(self):
+    self.assertEqual(
+        sorted(sockdiag.decode(fakeMessage(7, 1), 5, 1000, 1000)),
+        sorted(sockdiag.decode(fakeMessage(7, 1, '\0' * 232), 5, 1000, 1000)))
+
+
+class TestSockDiagAgent(unittest.TestCase):
+
+  def testVanishedSocketsAreClosedOnce(self):
+    agent = FakeAgent()
+    agent.messages = [fakeMessage(7, 1), fakeMessage(8, 1)]
+    tracker = conntrack.ConnectionTracker()
+    self.assertEqual(tracker.poll(agent.all_connections()), [])
+    agent.messages = [fakeMessage(8, 1)]
+    conns = agent.all_connections()
+    self.assertEqual([(c.cid, c.read('State')) for c in conns],
+                     [(8, 5), (7, sockdiag.WEB100_STATE_CLOSED)])
+    closed = tracker.poll(conns)
+    self.assertEqual([c.generation.cid for c in closed], [7])
+    self.assertEqual(closed[0].connection.readall()['State'],
+                     sockdiag.WEB100_STATE_CLOSED)
+    self.assertEqual(agent.all_connections()[0].cid, 8)
+    self.assertEqual(len(agent.all_connections()), 1)
+
+  def testReadVars(self):
+    agent = FakeAgent()
+    agent.messages = [fakeMessage(7, 1)]
+    c = agent.all_connections()[0]
+    self.assertEqual(c.readvars(['RemPort', 'State', 'NoSuchVariable']),
+                     {'RemPort': 4321, 'State': 5})
+
+  def testUnknownVariable(self):
+    agent = FakeAgent()
+    agent.messages = [fakeMessage(7, 1)]
+    with self.assertRaises(sockdiag.error):
+      agent.all_connections()[0].read('NoSuchVariable')
+
+  def testLoopback(self):
+    try:
+      agent = sockdiag.SockDiagAgent(families=(socket.AF_INET,))
+      list(agent.dump(socket.AF_INET))
+    except (sockdiag.error, socket.error) as e:
+      self.skipTest('NETLINK_SOCK_DIAG unavailable: %s' % e)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    client.sendall('x' * 1000)
+    server.recv(1000)
+    port = client.getsockname()[1]
+
+    def find(conns):
+      return [c for c in conns if c.read('LocalPort') == port]
+    mine = find(agent.all_connections())
+    self.assertEqual(len(mine), 1)
+    self.assertEqual(mine[0].read('State'), 5)
+    self.assertEqual(mine[0].read('DataBytesOut'), 1000)
+
+    # Reset the connection, so that it does not linger in TIME_WAIT.
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                      struct.pack('ii', 1, 0))
+    client.close()
+    server.close()
+    listener.close()
+    closed = find(agent.all_connections())
+    self.assertEqual([(c.cid, c.read('State')) for c in closed],
+                     [(mine[0].cid, sockdiag.WEB100_STATE_CLOSED)])
+    agent.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
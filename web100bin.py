@@ -0,0 +1,234 @@
+"""
+web100bin.py: Compact binary format for Web100 exit snapshots.
+
+A binary log file is a sequence of blocks, each starting with a one byte tag:
+
+  K: a schema block, listing the columns of the records that follow.
+       'K' u8 version, u16 column count, then for each column:
+       u8 type ('Q' unsigned 64 bit integer, 'A' 16 byte address), u16 name
+       length, name.
+  C: a record block, packed as fixed width little endian fields:
+       'C' u64 cid, i64 PollTime (seconds since the epoch), then one field per
+       schema column.  Addresses are stored as 16 byte IPv6 addresses, with
+       IPv4 addresses mapped into ::ffff:0:0/96.
+  S: a sampling block, written when exitstats starts or stops shedding load.
+       'S' i64 PollTime, u32 rate.  The records that follow are a
+       deterministic 1 in rate sample of the closed connections, until the
+       next sampling block.  Files start unsampled (rate 1).
+
+A file starts with a schema block, and a new schema block is written whenever
+the set of logged variables changes.  All records following a schema block
+have the same size, so a reader can load them as arrays without parsing each
+record.
+"""
+
+import gzip
+import socket
+import struct
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+VERSION = 1
+TYPE_INT = 'Q'
+TYPE_ADDRESS = 'A'
+MASK64 = (1 << 64) - 1
+
+_SCHEMA_HEADER = struct.Struct('<cBH')
+_SAMPLING = struct.Struct('<cqI')
+_COLUMN_HEADER = struct.Struct('<cH')
+_FIELD_FORMATS = {TYPE_INT: 'Q', TYPE_ADDRESS: '16s'}
+_NUMPY_TYPES = {TYPE_INT: '<u8', TYPE_ADDRESS: 'S16'}
+_IPV4_MAPPED_PREFIX = '\0' * 10 + '\xff\xff'
+
+
+def packAddress(address):
+    """Returns the 16 byte binary form of an IPv4 or IPv6 address string.
+
+    Unparsable addresses are packed as all zeros.
+    """
+    try:
+        if ':' in address:
+            return socket.inet_pton(socket.AF_INET6, address)
+        return _IPV4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, TypeError):
+        return '\0' * 16
+
+
+def unpackAddress(packed):
+    """Returns the string form of a 16 byte address from packAddress."""
+    packed = packed.ljust(16, '\0')
+    if packed.startswith(_IPV4_MAPPED_PREFIX):
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+class BinaryFormat(object):
+    """Formats Web100 snapshots as binary schema and record blocks.
+
+    setkey must be called before header or record, with the variables to log
+    and a sample snapshot, which determines the type of each column.
+    """
+    suffix = '.web100b'
+
+    def __init__(self):
+        self.active_vars = None
+
+    def setkey(self, active_vars, snap):
+        self.active_vars = list(active_vars)
+        self.types = [TYPE_ADDRESS if isinstance(snap[v], basestring)
+                      else TYPE_INT for v in self.active_vars]
+        self.addresses = [i for i, t in enumerate(self.types)
+                          if t == TYPE_ADDRESS]
+        self.struct = struct.Struct(
+            '<cQq' + ''.join(_FIELD_FORMATS[t] for t in self.types))
+        getter = itemgetter(*self.active_vars) if self.active_vars else None
+        if len(self.active_vars) == 1:
+            self.getter = lambda snap: (getter(snap),)
+        elif getter:
+            self.getter = getter
+        else:
+            self.getter = lambda snap: ()
+
+    def header(self):
+        block = [_SCHEMA_HEADER.pack('K', VERSION, len(self.active_vars))]
+        for name, t in zip(self.active_vars, self.types):
+            block.append(_COLUMN_HEADER.pack(t, len(name)))
+            block.append(name)
+        return ''.join(block)
+
+    def record(self, cid, poll_time, snap):
+        values = list(self.getter(snap))
+        for i in self.addresses:
+            values[i] = packAddress(values[i])
+        try:
+            return self.struct.pack('C', cid, int(poll_time), *values)
+        except struct.error:
+            # Values outside the unsigned 64 bit range wrap, as in the kernel.
+            for i, t in enumerate(self.types):
+                if t == TYPE_INT:
+                    values[i] = int(values[i]) & MASK64
+            return self.struct.pack('C', cid, int(poll_time), *values)
+
+    def sampling(self, poll_time, rate):
+        return _SAMPLING.pack('S', int(poll_time), rate)
+
+
+def openLog(name):
+    """Opens a binary log for reading, decompressing .gz and .zst files."""
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('reading %s requires the zstandard module' % name)
+        return zstandard.ZstdDecompressor().stream_reader(open(name, 'rb'))
+    return open(name, 'rb')
+
+
+def _readAll(f):
+    chunks = []
+    while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def _parseSchema(data, offset):
+    """Returns (names, types, offset after the block) for a schema block."""
+    tag, version, count = _SCHEMA_HEADER.unpack_from(data, offset)
+    if version != VERSION:
+        raise ValueError('unsupported binary log version %d' % version)
+    offset += _SCHEMA_HEADER.size
+    names, types = ['cid', 'PollTime'], []
+    for _ in range(count):
+        t, length = _COLUMN_HEADER.unpack_from(data, offset)
+        offset += _COLUMN_HEADER.size
+        names.append(data[offset:offset+length])
+        types.append(t)
+        offset += length
+    return names, types, offset
+
+
+def readSegments(data, rates=None):
+    """Splits the contents of a binary log into record arrays.
+
+    Args:
+      data: str, the uncompressed contents of a binary log.
+      rates: list, if not None, the sampling rate of each segment is appended
+          to it.
+    Returns:
+      list of numpy record arrays, one per run of records sharing a schema.
+      The fields are 'cid', 'PollTime' and the logged variables.
+    """
+    if numpy is None:
+        raise ValueError('reading binary logs requires numpy')
+    segments = []
+    offset = 0
+    dtype = None
+    rate = 1
+    while offset < len(data):
+        tag = data[offset]
+        if tag == 'S':
+            _, _, rate = _SAMPLING.unpack_from(data, offset)
+            offset += _SAMPLING.size
+        elif tag == 'K':
+            names, types, offset = _parseSchema(data, offset)
+            dtype = numpy.dtype(
+                [('tag', 'S1'), ('cid', '<u8'), ('PollTime', '<i8')] +
+                [(n, _NUMPY_TYPES[t]) for n, t in zip(names[2:], types)])
+        elif tag == 'C' and dtype is not None:
+            # Records are fixed size, so the tags of consecutive records are
+            # itemsize bytes apart.  The run ends at the first other tag.
+            available = (len(data) - offset) // dtype.itemsize
+            tags = numpy.frombuffer(data, dtype='S1',
+                                    count=available * dtype.itemsize,
+                                    offset=offset)[::dtype.itemsize]
+            others = numpy.flatnonzero(tags != 'C')
+            count = others[0] if len(others) else available
+            if count == 0:
+                raise ValueError('truncated record at offset %d' % offset)
+            segments.append(numpy.frombuffer(data, dtype=dtype, count=count,
+                                             offset=offset))
+            if rates is not None:
+                rates.append(rate)
+            offset += count * dtype.itemsize
+        else:
+            raise ValueError('unexpected block %r at offset %d' %
+                             (tag, offset))
+    return segments
+
+
+def readColumns(name):
+    """Loads a binary log as a dict of numpy arrays, one per column.
+
+    Only columns present in every schema of the file are returned.  Address
+    columns are arrays of 16 byte strings, see unpackAddress.  If any records
+    were sampled, a 'SampleRate' column holds the rate of each record, to
+    weight it by.
+    """
+    f = openLog(name)
+    try:
+        rates = []
+        segments = readSegments(_readAll(f), rates)
+    finally:
+        f.close()
+    if not segments:
+        return {}
+    names = [n for n in segments[0].dtype.names[1:]
+             if all(n in s.dtype.names for s in segments)]
+    columns = dict((n, numpy.concatenate([s[n] for s in segments]))
+                   for n in names)
+    if any(rate != 1 for rate in rates):
+        columns['SampleRate'] = numpy.concatenate(
+            [numpy.repeat(numpy.uint32(rate), len(s))
+             for s, rate in zip(segments, rates)])
+    return columns
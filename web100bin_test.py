@@ -0,0 +1,103 @@
+"""Tests for web100bin."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import web100bin
+
+
+class TestAddresses(unittest.TestCase):
+
+  def testRoundTrip(self):
+    for address in ('1.2.3.4', '2001:db8::1', '::1'):
+      packed = web100bin.packAddress(address)
+      self.assertEqual(len(packed), 16)
+      self.assertEqual(web100bin.unpackAddress(packed), address)
+
+  def testInvalid(self):
+    self.assertEqual(web100bin.packAddress('bad-address'), '\0' * 16)
+
+
+class TestBinaryFormat(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.name = os.path.join(self.tmpdir, 'test.web100b')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def snap(self, i):
+    return {'LocalAddress': '1.2.3.4', 'RemAddress': '2001:db8::%d' % i,
+            'DataBytesOut': i * 1000, 'MinRTT': i}
+
+  def testRoundTrip(self):
+    fmt = web100bin.BinaryFormat()
+    keys = ['LocalAddress', 'RemAddress', 'DataBytesOut', 'MinRTT']
+    fmt.setkey(keys, self.snap(0))
+    with open(self.name, 'wb') as f:
+      f.write(fmt.header())
+      for i in range(10):
+        f.write(fmt.record(100 + i, 1393151014 + i, self.snap(i)))
+
+    columns = web100bin.readColumns(self.name)
+    self.assertEqual(sorted(columns), sorted(keys + ['cid', 'PollTime']))
+    self.assertEqual(list(columns['cid']), range(100, 110))
+    self.assertEqual(list(columns['DataBytesOut']), range(0, 10000, 1000))
+    self.assertEqual(columns['PollTime'][3], 1393151017)
+    self.assertEqual(web100bin.unpackAddress(columns['RemAddress'][7]),
+                     '2001:db8::7')
+    self.assertEqual(web100bin.unpackAddress(columns['LocalAddress'][0]),
+                     '1.2.3.4')
+
+  def testSchemaChange(self):
+    fmt = web100bin.BinaryFormat()
+    with open(self.name, 'wb') as f:
+      fmt.setkey(['MinRTT', 'DataBytesOut'], self.snap(0))
+      f.write(fmt.header())
+      f.write(fmt.record(1, 0, self.snap(1)))
+      f.write(fmt.record(2, 0, self.snap(2)))
+      fmt.setkey(['MinRTT'], self.snap(0))
+      f.write(fmt.header())
+      f.write(fmt.record(3, 0, self.snap(3)))
+
+    with open(self.name, 'rb') as f:
+      segments = web100bin.readSegments(f.read())
+    self.assertEqual([len(s) for s in segments], [2, 1])
+    # Only columns present in every schema are returned.
+    columns = web100bin.readColumns(self.name)
+    self.assertEqual(sorted(columns), ['MinRTT', 'PollTime', 'cid'])
+    self.assertEqual(list(columns['MinRTT']), [1, 2, 3])
+
+  def testWrapsOutOfRangeValues(self):
+    fmt = web100bin.BinaryFormat()
+    fmt.setkey(['MinRTT'], {'MinRTT': 0})
+    with open(self.name, 'wb') as f:
+      f.write(fmt.header())
+      f.write(fmt.record(1, 0, {'MinRTT': -1}))
+    self.assertEqual(web100bin.readColumns(self.name)['MinRTT'][0], 2**64 - 1)
+
+  def testSampling(self):
+    fmt = web100bin.BinaryFormat()
+    fmt.setkey(['MinRTT'], {'MinRTT': 0})
+    with open(self.name, 'wb') as f:
+      f.write(fmt.header())
+      f.write(fmt.record(1, 0, {'MinRTT': 1}))
+      f.write(fmt.sampling(0, 4))
+      f.write(fmt.record(2, 0, {'MinRTT': 2}))
+      f.write(fmt.record(3, 0, {'MinRTT': 3}))
+      f.write(fmt.sampling(0, 1))
+      f.write(fmt.record(4, 0, {'MinRTT': 4}))
+    columns = web100bin.readColumns(self.name)
+    self.assertEqual(list(columns['MinRTT']), [1, 2, 3, 4])
+    self.assertEqual(list(columns['SampleRate']), [1, 4, 4, 1])
+
+  def testCorrupt(self):
+    with self.assertRaises(ValueError):
+      web100bin.readSegments('X')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,345 @@
+#! /usr/bin/python
+
+"""
+web100sim.py: A simulated Web100 agent, and a load harness for the daemons.
+
+SimulatedAgent behaves like Web100.Web100Agent: all_connections() returns the
+open and the closed but not yet reaped connections, each with a cid, read()
+and readall().  Connections are closed at a configurable rate, and stay
+visible for linger seconds after closing, like closed connections in the
+kernel.  A closed connection that is reaped before anyone read its State is
+counted as a missed close.
+
+Usage: web100sim.py [options]
+
+Runs exitstats or paris_rollins against a SimulatedAgent for a fixed
+duration, and reports the throughput and the number of missed closes.
+"""
+
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Web100 State values.
+STATE_CLOSED = 1
+STATE_ESTABLISHED = 5
+
+# Web100 LocalAddressType values.
+ADDRESS_IPV4 = 1
+ADDRESS_IPV6 = 2
+
+
+class error(Exception):
+    """Raised when reading a reaped connection, like Web100.error."""
+
+
+def replaySnapshots(name):
+    """Yields the snapshots logged in a text .web100 file.
+
+    Args:
+      name: str, the name of a .web100 file.
+    Yields:
+      dict of variables, with integer values converted to int.
+    """
+    keys = None
+    for line in open(name):
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'K:':
+            keys = fields[3:]
+        elif fields[0] == 'C:' and keys:
+            snap = {}
+            for k, v in zip(keys, fields[3:]):
+                try:
+                    snap[k] = int(v)
+                except ValueError:
+                    snap[k] = v
+            yield snap
+
+
+class SimulatedConnection(object):
+    """A connection of a SimulatedAgent."""
+
+    def __init__(self, agent, cid, values):
+        self.agent = agent
+        self.cid = cid
+        self.values = values
+        self.closed_at = None
+        self.observed = False
+        self.reaped = False
+
+    def read(self, name):
+        if self.reaped:
+            raise error('connection %d was reaped' % self.cid)
+        value = self.values[name]
+        if name == 'State' and value == STATE_CLOSED:
+            self.observed = True
+        return value
+
+    def readall(self):
+        if self.reaped:
+            raise error('connection %d was reaped' % self.cid)
+        if self.closed_at is not None:
+            self.observed = True
+        return dict(self.values)
+
+
+class SimulatedAgent(object):
+    """A configurable stand in for Web100.Web100Agent.
+
+    The agent keeps `connections` connections open.  It closes close_rate of
+    them per second, replacing each with a new connection, and reaps closed
+    connections linger seconds after they close.  Time advances with clock(),
+    which all_connections() reads.
+    """
+
+    def __init__(self, connections=1000, close_rate=100.0, linger=10.0,
+                 cid_reuse=0.5, ipv6_fraction=0.2, loopback_fraction=0.05,
+                 plc_fraction=0.01, remote_addresses=5000, local_addresses=13,
+                 templates=None, seed=0, clock=time.time):
+        """
+        Args:
+          connections: int, number of open connections.
+          close_rate: float, connections closed per second.
+          linger: float, seconds a closed connection stays visible.
+          cid_reuse: float, probability that a new connection reuses the cid
+              of a reaped connection.
+          ipv6_fraction, loopback_fraction, plc_fraction: float, fractions of
+              connections with IPv6, loopback, and PLC remote addresses.
+          remote_addresses: int, number of distinct remote addresses.
+          local_addresses: int, number of distinct local addresses.
+          templates: iterable of snapshots, e.g. from replaySnapshots, that
+              new connections copy their variables from, in turn.
+          seed: int, seed for the random choices.
+          clock: callable, returns the current time in seconds.
+        """
+        self.close_rate = float(close_rate)
+        self.linger = linger
+        self.cid_reuse = cid_reuse
+        self.ipv6_fraction = ipv6_fraction
+        self.loopback_fraction = loopback_fraction
+        self.plc_fraction = plc_fraction
+        self.remote_addresses = remote_addresses
+        self.local_addresses = local_addresses
+        self.templates = list(templates) if templates is not None else None
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.start = self.now = clock()
+        self.next_cid = 1
+        self.free_cids = []
+        self.opened = 0
+        # Open connections, and closed connections in the order they closed.
+        self.open = []
+        self.closed = []
+        self.closes = 0
+        self.missed = 0
+        for _ in range(connections):
+            self.open.append(self._newConnection())
+
+    def _address(self, n, ipv6):
+        if ipv6:
+            return '2001:db8:%x::%x' % (n >> 16, n & 0xffff)
+        return '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+
+    def _newConnection(self):
+        if self.free_cids and self.random.random() < self.cid_reuse:
+            cid = self.free_cids.pop(self.random.randrange(len(self.free_cids)))
+        else:
+            cid = self.next_cid
+            self.next_cid += 1
+        if self.templates:
+            values = dict(self.templates[self.opened % len(self.templates)])
+        else:
+            values = self._syntheticValues()
+        values['State'] = STATE_ESTABLISHED
+        values['StartTimeSec'] = int(self.now)
+        self.opened += 1
+        return SimulatedConnection(self, cid, values)
+
+    def _syntheticValues(self):
+        r = self.random.random()
+        ipv6 = self.random.random() < self.ipv6_fraction
+        local = 9 + self.random.randrange(self.local_addresses)
+        if ipv6:
+            local_address = '2001:db8:1::%d' % local
+        else:
+            local_address = '192.168.1.%d' % local
+        if r < self.loopback_fraction:
+            remote = '::1' if ipv6 else '127.0.0.1'
+        elif r < self.loopback_fraction + self.plc_fraction:
+            remote = '128.112.139.%d' % self.random.randrange(256)
+            ipv6 = False
+            local_address = '192.168.1.%d' % local
+        else:
+            remote = self._address(
+                self.random.randrange(self.remote_addresses), ipv6)
+        rtt = self.random.randint(1, 300)
+        return {
+            'LocalAddress': local_address,
+            'LocalPort': self.random.choice((80, 443, 3010, 8000)),
+            'RemAddress': remote,
+            'RemPort': self.random.randint(1024, 65535),
+            'LocalAddressType': ADDRESS_IPV6 if ipv6 else ADDRESS_IPV4,
+            'StartTimeUsec': self.random.randrange(1000000),
+            'DataBytesOut': self.random.randint(0, 1 << 24),
+            'DataBytesIn': self.random.randint(0, 1 << 16),
+            'PktsOut': self.random.randint(1, 20000),
+            'PktsIn': self.random.randint(1, 20000),
+            'PktsRetrans': self.random.randint(0, 100),
+            'CongestionSignals': self.random.randint(0, 20),
+            'MinRTT': rtt,
+            'SmoothedRTT': rtt + self.random.randint(0, 50),
+            'Duration': self.random.randint(1000, 60000000),
+        }
+
+    def advance(self, now):
+        """Closes, replaces and reaps connections up to time now."""
+        # Closes are spread evenly over time, from when the agent started.
+        while self.close_rate > 0 and self.open:
+            close_time = self.start + (self.closes + 1) / self.close_rate
+            if close_time > now:
+                break
+            self.now = close_time
+            # Swap a random open connection to the end, and close it.
+            i = self.random.randrange(len(self.open))
+            self.open[i], self.open[-1] = self.open[-1], self.open[i]
+            c = self.open.pop()
+            c.values['State'] = STATE_CLOSED
+            c.closed_at = close_time
+            self.closed.append(c)
+            self.closes += 1
+            self.open.append(self._newConnection())
+        self.now = now
+        reaped = 0
+        while (reaped < len(self.closed) and
+               self.closed[reaped].closed_at + self.linger <= now):
+            c = self.closed[reaped]
+            c.reaped = True
+            if not c.observed:
+                self.missed += 1
+            self.free_cids.append(c.cid)
+            reaped += 1
+        del self.closed[:reaped]
+
+    def all_connections(self):
+        self.advance(self.clock())
+        return self.open + self.closed
+
+
+def runExitstats(agent, duration, interval):
+    """Runs the exitstats poller and writer threads against agent.
+
+    Returns:
+      (polls, connections logged, total poll seconds)
+    """
+    import conntrack
+    import exitstats
+    import pipeline
+    writer = exitstats.Web100StatsWriter('sim/')
+    queue = pipeline.SnapshotQueue(100000)
+    _, writers = exitstats.startWriters(writer, queue, 1)
+    tracker = conntrack.ConnectionTracker(error_callback=exitstats.countException)
+    prefilter = exitstats.Prefilter(exitstats.ClassificationCache(
+        writer.ipToIndex, writer.connectionType))
+    polls = emitted = 0
+    poll_seconds = 0.0
+    end = time.time() + duration
+    try:
+        while time.time() < end:
+            start = time.time()
+            emitted += exitstats.pollConnections(
+                agent, tracker, queue, prefilter=prefilter).emitted
+            poll_seconds += time.time() - start
+            polls += 1
+            time.sleep(max(0, interval - (time.time() - start)))
+    finally:
+        exitstats.stopWriters(writer, queue, writers)
+    return polls, emitted, poll_seconds
+
+
+def runParisRollins(agent, duration, interval):
+    """Runs the paris_rollins scan (without traceroutes) against agent.
+
+    Returns:
+      (polls, connections selected for traceroute, total poll seconds)
+    """
+    import paris_rollins
+    # Reads of reaped connections raise error, like Web100.error.
+    read_errors = paris_rollins.READ_ERRORS + (error,)
+    cache = paris_rollins.RecentIPAddressCache(
+        paris_rollins.MEAN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MIN_IP_CACHE_TIME_SECONDS,
+        paris_rollins.MAX_IP_CACHE_TIME_SECONDS)
+    scan = paris_rollins.ScanState()
+    polls = selected = 0
+    poll_seconds = 0.0
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.time()
+        cache.expire(start)
+        selected += len(paris_rollins.uncached_closed_connections(
+            agent, cache, scan, read_errors))
+        poll_seconds += time.time() - start
+        polls += 1
+        time.sleep(max(0, interval - (time.time() - start)))
+    return polls, selected, poll_seconds
+
+
+DAEMONS = {'exitstats': runExitstats, 'paris_rollins': runParisRollins}
+
+optparser = optparse.OptionParser()
+optparser.add_option('--daemon', default='exitstats',
+                     help='daemon to drive: ' + ', '.join(sorted(DAEMONS)))
+optparser.add_option('--duration', type='float', default=30,
+                     help='seconds to run for')
+optparser.add_option('--interval', type='float', default=5,
+                     help='seconds between polls')
+optparser.add_option('--connections', type='int', default=50000,
+                     help='number of open connections')
+optparser.add_option('--close-rate', type='float', default=2000,
+                     help='connections closed per second')
+optparser.add_option('--linger', type='float', default=10,
+                     help='seconds a closed connection stays visible')
+optparser.add_option('--cid-reuse', type='float', default=0.5,
+                     help='probability that a new connection reuses a cid')
+optparser.add_option('--ipv6-fraction', type='float', default=0.2,
+                     help='fraction of IPv6 connections')
+optparser.add_option('--replay', help='.web100 file to copy connections from')
+
+
+def main(argv):
+    (options, args) = optparser.parse_args(argv[1:])
+    if options.daemon not in DAEMONS:
+        optparser.error('unknown daemon %s' % options.daemon)
+    templates = replaySnapshots(options.replay) if options.replay else None
+    agent = SimulatedAgent(connections=options.connections,
+                           close_rate=options.close_rate,
+                           linger=options.linger,
+                           cid_reuse=options.cid_reuse,
+                           ipv6_fraction=options.ipv6_fraction,
+                           templates=templates)
+    # exitstats writes its logs relative to the working directory.
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix='web100sim')
+    os.chdir(tmpdir)
+    try:
+        start = time.time()
+        polls, handled, poll_seconds = DAEMONS[options.daemon](
+            agent, options.duration, options.interval)
+        elapsed = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    print '%s: %d polls in %.1fs, %.3fs per poll' % (
+        options.daemon, polls, elapsed, poll_seconds / max(polls, 1))
+    print 'closes: %d, handled: %d (%.0f/sec), missed: %d' % (
+        agent.closes, handled, handled / elapsed, agent.missed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+"""Tests for web100sim."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import conntrack
+import web100sim
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestSimulatedAgent(unittest.TestCase):
+
+  def testPopulationAndCloses(self):
+    clock = FakeClock()
+    agent = web100sim.SimulatedAgent(connections=100, close_rate=10,
+                                     linger=5, clock=clock)
+    self.assertEqual(len(agent.all_connections()), 100)
+    clock.now += 2
+    conns = agent.all_connections()
+    self.assertEqual(len(conns), 120)
+    closed = [c for c in conns if c.read('State') == web100sim.STATE_CLOSED]
+    self.assertEqual(len(closed), 20)
+    self.assertEqual(agent.closes, 20)
+
+  def testMissedCloses(self):
+    clock = FakeClock()
+    agent = web100sim.SimulatedAgent(connections=100, close_rate=10,
+                                     linger=5, cid_reuse=0, clock=clock)
+    tracker = conntrack.ConnectionTracker()
+    clock.now += 1
+    self.assertEqual(len(tracker.poll(agent.all_connections())), 10)
+    # Polling less often than the linger time loses closes.
+    clock.now += 10
+    agent.all_connections()
+    self.assertEqual(agent.missed, 50)
+    clock.now += 10
+    agent.all_connections()
+    self.assertEqual(agent.missed, 150)
+
+  def testReapedConnectionsRaise(self):
+    clock = FakeClock()
+    agent = web100sim.SimulatedAgent(connections=1, close_rate=1, linger=1,
+                                     clock=clock)
+    c = agent.all_connections()[0]
+    clock.now += 1
+    agent.all_connections()
+    clock.now += 1
+    agent.all_connections()
+    with self.assertRaises(web100sim.error):
+      c.read('State')
+
+  def testCidReuse(self):
+    clock = FakeClock()
+    agent = web100sim.SimulatedAgent(connections=10, close_rate=10, linger=1,
+                                     cid_reuse=1, clock=clock)
+    for _ in range(5):
+      clock.now += 1
+      conns = agent.all_connections()
+    self.assertTrue(max(c.cid for c in conns) <= 30)
+
+  def testAddressMix(self):
+    agent = web100sim.SimulatedAgent(connections=1000, ipv6_fraction=0.5,
+                                     loopback_fraction=0.1, plc_fraction=0)
+    remotes = [c.read('RemAddress') for c in agent.all_connections()]
+    ipv6 = len([r for r in remotes if ':' in r])
+    loopback = len([r for r in remotes if r in ('::1', '127.0.0.1')])
+    self.assertTrue(400 < ipv6 < 600, ipv6)
+    self.assertTrue(50 < loopback < 150, loopback)
+
+
+class TestReplay(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testReplay(self):
+    name = os.path.join(self.tmpdir, 'test.web100')
+    with open(name, 'w') as f:
+      f.write('K: cid PollTime LocalAddress RemAddress DataBytesOut\n')
+      f.write('C: 1 2014-02-23-10:23:34Z 1.2.3.4 5.4.3.2 17\n')
+      f.write('C: 2 2014-02-23-10:23:34Z 1.2.3.4 5.4.3.3 18\n')
+    snaps = list(web100sim.replaySnapshots(name))
+    self.assertEqual(snaps[1], {'LocalAddress': '1.2.3.4',
+                                'RemAddress': '5.4.3.3', 'DataBytesOut': 18})
+
+    agent = web100sim.SimulatedAgent(connections=3, templates=snaps)
+    remotes = [c.read('RemAddress') for c in agent.all_connections()]
+    self.assertEqual(remotes, ['5.4.3.2', '5.4.3.3', '5.4.3.2'])
+
+
+class TestHarness(unittest.TestCase):
+
+  def testRunParisRollins(self):
+    import paris_rollins
+    read_errors = paris_rollins.READ_ERRORS
+    agent = web100sim.SimulatedAgent(connections=100, close_rate=100,
+                                     linger=0.01)
+    polls, _, _ = web100sim.runParisRollins(agent, 0.1, 0.02)
+    self.assertTrue(polls > 1)
+    # Reads of reaped connections were skipped without changing the module.
+    self.assertIs(paris_rollins.READ_ERRORS, read_errors)
+
+
+if __name__ == '__main__':
+  unittest.main()